@@ -4,22 +4,42 @@
 # ================================================================
 
 import os
+import re
+import io
+import csv
 import json
+import sys
 import copy
+import time
+import functools
+import bisect
+import heapq
 import random
+import math
+from collections import OrderedDict, deque
+from enum import IntEnum
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 import hashlib
+import base64
+import zlib
 import asyncio
 from datetime import datetime
 from zoneinfo import ZoneInfo
 
 import httpx
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import (
+    Update, InlineKeyboardButton, InlineKeyboardMarkup,
+    InlineQueryResultCachedDocument, InlineQueryResultArticle,
+    InputTextMessageContent, InputMediaDocument,
+)
 from telegram.ext import (
-    Application, CommandHandler, CallbackQueryHandler,
-    MessageHandler, ContextTypes, filters,
+    Application, CommandHandler, CallbackQueryHandler, InlineQueryHandler,
+    MessageHandler, TypeHandler, ContextTypes, BaseUpdateProcessor, filters,
 )
-from telegram.error import Forbidden, BadRequest
+from telegram.error import Forbidden, BadRequest, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 
 
 # ================================================================
@@ -41,6 +61,14 @@ FILE_NOTES    = "notes.json"
 FILE_LIKES    = "likes.json"
 FILE_POLL     = "poll.json"
 FILE_TERMS    = "terms.json"
+FILE_SEEN_UPD = "seen_updates.json"
+FILE_CAT_IDS  = "catalog_ids.json"
+FILE_TERM_IDS = "term_ids.json"
+FILE_DECKS    = "quiz_decks.json"
+FILE_BOARDS   = "leaderboard.json"
+FILE_OPENS    = "opens.json"
+FILE_STATS    = "stats_daily.json"
+FILE_SEEN     = "last_seen.json"
 
 TZ = ZoneInfo("Africa/Algiers")
 
@@ -128,6 +156,14 @@ CAT_MULAKH  = "📋 ملخص"
 CAT_IMTIHAN = "📝 امتحان"
 CATS        = [CAT_DARS, CAT_MULAKH, CAT_IMTIHAN]
 
+class Cat(IntEnum):
+    """رقم التصنيف المخزّن في سجلات الدروس — فهرس في CATS"""
+    DARS    = 0
+    MULAKH  = 1
+    IMTIHAN = 2
+
+CAT_BY_LABEL = {c: Cat(i) for i, c in enumerate(CATS)}
+
 
 # ================================================================
 #  ٢. البيانات المدمجة
@@ -202,26 +238,154 @@ ADYIA_YAWM = [
 def _clean(s):
     return "".join(str(s).strip().split()) if s else ""
 
+# ── التخزين: القراءة من الذاكرة والكتابة في خيط مستقل ──
+# _load يُرجع الكائن المخزَّن نفسه (مشترك): عدّله ثم مرّره لـ _save.
+# _save يحدّث الذاكرة فوراً ويجدول الكتابة على خيط واحد (ترتيب الملف محفوظ)؛
+# الكتابات المتتالية لنفس الملف قبل تنفيذها تُدمج في كتابة واحدة لآخر حالة.
+# defer=True: الذاكرة فقط، والكتابة مع الحفظ الدوري (تخفيف الحمل).
+# التعديل اليدوي للملف يُلتقط بمقارنة (mtime, size) عند القراءة.
+
+_STORE   = {}        # path ← [data, توقيع الملف على القرص، رقم النسخة]
+_PENDING = set()     # ملفات مُجدولة لم تبدأ كتابتها
+_DEFERRED = set()    # حُفظت في الذاكرة فقط (تخفيف الحمل) — تُكتب مع الحفظ الدوري
+_BUSY    = set()     # ملفات تُكتب الآن
+_IO      = ThreadPoolExecutor(max_workers=1, thread_name_prefix="store")
+_STORE_VER   = 0
+
+def _file_sig(path):
+    try:
+        st = os.stat(path)
+        return st.st_mtime_ns, st.st_size
+    except OSError:
+        return None
+
+def _next_ver():
+    global _STORE_VER
+    _STORE_VER += 1
+    return _STORE_VER
+
 def _load(path, default):
+    entry = _STORE.get(path)
+    if entry is not None and (path in _PENDING or path in _BUSY or path in _DEFERRED):
+        return entry[0]
+    sig = _file_sig(path)
+    if entry is not None and sig == entry[1]:
+        return entry[0]
+    if sig is None:
+        _STORE.pop(path, None)
+        return default
     try:
-        if os.path.exists(path):
-            with open(path, "r", encoding="utf-8") as f:
-                return json.load(f)
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
     except Exception:
-        pass
-    return default
-
-def _save(path, data):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+        return default
+    _STORE[path] = [data, sig, _next_ver()]
+    return data
+
+def _save(path, data, defer=False):
+    entry = _STORE.get(path)
+    if entry is None:
+        _STORE[path] = [data, None, _next_ver()]
+    else:
+        entry[0], entry[2] = data, _next_ver()
+    if defer:
+        _DEFERRED.add(path); return
+    _DEFERRED.discard(path)
+    if path not in _PENDING:
+        _PENDING.add(path)
+        _IO.submit(_write_file, path)
+
+def store_flush_deferred():
+    for path in list(_DEFERRED):
+        _save(path, _STORE[path][0])
+
+def _write_file(path):
+    """في خيط التخزين: تسلسل آخر حالة ثم استبدال ذرّي للملف"""
+    t0 = time.perf_counter()
+    _BUSY.add(path)
+    _PENDING.discard(path)          # ما يُحفظ بعد هذه اللحظة يُجدول كتابة جديدة
+    try:
+        entry = _STORE[path]
+        for _ in range(3):
+            try:
+                text = json.dumps(entry[0], ensure_ascii=False, indent=2)
+                break
+            except RuntimeError:    # عُدّل الكائن أثناء التسلسل ← نعيد
+                time.sleep(0.01)
+        else:
+            _PENDING.add(path); _IO.submit(_write_file, path)
+            return
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, path)
+        entry[1] = _file_sig(path)
+    except Exception as e:
+        print(f"⚠️ store write {path}: {e}")
+    finally:
+        _BUSY.discard(path)
+        STORE_WRITES.observe(time.perf_counter() - t0)
+
+def store_version(path):
+    """رقم يتغيّر مع كل حفظ من البوت أو تعديل يدوي للملف (None إن لم يوجد)"""
+    _load(path, None)
+    entry = _STORE.get(path)
+    return entry[2] if entry else None
+
+def store_drain():
+    """انتظار انتهاء كل الكتابات المجدولة (متزامن)"""
+    while _PENDING or _BUSY:
+        _IO.submit(lambda: None).result()
 
 def is_url(s):
     return isinstance(s, str) and (s.startswith("http://") or s.startswith("https://"))
 
+def parse_manifest(data):
+    """ملف بيان مرفوع ← صفوف خام (قوائم أو قواميس).
+    JSON: قائمة، أو قاموس فيه قائمة، أو قاموس {مفتاح: قيمة}. وإلا CSV.
+    يرفع ValueError إذا تعذّرت القراءة."""
+    text = bytes(data).decode("utf-8-sig").strip()
+    if text[:1] in "[{":
+        rows = json.loads(text)
+        if isinstance(rows, dict):
+            lists = [v for v in rows.values() if isinstance(v, list)]
+            rows  = lists[0] if lists else [[k, v] for k, v in rows.items()]
+        return rows
+    try:    dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t|")
+    except csv.Error: dialect = csv.excel
+    return [r for r in csv.reader(io.StringIO(text), dialect) if any(c.strip() for c in r)]
+
+def read_manifest(data, fields, aliases=None):
+    """ملف بيان (JSON أو CSV، سطر العناوين اختياري) ← صفوف نصية بترتيب fields.
+    data إما بايتات الملف أو صفوف parse_manifest بعد تعديلها."""
+    names = {f: f for f in fields}
+    names.update(aliases or {})
+    rows = parse_manifest(data) if isinstance(data, (bytes, bytearray)) else data
+    if rows and isinstance(rows[0], list) and \
+            all(str(c).strip().lower() in names for c in rows[0] if str(c).strip()):
+        head = [names.get(str(c).strip().lower(), "") for c in rows[0]]
+        rows = [dict(zip(head, r)) for r in rows[1:]]
+    out = []
+    for r in rows:
+        if isinstance(r, dict):
+            r = {names.get(str(k).strip().lower(), k): v for k, v in r.items()}
+            r = [r.get(f) for f in fields]
+        elif not isinstance(r, list):
+            raise ValueError(f"صف غير مفهوم: {r!r}"[:80])
+        r = (r + [None] * len(fields))[:len(fields)]
+        out.append(["" if v is None else str(v).strip() for v in r])
+    return out
+
 def is_admin(uid, cid=None):
     return uid in ADMIN_IDS or cid == ADMIN_CHAT_ID
 
-def lesson_key(year, spec, sem, subj, idx):
+def lesson_key(path, value, n=1):
+    """مفتاح الإعجاب: المسار + الملف، فلا يتغير بحذف درس قبله"""
+    s = f"{path}|{value}" if n == 1 else f"{path}|{value}#{n}"
+    return hashlib.md5(s.encode()).hexdigest()[:10]
+
+def legacy_lesson_key(year, spec, sem, subj, idx):
+    """المفتاح القديم المبني على ترتيب الدرس — للترحيل فقط"""
     s = f"{year}|{spec}|{sem}|{subj}|{idx}"
     return hashlib.md5(s.encode()).hexdigest()[:10]
 
@@ -233,15 +397,245 @@ def cat_icon(cat):
     return {"📖 درس": "📖", "📋 ملخص": "📋", "📝 امتحان": "📝"}.get(cat, "📄")
 
 
+# ================================================================
+#  ٣-أ. مقاييس الأداء
+# ================================================================
+
+# حدود الدلاء بالثواني (من 1ms إلى 5s)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class Histogram:
+    """مدرّج تكراري بدلاء ثابتة — التسجيل O(log b) بلا تخصيص ذاكرة"""
+    __slots__ = ("bounds", "counts", "total", "n")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)   # الأخير = +Inf
+        self.total  = 0.0
+        self.n      = 0
+
+    def observe(self, v):
+        self.counts[bisect.bisect_left(self.bounds, v)] += 1
+        self.total += v
+        self.n     += 1
+
+    def quantile(self, q):
+        """تقدير تقريبي: الحد الأعلى للدلو الذي يبلغ النسبة q"""
+        if not self.n: return 0.0
+        need, acc = q * self.n, 0
+        for i, c in enumerate(self.counts):
+            acc += c
+            if acc >= need:
+                return self.bounds[i] if i < len(self.bounds) else self.bounds[-1]
+        return self.bounds[-1]
+
+
+STORE_WRITES = Histogram()     # مدة كتابة الملفات في خيط التخزين
+
+
+# ================================================================
+#  ٣-ج. مراقبة الحمل: تأخّر حلقة الأحداث وتخفيف الحمل
+#  عيّنة كل LAG_SAMPLE_SECS = كم تأخّر الاستيقاظ عن موعده.
+#  p99 آخر LAG_WINDOW عيّنة يحدد المستوى (LAG_TIERS عتبات الصعود بالثواني):
+#    1 ← تأجيل حفظ الإعجابات والاستطلاع إلى الحفظ الدوري
+#    2 ← إيقاف المساعد الذكي ومواقيت الصلاة مؤقتاً مع تنبيه
+#    3 ← إبطاء البث
+#  النزول درجة واحدة بعد LAG_COOLDOWN وحين ينخفض p99 تحت نصف العتبة،
+#  فلا يتذبذب المستوى. تصفّح الدروس لا يتأثر بأي مستوى.
+# ================================================================
+
+LAG_SAMPLE_SECS = float(os.environ.get("LAG_SAMPLE_SECS", "0.25"))
+LAG_WINDOW      = 40
+LAG_TIERS       = tuple(float(x) for x in
+                        os.environ.get("LAG_TIERS", "0.05,0.15,0.4").split(","))
+LAG_COOLDOWN    = 15
+SHED_BROADCAST_DELAY = 0.2
+SHED_NOTICE = ("⏳ هذه الخدمة متوقفة مؤقتاً بسبب الضغط على البوت.\n"
+               "الدروس متاحة كالعادة، حاول بعد قليل 🌿")
+
+class LoadMonitor:
+    def __init__(self, tiers=LAG_TIERS):
+        self.tiers   = tiers
+        self.recent  = deque(maxlen=LAG_WINDOW)
+        self.hist    = Histogram()
+        self.level   = 0
+        self.changed = 0.0
+
+    def lag(self, q):
+        """نسبة q من تأخّر آخر LAG_WINDOW عيّنة (بالثواني)"""
+        if not self.recent: return 0.0
+        s = sorted(self.recent)
+        return s[min(len(s) - 1, int(q * len(s)))]
+
+    def observe(self, lag, now=None):
+        now = time.monotonic() if now is None else now
+        self.recent.append(lag)
+        self.hist.observe(lag)
+        p99 = self.lag(0.99)
+        up  = sum(1 for t in self.tiers if p99 >= t)
+        if up > self.level:
+            self._set(up, now)
+        elif (self.level and now - self.changed >= LAG_COOLDOWN
+                and p99 < self.tiers[self.level - 1] / 2):
+            self._set(self.level - 1, now)
+
+    def _set(self, level, now):
+        print(f"{'🔴' if level > self.level else '🟢'} مستوى الحمل {self.level} ← {level}"
+              f" (p99 {self.lag(0.99) * 1000:.0f}ms)")
+        self.level, self.changed = level, now
+        if level < 1:
+            store_flush_deferred()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            t = loop.time()
+            await asyncio.sleep(LAG_SAMPLE_SECS)
+            self.observe(max(0.0, loop.time() - t - LAG_SAMPLE_SECS))
+
+
+LOAD = LoadMonitor()
+
+def shedding(tier):
+    return LOAD.level >= tier
+
+async def broadcast_pause():
+    """بين رسائل البث: مهلة عند الضغط الشديد تترك الحلقة لطلبات الطلاب"""
+    if shedding(3):
+        await asyncio.sleep(SHED_BROADCAST_DELAY)
+
+
+# ================================================================
+#  ٣-ب. مُجمِّع الإحصاءات
+#  يُحدَّث من مسارات التعديل ومن معالج النشاط؛ /stats يقرأ منه فقط.
+#  المستخدمون النشطون: HyperLogLog يومي (1024 خانة = 1KB مهما كان العدد)،
+#  والأسبوع/الشهر دمج لرسومات الأيام (أقصى خانة).
+# ================================================================
+
+HLL_P    = 10
+HLL_M    = 1 << HLL_P
+HLL_BITS = 64 - HLL_P
+_HLL_ALPHA = 0.7213 / (1 + 1.079 / HLL_M)
+
+class HyperLogLog:
+    __slots__ = ("reg",)
+
+    def __init__(self, reg=None):
+        self.reg = bytearray(reg) if reg else bytearray(HLL_M)
+
+    def add(self, item):
+        h = int.from_bytes(hashlib.blake2b(str(item).encode(), digest_size=8).digest(), "big")
+        i, w = h & (HLL_M - 1), h >> HLL_P
+        r = HLL_BITS - w.bit_length() + 1
+        if r > self.reg[i]:
+            self.reg[i] = r
+
+    def merge(self, other):
+        self.reg = bytearray(map(max, self.reg, other.reg))
+        return self
+
+    def count(self):
+        reg = self.reg
+        est = _HLL_ALPHA * HLL_M * HLL_M / sum(2.0 ** -r for r in reg)
+        zeros = reg.count(0)
+        if est <= 2.5 * HLL_M and zeros:
+            est = HLL_M * math.log(HLL_M / zeros)      # عدد صغير ← عدّ خطي
+        return round(est)
+
+
+STATS_KEEP_DAYS = 31
+
+class StatsAggregator:
+    """لكل يوم: رسم HLL للمستخدمين، عدد الجدد، والتفاعلات لكل ميزة.
+    gauges: أعداد حالية (طلاب، أسئلة، مصطلحات) تُحدَّث عند الحفظ."""
+
+    def __init__(self, path):
+        self.path   = path
+        d = _load(path, {})
+        self.days   = {}
+        for k, v in d.get("days", {}).items():
+            self.days[int(k)] = {"h": HyperLogLog(base64.b64decode(v.get("h", ""))),
+                                 "n": v.get("n", 0), "f": v.get("f", {})}
+        self.gauges = {}
+        self._merged = {}    # (اليوم، عدد الأيام) ← دمج الأيام السابقة (يُحسب مرة يومياً)
+        self.dirty  = False
+
+    def _day(self):
+        today = _today()
+        day = self.days.get(today)
+        if day is None:
+            day = self.days[today] = {"h": HyperLogLog(), "n": 0, "f": {}}
+            for old in [k for k in self.days if k <= today - STATS_KEEP_DAYS]:
+                del self.days[old]
+            self._merged.clear()
+        return day
+
+    def touch(self, uid, feature=None):
+        day = self._day()
+        if uid is not None:
+            day["h"].add(uid)
+        if feature:
+            day["f"][feature] = day["f"].get(feature, 0) + 1
+        self.dirty = True
+
+    def new_user(self):
+        self._day()["n"] += 1
+        self.dirty = True
+
+    def active(self, span):
+        """المستخدمون المميّزون تقريبياً في آخر span يوم (اليوم منها)"""
+        today = self._day()
+        key   = (_today(), span)
+        past  = self._merged.get(key)
+        if past is None:
+            past = HyperLogLog()
+            for k, d in self.days.items():
+                if 0 < _today() - k < span:
+                    past.merge(d["h"])
+            self._merged[key] = past
+        return HyperLogLog(past.reg).merge(today["h"]).count()
+
+    def new_users(self, span):
+        return sum(d["n"] for k, d in self.days.items() if 0 <= _today() - k < span)
+
+    def features(self, span, n=8):
+        tot = {}
+        for k, d in self.days.items():
+            if 0 <= _today() - k < span:
+                for f, c in d["f"].items():
+                    tot[f] = tot.get(f, 0) + c
+        return heapq.nlargest(n, tot.items(), key=lambda kv: kv[1])
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def flush(self):
+        if not self.dirty: return
+        self.dirty = False
+        _save(self.path, {"days": {
+            str(k): {"h": base64.b64encode(bytes(d["h"].reg)).decode(),
+                     "n": d["n"], "f": d["f"]}
+            for k, d in self.days.items()}})
+
+
+_STATS = None
+
+def get_stats():
+    global _STATS
+    if _STATS is None:
+        _STATS = StatsAggregator(FILE_STATS)
+    return _STATS
+
+
 # ================================================================
 #  ٤. الدروس
 # ================================================================
 
 def load_lessons():
-    if os.path.exists(FILE_LESSONS):
-        d = _load(FILE_LESSONS, None)
-        if isinstance(d, dict) and d:
-            return d
+    d = _load(FILE_LESSONS, None)      # من الذاكرة أولاً: حفظ لم يُكتب بعد ليس ملفاً مفقوداً
+    if isinstance(d, dict) and d:
+        return d
     try:
         from lessons import LESSONS as _D
         d = copy.deepcopy(_D)
@@ -257,9 +651,581 @@ def load_lessons():
 def save_lessons(d):
     _save(FILE_LESSONS, d)
 
-def total_lessons(d):
-    return sum(len(v) for y in d.values() for s in y.values()
-               for sm in s.values() for v in sm.values())
+
+# ================================================================
+#  ٤-أ. الفهرس المُجمَّع
+#  الشجرة المتداخلة ← مصفوفات مسطّحة مفهرسة بمعرّفات رقمية ثابتة.
+#  الأزرار تحمل المعرّف فقط (D:n:<id>) فلا حاجة لحالة في user_data.
+# ================================================================
+
+LVL_ROOT, LVL_YEAR, LVL_SPEC, LVL_SEM, LVL_SUBJ, LVL_FILE = range(6)
+ROOT_ID = 0
+
+
+class Lesson:
+    """سجل درس مضغوط يُبنى مرة واحدة عند تجميع الفهرس.
+    subj و path نصوص مُدمجة (interned) مشتركة بين دروس المادة الواحدة."""
+
+    __slots__ = ("id", "title", "value", "cat", "subj", "path", "like_key")
+
+    def __init__(self, nid, title, value, cat, subj, path, like_key):
+        self.id       = nid
+        self.title    = title
+        self.value    = value          # file_id أو رابط
+        self.cat      = cat            # Cat
+        self.subj     = subj
+        self.path     = path           # "سنة|تخصص|سداسي|مادة"
+        self.like_key = like_key
+
+    @property
+    def label(self):
+        return CATS[self.cat]
+
+    def to_item(self):
+        return [self.title, self.value, CATS[self.cat]]
+
+
+class IdRegistry:
+    """معرّفات رقمية ثابتة لمفاتيح نصية، محفوظة في ملف.
+    المعرّف لا يُعاد استخدامه بعد الحذف، فلا يشير زر قديم إلى عنصر آخر."""
+
+    def __init__(self, path):
+        self.path = path
+        d = _load(path, {})
+        if not isinstance(d, dict): d = {}
+        self.ids   = d.get("ids", {})
+        self.next  = d.get("next", ROOT_ID + 1)
+        self.dirty = False
+
+    def get(self, key):
+        i = self.ids.get(key)
+        if i is None:
+            i = self.ids[key] = self.next
+            self.next += 1
+            self.dirty = True
+        return i
+
+    def retain(self, live):
+        """إسقاط مفاتيح العناصر المحذوفة"""
+        dead = [k for k in self.ids if k not in live]
+        for k in dead: del self.ids[k]
+        if dead: self.dirty = True
+
+    def flush(self):
+        if self.dirty:
+            _save(self.path, {"next": self.next, "ids": self.ids})
+            self.dirty = False
+
+
+# عدّادات كل عقدة: [الإجمالي، درس، ملخص، امتحان]
+N_COUNTS = 1 + len(CATS)
+
+
+def _file_key(base, value, n):
+    return f"F|{base}|{value}#{n}"
+
+def _make_lesson(nid, item, subj, base, n):
+    return Lesson(nid, item[0], item[1],
+                  CAT_BY_LABEL.get(get_cat(item), Cat.DARS),
+                  subj, base, lesson_key(base, item[1], n))
+
+
+class Catalog:
+    """نسخة مُجمَّعة من lessons_data.json.
+    كل المصفوفات مفهرسة بمعرّف العقدة؛ أبناء العقدة متجاورون في children،
+    وعدّادات الدروس لكل عقدة في counts (N_COUNTS خانة لكل عقدة)،
+    وفهرس البحث في index، ومعرّف كل درس بمفتاح إعجابه في by_like."""
+
+    __slots__ = ("version", "level", "parent", "name", "lesson",
+                 "child_start", "child_count", "children", "counts", "index",
+                 "by_like")
+
+    def __init__(self, size):
+        self.version     = 0
+        self.level       = bytearray([255]) * size     # 255 = لا توجد عقدة
+        self.parent      = array("i", [-1]) * size
+        self.child_start = array("i", [0]) * size
+        self.child_count = array("i", [0]) * size
+        self.name        = [None] * size
+        self.lesson      = [None] * size               # Lesson لعقد الملفات
+        self.children    = array("i")
+        self.counts      = array("i", [0]) * (size * N_COUNTS)
+        self.index       = SearchIndex()
+        self.by_like     = {}                          # like_key ← معرّف الدرس
+
+    @classmethod
+    def compile(cls, d, reg):
+        nodes = []          # (id, level, name, parent)
+        kids  = {ROOT_ID: []}
+        files = []          # Lesson
+        live  = set()
+
+        def node(key, lvl, name, par):
+            live.add(key)
+            nid = reg.get(key)
+            nodes.append((nid, lvl, name, par))
+            kids[par].append(nid)
+            kids[nid] = []
+            return nid
+
+        for year, specs in d.items():
+            y = node(f"Y|{year}", LVL_YEAR, year, ROOT_ID)
+            for spec, sems in specs.items():
+                s = node(f"S|{year}|{spec}", LVL_SPEC, spec, y)
+                for sem, subjs in sems.items():
+                    m = node(f"M|{year}|{spec}|{sem}", LVL_SEM, sem, s)
+                    for subj, items in subjs.items():
+                        subj = sys.intern(subj)
+                        base = sys.intern(f"{year}|{spec}|{sem}|{subj}")
+                        b    = node(f"B|{base}", LVL_SUBJ, subj, m)
+                        seen = {}
+                        for item in items:
+                            n = seen[item[1]] = seen.get(item[1], 0) + 1
+                            f = node(_file_key(base, item[1], n), LVL_FILE, item[0], b)
+                            files.append(_make_lesson(f, item, subj, base, n))
+
+        reg.retain(live)
+        reg.flush()
+
+        c = cls(reg.next)
+        c.level[ROOT_ID] = LVL_ROOT
+        for nid, lvl, name, par in nodes:
+            c.level[nid]  = lvl
+            c.name[nid]   = name
+            c.parent[nid] = par
+        for les in files:
+            c.lesson[les.id] = les
+            c._bump(les.id, les.cat, 1)
+            c.index.add(les, shared=False)
+            c.by_like[les.like_key] = les.id
+        for nid, ch in kids.items():
+            c.child_start[nid] = len(c.children)
+            c.child_count[nid] = len(ch)
+            c.children.extend(ch)
+        return c
+
+    # ── قراءة ─────────────────────────────────────────────
+
+    def has(self, nid):
+        return 0 <= nid < len(self.level) and self.level[nid] != 255
+
+    def kids(self, nid):
+        start = self.child_start[nid]
+        return self.children[start:start + self.child_count[nid]]
+
+    def path(self, nid):
+        """أسماء العقد من السنة حتى nid"""
+        out = []
+        while nid > ROOT_ID:
+            out.append(self.name[nid])
+            nid = self.parent[nid]
+        return out[::-1]
+
+    def count(self, nid, cat=None):
+        """عدد الدروس تحت العقدة (كلها أو من تصنيف واحد) — O(1)"""
+        return self.counts[nid * N_COUNTS + (0 if cat is None else 1 + cat)]
+
+    def find(self, *names):
+        """معرّف العقدة بالأسماء (سنة، تخصص، ...) أو None"""
+        nid = ROOT_ID
+        for name in names:
+            nid = next((k for k in self.kids(nid) if self.name[k] == name), None)
+            if nid is None: return None
+        return nid
+
+    # ── تعديل تدريجي (بلا إعادة تجميع) ──────────────────────
+
+    def clone(self):
+        """نسخة مستقلة للتعديل — نسخ مصفوفات فقط، سجلات الدروس مشتركة"""
+        c = Catalog.__new__(Catalog)
+        c.version     = self.version
+        c.level       = bytearray(self.level)
+        c.parent      = array("i", self.parent)
+        c.child_start = array("i", self.child_start)
+        c.child_count = array("i", self.child_count)
+        c.name        = self.name[:]
+        c.lesson      = self.lesson[:]
+        c.children    = array("i", self.children)
+        c.counts      = array("i", self.counts)
+        c.index       = self.index.clone()
+        c.by_like     = dict(self.by_like)
+        return c
+
+    def _bump(self, nid, cat, delta):
+        """تحديث عدّادات الدرس وكل أسلافه — O(العمق)"""
+        counts = self.counts
+        while nid >= ROOT_ID:
+            base = nid * N_COUNTS
+            counts[base]           += delta
+            counts[base + 1 + cat] += delta
+            if nid == ROOT_ID: break
+            nid = self.parent[nid]
+
+    def _grow(self, size):
+        extra = size - len(self.level)
+        if extra <= 0: return
+        self.level.extend(bytearray([255]) * extra)
+        self.parent.extend(array("i", [-1]) * extra)
+        self.child_start.extend(array("i", [0]) * extra)
+        self.child_count.extend(array("i", [0]) * extra)
+        self.name.extend([None] * extra)
+        self.lesson.extend([None] * extra)
+        self.counts.extend(array("i", [0]) * (extra * N_COUNTS))
+
+    def _append_child(self, par, nid):
+        start, n = self.child_start[par], self.child_count[par]
+        if start + n != len(self.children):
+            # كتلة الأب ليست في النهاية ← نقلها إلى النهاية (O(عدد الإخوة))
+            block = self.children[start:start + n]
+            start = self.child_start[par] = len(self.children)
+            self.children.extend(block)
+        self.children.append(nid)
+        self.child_count[par] = n + 1
+
+    def _ensure(self, reg, key, lvl, name, par):
+        nid = reg.get(key)
+        self._grow(reg.next)
+        if not self.has(nid):
+            self.level[nid]  = lvl
+            self.name[nid]   = name
+            self.parent[nid] = par
+            self.child_start[nid] = len(self.children)
+            self.child_count[nid] = 0
+            self._append_child(par, nid)
+        return nid
+
+    def add_lesson(self, reg, year, spec, sem, subj, item):
+        subj = sys.intern(subj)
+        base = sys.intern(f"{year}|{spec}|{sem}|{subj}")
+        y = self._ensure(reg, f"Y|{year}", LVL_YEAR, year, ROOT_ID)
+        s = self._ensure(reg, f"S|{year}|{spec}", LVL_SPEC, spec, y)
+        m = self._ensure(reg, f"M|{year}|{spec}|{sem}", LVL_SEM, sem, s)
+        b = self._ensure(reg, f"B|{base}", LVL_SUBJ, subj, m)
+        # ملف مكرر في نفس المادة ← رقم تكراره بترتيب الملف، كما في compile
+        n = 1 + sum(1 for k in self.kids(b) if self.lesson[k].value == item[1])
+        f = self._ensure(reg, _file_key(base, item[1], n), LVL_FILE, item[0], b)
+        les = self.lesson[f] = _make_lesson(f, item, subj, base, n)
+        self._bump(f, les.cat, 1)
+        self.index.add(les)
+        self.by_like[les.like_key] = f
+        return les
+
+    def remove_lesson(self, reg, subj_id, pos):
+        """حذف الدرس رقم pos من المادة (نفس ترتيب القائمة في الملف)"""
+        start, n = self.child_start[subj_id], self.child_count[subj_id]
+        f = self.children[start + pos]
+        self.children[start + pos:start + n - 1] = self.children[start + pos + 1:start + n]
+        self.child_count[subj_id] = n - 1
+        les = self.lesson[f]
+        self._drop(f)
+        self._renumber(reg, subj_id)
+        return les
+
+    def _drop(self, f):
+        les = self.lesson[f]
+        self._bump(f, les.cat, -1)
+        self.index.remove(les)
+        if self.by_like.get(les.like_key) == f:
+            del self.by_like[les.like_key]
+        self.level[f]  = 255
+        self.lesson[f] = None
+
+    def _renumber(self, reg, subj_id):
+        """أرقام تكرار الملف نفسه بعد حذف نسخة منه تنزل كما يرقّمها compile
+        ← معرّف العقدة ومفتاح الإعجاب هما ما سيعطيه التجميع الكامل"""
+        start, seen = self.child_start[subj_id], {}
+        for pos in range(self.child_count[subj_id]):
+            f   = self.children[start + pos]
+            les = self.lesson[f]
+            n   = seen[les.value] = seen.get(les.value, 0) + 1
+            nid = reg.get(_file_key(les.path, les.value, n))
+            if nid == f: continue
+            self._grow(reg.next)
+            self._drop(f)               # ترتيب تصاعدي: المعرّف الهدف حُرّر قبل الوصول إليه
+            new = self.lesson[nid] = _make_lesson(nid, les.to_item(), les.subj, les.path, n)
+            self.level[nid], self.name[nid], self.parent[nid] = LVL_FILE, les.title, subj_id
+            self.children[start + pos] = nid
+            self._bump(nid, new.cat, 1)
+            self.index.add(new)
+            self.by_like[new.like_key] = nid
+
+def migrate_like_keys(cat):
+    """نقل الإعجابات من المفاتيح الموضعية القديمة إلى المفاتيح الثابتة"""
+    likes, moved = load_likes(), 0
+    if not likes: return
+    for subj_id in range(len(cat.level)):
+        if cat.level[subj_id] != LVL_SUBJ: continue
+        for i, f in enumerate(cat.kids(subj_id)):
+            les = cat.lesson[f]
+            old = legacy_lesson_key(*les.path.split("|"), i)
+            if old in likes and les.like_key not in likes:
+                likes[les.like_key] = likes.pop(old); moved += 1
+    if moved:
+        save_likes(likes)
+        print(f"✅ ترحيل {moved} مفتاح إعجاب")
+
+
+# ── النسخة الحالية (copy-on-write) ───────────────────────
+# المعالجات تقرأ _CATALOG بلا أقفال؛ أي تعديل يبني نسخة جديدة ثم يستبدل
+# المرجع دفعة واحدة، فالتنقل الجاري يكمل على نسخته القديمة دون أخطاء.
+
+LESSONS_VERSION    = 0       # يزداد مع كل نسخة — يُبطل ذاكرة لوحات المفاتيح
+CATALOG_WATCH_SECS = int(os.environ.get("CATALOG_WATCH_SECS", "5"))
+
+_CATALOG      = None
+_CATALOG_IDS  = None
+_CATALOG_SIG  = None         # نسخة ملف الدروس في التخزين التي بُنيت منها النسخة
+_CATALOG_LOCK = asyncio.Lock()
+
+def _lessons_sig():
+    return store_version(FILE_LESSONS)
+
+def _build_catalog():
+    """تجميع كامل من الملف — يُشغَّل في خيط عند إعادة التحميل"""
+    global _CATALOG_IDS
+    if _CATALOG_IDS is None:
+        _CATALOG_IDS = IdRegistry(FILE_CAT_IDS)
+    sig = _lessons_sig()           # قبل القراءة: تعديل لاحق يُعيد التحميل مرة أخرى
+    d   = load_lessons()
+    if sig is None:                # أُنشئ الملف الآن من lessons.py
+        sig = _lessons_sig()
+    return Catalog.compile(d, _CATALOG_IDS), sig
+
+def _swap_catalog(cat, sig):
+    global _CATALOG, _CATALOG_SIG, LESSONS_VERSION
+    LESSONS_VERSION += 1
+    cat.version = LESSONS_VERSION
+    _CATALOG, _CATALOG_SIG = cat, sig
+    _KB_CACHE.clear()
+
+def get_catalog():
+    """النسخة الحالية من الفهرس — O(1) بعد أول بناء"""
+    if _CATALOG is None:
+        _swap_catalog(*_build_catalog())
+        migrate_like_keys(_CATALOG)
+    return _CATALOG
+
+async def reload_catalog():
+    async with _CATALOG_LOCK:
+        cat, sig = await asyncio.to_thread(_build_catalog)
+        _swap_catalog(cat, sig)
+
+async def catalog_watch_loop():
+    """إعادة تحميل الفهرس إذا عدّل المشرف lessons_data.json يدوياً"""
+    while True:
+        await asyncio.sleep(CATALOG_WATCH_SECS)
+        try:
+            if _lessons_sig() != _CATALOG_SIG:
+                await reload_catalog()
+                print(f"🔄 أُعيد تحميل الدروس (نسخة {LESSONS_VERSION})")
+        except Exception as e:
+            print(f"⚠️ catalog watch: {e}")
+
+async def _catalog_edit(edit_file, edit_catalog):
+    """تعديل الملف ثم نسخة جديدة من الفهرس: تدريجياً إن كانت الحالية
+    مطابقة للملف، وإلا (تعديل يدوي لم يُلتقط بعد) تجميع كامل."""
+    async with _CATALOG_LOCK:
+        cur     = get_catalog()
+        fresh   = _lessons_sig() == _CATALOG_SIG
+        lessons = load_lessons()
+        result  = edit_file(lessons)
+        save_lessons(lessons)
+        if fresh:
+            new = cur.clone()
+            edit_catalog(new)
+            _swap_catalog(new, _lessons_sig())
+        else:
+            _swap_catalog(*await asyncio.to_thread(_build_catalog))
+        return result
+
+async def catalog_add_many(entries):
+    """إضافة دفعة [(سنة، تخصص، سداسي، مادة، [عنوان، قيمة، تصنيف])] كمعاملة واحدة:
+    حفظ واحد للملف ونسخة واحدة جديدة من الفهرس"""
+    def edit_file(lessons):
+        for year, spec, sem, subj, item in entries:
+            (lessons.setdefault(year, {})
+                    .setdefault(spec, {})
+                    .setdefault(sem, {})
+                    .setdefault(subj, [])
+                    .append(item))
+    def edit_catalog(cat):
+        for entry in entries:
+            cat.add_lesson(_CATALOG_IDS, *entry)
+        _CATALOG_IDS.flush()
+    await _catalog_edit(edit_file, edit_catalog)
+
+async def catalog_add(year, spec, sem, subj, item):
+    """إضافة درس: حفظ الملف + نسخة جديدة بعدّادات محدّثة تدريجياً"""
+    await catalog_add_many([(year, spec, sem, subj, item)])
+
+def shift_duplicate_likes(base, items, idx):
+    """قبل حذف items[idx]: نسخ الملف نفسه بعده ينزل رقم تكرارها (مفتاح
+    إعجابها) — تُنقل إعجاباتها معها، سواء عُدّل الفهرس تدريجياً أو أُعيد تجميعه"""
+    value = items[idx][1]
+    n_del = sum(1 for it in items[:idx + 1] if it[1] == value)
+    total = sum(1 for it in items if it[1] == value)
+    if n_del == total: return
+    likes = load_likes()
+    for n in range(n_del, total):
+        new, old = lesson_key(base, value, n), lesson_key(base, value, n + 1)
+        if old in likes: likes[new] = likes.pop(old)
+        else:            likes.pop(new, None)
+    save_likes(likes)
+
+async def catalog_remove(year, spec, sem, subj, idx):
+    """حذف الدرس رقم idx ← العنصر المحذوف، أو KeyError/IndexError"""
+    def edit_file(lessons):
+        items = lessons[year][spec][sem][subj]
+        shift_duplicate_likes(f"{year}|{spec}|{sem}|{subj}", items, idx)
+        return items.pop(idx)
+    def edit_catalog(cat):
+        cat.remove_lesson(_CATALOG_IDS, cat.find(year, spec, sem, subj), idx)
+        _CATALOG_IDS.flush()
+    return await _catalog_edit(edit_file, edit_catalog)
+
+
+# ================================================================
+#  ٤-ب. البحث في الدروس
+#  تطبيع عربي + تجذيع خفيف ← فهرس مقلوب (كلمة ← {معرّف الدرس: وزن}).
+#  الفهرس جزء من نسخة الفهرس المُجمَّع ويُحدَّث معها تدريجياً.
+# ================================================================
+
+_AR_MARKS = re.compile(r"[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]")
+_AR_FOLD  = str.maketrans("أإآٱىةؤئ٠١٢٣٤٥٦٧٨٩", "اااايهوي0123456789")
+_WORD_RE  = re.compile(r"\w+")
+
+_AR_PREFIXES = ("وال", "بال", "كال", "فال", "لل", "ال")
+_AR_SUFFIXES = ("ها", "ان", "ات", "ون", "ين", "يه", "ه", "ي")
+_STOPWORDS   = {"في", "من", "على", "الى", "عن", "مع", "او", "ثم", "و"}
+
+# وزن الكلمة حسب موضعها: العنوان > المادة > السنة/التخصص/السداسي/التصنيف
+W_TITLE, W_SUBJ, W_PATH = 3, 2, 1
+SEARCH_PREFIX_MAX = 64      # أقصى عدد كلمات تُوسَّع إليها بادئة واحدة
+SEARCH_LIMIT      = 50      # أقصى عدد نتائج مرتّبة
+SEARCH_PAGE       = 8
+SEARCH_CACHE_MAX  = 256     # نتائج محفوظة لكل نسخة (التصفّح بين الصفحات مجاني)
+SEARCH_CACHE_STATS = {"hits": 0, "misses": 0}
+
+
+def ar_normalize(text):
+    """حذف التشكيل والتطويل وتوحيد الهمزات والتاء المربوطة والأرقام"""
+    return _AR_MARKS.sub("", text).translate(_AR_FOLD).lower()
+
+def ar_stem(w):
+    """تجذيع خفيف (على طريقة Light10): سوابق ثم لواحق، مع إبقاء جذع ≥ حرفين"""
+    if len(w) > 3 and w[0] == "و":
+        w = w[1:]
+    for p in _AR_PREFIXES:
+        if w.startswith(p) and len(w) - len(p) >= 2:
+            w = w[len(p):]
+            break
+    # حتى الاستقرار، فيلتقي "امتحان" و"امتحانات" على الجذع نفسه
+    stripped = True
+    while stripped:
+        stripped = False
+        for s in _AR_SUFFIXES:
+            if len(w) > len(s) + 1 and w.endswith(s):
+                w, stripped = w[:-len(s)], True
+                break
+    return w
+
+def ar_tokens(text):
+    return [ar_stem(w) for w in _WORD_RE.findall(ar_normalize(text))]
+
+
+class SearchIndex:
+    """فهرس مقلوب قابل للنسخ: النسخة الجديدة تشارك قوائم الكلمات مع القديمة
+    ولا تنسخ إلا قائمة الكلمة التي تتغير (copy-on-write)."""
+
+    __slots__ = ("post", "_vocab", "_cache")
+
+    def __init__(self):
+        self.post   = {}        # كلمة ← {lesson_id: وزن}
+        self._vocab = None      # الكلمات مرتّبة للبحث بالبادئة (تُبنى عند الحاجة)
+        self._cache = {}        # كلمات الاستعلام ← النتائج المرتّبة
+
+    def clone(self):
+        c = SearchIndex.__new__(SearchIndex)
+        c.post, c._vocab, c._cache = dict(self.post), self._vocab, {}
+        return c
+
+    @staticmethod
+    def _terms(les):
+        """كلمات الدرس مع أعلى وزن لكل كلمة"""
+        year, spec, sem, _ = les.path.split("|")
+        terms = {}
+        for text, w in ((les.title, W_TITLE), (les.subj, W_SUBJ),
+                        (f"{year} {spec} {sem} {les.label}", W_PATH)):
+            for t in ar_tokens(text):
+                if terms.get(t, 0) < w:
+                    terms[t] = w
+        return terms
+
+    def add(self, les, shared=True):
+        """shared=False أثناء التجميع الكامل — لا حاجة لنسخ القوائم"""
+        self._cache.clear()
+        for t, w in self._terms(les).items():
+            p = self.post.get(t)
+            if p is None:
+                p = self.post[t] = {}
+                self._vocab = None
+            elif shared:
+                p = self.post[t] = dict(p)
+            p[les.id] = w
+
+    def remove(self, les):
+        self._cache.clear()
+        for t in self._terms(les):
+            p = self.post.get(t)
+            if p is None or les.id not in p: continue
+            if len(p) == 1:
+                del self.post[t]
+                self._vocab = None
+            else:
+                p = self.post[t] = dict(p)
+                del p[les.id]
+
+    def _expand(self, t):
+        """{lesson_id: نقاط} للكلمة: تطابق تام بضعف الوزن، وبادئة بالوزن"""
+        exact = self.post.get(t)
+        hits  = {k: 2 * w for k, w in exact.items()} if exact else {}
+        if len(t) < 2:
+            return hits
+        if self._vocab is None:
+            self._vocab = sorted(self.post)
+        vocab = self._vocab
+        i = bisect.bisect_left(vocab, t)
+        for v in vocab[i:i + SEARCH_PREFIX_MAX]:
+            if not v.startswith(t): break
+            if v == t: continue
+            for k, w in self.post[v].items():
+                if hits.get(k, 0) < w:
+                    hits[k] = w
+        return hits
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        """معرّفات الدروس التي تطابق كل كلمات الاستعلام، مرتّبة بالنقاط"""
+        terms = [t for t in dict.fromkeys(ar_tokens(query)) if t]
+        terms = [t for t in terms if t not in _STOPWORDS] or terms
+        if not terms: return []
+        key = (limit, *terms)
+        found = self._cache.get(key)
+        if found is not None:
+            SEARCH_CACHE_STATS["hits"] += 1
+        else:
+            SEARCH_CACHE_STATS["misses"] += 1
+            per = sorted((self._expand(t) for t in terms), key=len)
+            scores = per[0]
+            for hits in per[1:]:
+                scores = {k: s + hits[k] for k, s in scores.items() if k in hits}
+            found = heapq.nlargest(limit, scores, key=scores.__getitem__)
+            if len(self._cache) >= SEARCH_CACHE_MAX:
+                self._cache.clear()
+            self._cache[key] = found
+        return found
+
+    def __len__(self):
+        return len(self.post)
 
 
 # ================================================================
@@ -269,10 +1235,179 @@ def total_lessons(d):
 def load_quiz():
     d = _load(FILE_QUIZ, None)
     if isinstance(d, list) and d: return d
-    _save(FILE_QUIZ, DEFAULT_QUIZ)
-    return copy.deepcopy(DEFAULT_QUIZ)
+    d = copy.deepcopy(DEFAULT_QUIZ)    # المخزن يشارك الكائن ← لا نعطيه الثابت نفسه
+    _save(FILE_QUIZ, d)
+    return d
+
+QUIZ_VERSION = 0
+QUIZ_DEFAULT_POINTS = 1      # سؤال بلا نقاط (استيراد بلا عمود points أو سؤال قديم)
+
+def save_quiz(d):
+    global QUIZ_VERSION
+    _save(FILE_QUIZ, d)
+    QUIZ_VERSION += 1
+    get_stats().gauge("quiz", len(d))
+
+
+# ── مجموعة أسئلة لكل طالب + تكرار متباعد (Leitner) ───────────
+# كل طالب له تبديلة مخلوطة من أرقام الأسئلة (array('H')) ومؤشر عليها:
+# السحب O(1) ولا يتكرر سؤال قبل المرور على البنك كله. السؤال الخاطئ
+# يدخل الصندوق 1 ويعود بعد LEITNER_GAPS[0] سؤالاً، وكل إجابة صحيحة
+# ترفعه صندوقاً حتى يخرج. أي تعديل في البنك يعيد خلط المجموعات.
+
+LEITNER_GAPS = (3, 10, 30)      # بعد كم سحبة يعود السؤال حسب صندوقه
+LEITNER_MAX  = 50               # أقصى عدد أسئلة معلّقة للمراجعة لكل طالب
+DECKS_FLUSH_SECS = 30
+
+_QUIZ_SIG = (-1, 0)             # (QUIZ_VERSION، البصمة)
+
+def quiz_sig(quiz):
+    """بصمة البنك (crc32 للأسئلة) — تُحسب مرة لكل نسخة"""
+    global _QUIZ_SIG
+    if _QUIZ_SIG[0] != QUIZ_VERSION:
+        _QUIZ_SIG = (QUIZ_VERSION, zlib.crc32("\x1f".join(q["q"] for q in quiz).encode()))
+    return _QUIZ_SIG[1]
+
+def question_key(item):
+    """مفتاح إحصاءات السؤال — نصه، فلا يتأثر بإعادة الترتيب"""
+    return format(zlib.crc32(item["q"].encode()), "08x")
+
+
+class QuizDeck:
+    __slots__ = ("sig", "perm", "cur", "draws", "due", "pending", "box", "last")
+
+    def __init__(self):
+        self.sig     = None
+        self.perm    = array("H")
+        self.cur     = 0
+        self.draws   = 0
+        self.due     = []        # [موعد السحب، السؤال، الصندوق] مرتّبة بالموعد
+        self.pending = -1        # السؤال المعروض ولم يُجب بعد
+        self.box     = 0         # صندوقه (0 = من التبديلة)
+        self.last    = -1        # آخر سؤال عُرض فعلاً (من التبديلة أو المراجعة)
+
+    def _shuffle(self):
+        """تبديلة جديدة لا تبدأ بآخر سؤال رآه الطالب"""
+        random.shuffle(self.perm)
+        if len(self.perm) > 1 and self.perm[0] == self.last:
+            self.perm[0], self.perm[-1] = self.perm[-1], self.perm[0]
+        self.cur = 0
+
+    def draw(self, n, sig):
+        if self.sig != sig or len(self.perm) != n:
+            self.sig, self.perm, self.due = sig, array("H", range(n)), []
+            self._shuffle()
+        self.draws += 1
+        if self.due and self.due[0][0] <= self.draws:
+            _, qid, box = self.due.pop(0)
+        else:
+            if self.cur >= len(self.perm):
+                self._shuffle()
+            qid, box = self.perm[self.cur], 0
+            self.cur += 1
+        self.pending, self.box = qid, box
+        self.last = qid
+        return qid
+
+    def answer(self, qid, right):
+        """True إذا كان السؤال معلّقاً (يُحتسب مرة واحدة فقط)"""
+        if qid != self.pending: return False
+        box, self.pending = self.box, -1
+        self.due = [d for d in self.due if d[1] != qid]
+        if not right:
+            box = 1
+        elif box:
+            box += 1
+        if 0 < box <= len(LEITNER_GAPS) and len(self.due) < LEITNER_MAX:
+            bisect.insort(self.due, [self.draws + LEITNER_GAPS[box - 1], qid, box])
+        return True
+
+    def to_json(self):
+        return {"s": self.sig, "p": base64.b64encode(self.perm.tobytes()).decode(),
+                "c": self.cur, "d": self.draws, "q": self.due,
+                "w": self.pending, "b": self.box, "l": self.last}
+
+    @classmethod
+    def from_json(cls, d):
+        deck = cls()
+        deck.sig, deck.cur, deck.draws = d.get("s"), d.get("c", 0), d.get("d", 0)
+        deck.perm.frombytes(base64.b64decode(d.get("p", "")))
+        deck.due, deck.pending, deck.box = d.get("q", []), d.get("w", -1), d.get("b", 0)
+        deck.last = d.get("l", -1)
+        return deck
+
+
+_DECKS       = None          # uid ← QuizDeck
+_QSTATS      = None          # question_key ← [محاولات، صحيحة]
+_DECKS_DIRTY = False
+
+def _load_decks():
+    global _DECKS, _QSTATS
+    if _DECKS is None:
+        d = _load(FILE_DECKS, {})
+        _DECKS  = {u: QuizDeck.from_json(v) for u, v in d.get("decks", {}).items()}
+        _QSTATS = d.get("stats", {})
+
+def get_deck(uid):
+    _load_decks()
+    deck = _DECKS.get(str(uid))
+    if deck is None:
+        deck = _DECKS[str(uid)] = QuizDeck()
+    return deck
+
+def record_answer(uid, qid, item, right):
+    """تحديث مجموعة الطالب وإحصاءات السؤال ← False إذا سبق احتسابه"""
+    global _DECKS_DIRTY
+    if not get_deck(uid).answer(qid, right):
+        return False
+    st = _QSTATS.setdefault(question_key(item), [0, 0])
+    st[0] += 1
+    st[1] += right
+    _DECKS_DIRTY = True
+    return True
+
+def question_stats(item):
+    """(محاولات، نسبة الصحة) أو None"""
+    _load_decks()
+    st = _QSTATS.get(question_key(item))
+    return (st[0], st[1] / st[0]) if st and st[0] else None
+
+def flush_decks():
+    global _DECKS_DIRTY
+    if not _DECKS_DIRTY: return
+    _DECKS_DIRTY = False
+    _save(FILE_DECKS, {"decks": {u: d.to_json() for u, d in _DECKS.items()},
+                       "stats": _QSTATS})
+
+def flush_state():
+    """حفظ الحالة المجمَّعة في الذاكرة (كويز، ترتيب، فتح، إحصاءات، آخر ظهور)"""
+    flush_decks()
+    flush_boards()
+    if _POPULARITY is not None:
+        _POPULARITY.flush()
+    get_stats().flush()
+    if _LAST_SEEN is not None:
+        _LAST_SEEN.flush()
+    if _POLLS is not None:
+        _POLLS.flush()
+    store_flush_deferred()
+
+async def decks_flush_loop():
+    """حفظ دوري لحالة الكويز والترتيب وعدّادات الفتح (بدل كتابة مع كل حدث)"""
+    while True:
+        await asyncio.sleep(DECKS_FLUSH_SECS)
+        try:
+            flush_state()
+        except Exception as e:
+            print(f"⚠️ decks flush: {e}")
 
-def save_quiz(d): _save(FILE_QUIZ, d)
+async def flush_all():
+    """عند الإيقاف: حفظ كل الحالة ثم انتظار انتهاء الكتابات دون حجز الحلقة"""
+    try:
+        flush_state()
+    except Exception as e:
+        print(f"⚠️ flush: {e}")
+    await asyncio.to_thread(store_drain)
 
 
 # ================================================================
@@ -284,12 +1419,114 @@ def load_users():
     try: return set(int(x) for x in d)
     except: return set()
 
-def save_users(u): _save(FILE_USERS, sorted(list(u)))
+def save_users(u):
+    _save(FILE_USERS, sorted(list(u)))
+    get_stats().gauge("users", len(u))
 
-def add_user(cid):
+def add_user(cid, new=True):
+    """new=False: عائد بعد حذفه بالتنظيف — يُعاد لقائمة الإرسال ولا يُعدّ جديداً"""
     u = load_users()
     if int(cid) not in u:
         u.add(int(cid)); save_users(u)
+        if new: get_stats().new_user()
+
+
+# ── آخر ظهور: uid ← خانة في مصفوفة uint32 (ثوانٍ) ──
+# 4 بايت لكل مستخدم بدل قاموس كائنات؛ يُحدَّث في الذاكرة ويُحفظ دورياً.
+PRUNE_DAYS = int(os.environ.get("PRUNE_DAYS", "180"))
+DAY_SECS   = 86400
+
+class LastSeen:
+    """المستخدمون بلا سجل (قبل بدء التتبّع) يُعامَلون كأنهم ظهروا عند born.
+    المحذوفون بالتنظيف يبقى سجلهم ويُعلَّمون في gone، فعودتهم ليست «مستخدماً جديداً»."""
+
+    def __init__(self, path):
+        self.path  = path
+        d = _load(path, {})
+        self.born  = int(d.get("born") or time.time())
+        self.uids  = [int(u) for u in d.get("u", [])]
+        self.ts    = array("I")
+        self.ts.frombytes(base64.b64decode(d.get("t", "")))
+        if len(self.ts) != len(self.uids):          # ملف تالف ← نبدأ من جديد
+            self.uids, self.ts = [], array("I")
+        self.slot  = {u: i for i, u in enumerate(self.uids)}
+        self.gone  = set(int(u) for u in d.get("g", []))
+        self.dirty = not d
+
+    def _add(self, uid, ts):
+        self.slot[uid] = len(self.uids)
+        self.uids.append(uid); self.ts.append(ts)
+
+    def touch(self, uid, now=None):
+        """None: أول ظهور · True: عاد بعد حذفه بالتنظيف · False: معروف"""
+        now = int(now or time.time())
+        i = self.slot.get(uid)
+        self.dirty = True
+        if i is None:
+            self._add(uid, now)
+            return None
+        self.ts[i] = now
+        if uid in self.gone:
+            self.gone.discard(uid)
+            return True
+        return False
+
+    def last(self, uid):
+        i = self.slot.get(uid)
+        return self.born if i is None else self.ts[i]
+
+    def active(self, uids, days):
+        cutoff = time.time() - days * DAY_SECS
+        return {u for u in uids if self.last(u) >= cutoff}
+
+    def retire(self, uids):
+        """حُذفوا من قائمة الإرسال: يبقى سجلهم (بتاريخ born لمن لا سجل له)"""
+        for u in uids:
+            if u not in self.slot:
+                self._add(u, self.born)
+        self.gone.update(uids)
+        self.dirty = True
+
+    def flush(self):
+        if not self.dirty: return
+        self.dirty = False
+        _save(self.path, {"born": self.born, "u": self.uids,
+                          "t": base64.b64encode(self.ts.tobytes()).decode(),
+                          "g": sorted(self.gone)})
+
+
+_LAST_SEEN = None
+
+def get_last_seen():
+    global _LAST_SEEN
+    if _LAST_SEEN is None:
+        _LAST_SEEN = LastSeen(FILE_SEEN)
+    return _LAST_SEEN
+
+def broadcast_targets(active_days=None):
+    """(كل المستخدمين، المستهدَفون) — active_days يقصر الإرسال على النشطين"""
+    users = load_users()
+    if not active_days:
+        return users, users
+    return users, get_last_seen().active(users, active_days)
+
+def prune_inactive(days=PRUNE_DAYS):
+    """حذف من غاب أكثر من days يوماً من قائمة الإرسال (يعود تلقائياً إذا تفاعل)"""
+    users, keep = broadcast_targets(days)
+    stale = users - keep
+    if stale:
+        save_users(keep)
+        get_last_seen().retire(stale)
+        print(f"🧹 حُذف {len(stale)} مستخدماً غير نشط منذ {days} يوماً")
+    return len(stale)
+
+async def prune_loop(every=DAY_SECS):
+    while True:
+        await asyncio.sleep(every)
+        try:
+            prune_inactive()
+        except Exception as e:
+            print(f"⚠️ prune: {e}")
 
 
 # ================================================================
@@ -309,6 +1546,128 @@ def get_profile_points(uid):
 def save_profile_points(uid, prof):
     p = load_points(); p[str(uid)] = prof; save_points(p)
 
+class Leaderboard:
+    """ترتيب تنازلي يبقى مرتّباً: كل تحديث بحث ثنائي O(log n)
+    (+ إزاحة في القائمة)، والترتيب والأوائل بلا فرز."""
+
+    __slots__ = ("score", "keys")
+
+    def __init__(self, scores=None):
+        self.score = {u: s for u, s in (scores or {}).items() if s > 0}
+        self.keys  = sorted((-s, u) for u, s in self.score.items())
+
+    def __len__(self):
+        return len(self.keys)
+
+    def set(self, uid, s):
+        old = self.score.get(uid)
+        if old == s: return
+        if old is not None:
+            del self.keys[bisect.bisect_left(self.keys, (-old, uid))]
+            del self.score[uid]
+        if s > 0:
+            self.score[uid] = s
+            bisect.insort(self.keys, (-s, uid))
+
+    def add(self, uid, delta):
+        self.set(uid, self.score.get(uid, 0) + delta)
+
+    def rank(self, uid):
+        """الترتيب (المتساوون يتشاركونه) أو None"""
+        s = self.score.get(uid)
+        return None if s is None else bisect.bisect_left(self.keys, (-s,)) + 1
+
+    def top(self, n):
+        return [(u, -s) for s, u in self.keys[:n]]
+
+
+# ── الترتيب حسب الفترة ──────────────────────────────────────
+# دلو لكل يوم {uid: نقاط} لآخر 30 يوماً؛ مجاميع الأسبوع والشهر تُحدَّث مع
+# كل إجابة. عند تغيّر اليوم يُطرح دلو اليوم الخارج من كل نافذة فقط،
+# فلا يُعاد المرور على كل المستخدمين.
+
+WINDOWS = {"w": 7, "m": 30}          # النافذة ← عدد الأيام
+WINDOW_NAMES = {"w": "الأسبوع", "m": "الشهر", "a": "كل الأوقات"}
+
+def _today():
+    return datetime.now(TZ).date().toordinal()
+
+
+class WindowedScores:
+    def __init__(self, path):
+        self.path  = path
+        d = _load(path, {})
+        self.days  = {int(k): v for k, v in d.get("days", {}).items()}
+        self.today = d.get("today", _today())
+        totals = {w: {} for w in WINDOWS}
+        for day, bucket in self.days.items():
+            for w, span in WINDOWS.items():
+                if 0 <= self.today - day < span:
+                    for u, p in bucket.items():
+                        totals[w][u] = totals[w].get(u, 0) + p
+        self.boards = {w: Leaderboard(totals[w]) for w in WINDOWS}
+        self.dirty  = False
+        self.roll()
+
+    def roll(self):
+        today = _today()
+        if today - self.today > max(WINDOWS.values()):
+            # توقف طويل ← كل النوافذ فارغة
+            self.days, self.today = {}, today
+            self.boards = {w: Leaderboard() for w in WINDOWS}
+            self.dirty  = True
+        while self.today < today:
+            self.today += 1
+            for w, span in WINDOWS.items():
+                for u, p in self.days.get(self.today - span, {}).items():
+                    self.boards[w].add(u, -p)
+            self.days.pop(self.today - max(WINDOWS.values()), None)
+            self.dirty = True
+
+    def add(self, uid, pts):
+        self.roll()
+        bucket = self.days.setdefault(self.today, {})
+        bucket[uid] = bucket.get(uid, 0) + pts
+        for board in self.boards.values():
+            board.add(uid, pts)
+        self.dirty = True
+
+    def board(self, w):
+        self.roll()
+        return self.boards[w]
+
+    def flush(self):
+        if not self.dirty: return
+        self.dirty = False
+        _save(self.path, {"today": self.today,
+                          "days": {str(k): v for k, v in self.days.items()}})
+
+
+_ALLTIME = None
+_WINDOWS = None
+
+def get_board(w="a"):
+    """لوحة الترتيب: "a" لكل الأوقات (من points.json)، "w" أسبوع، "m" شهر"""
+    global _ALLTIME, _WINDOWS
+    if w == "a":
+        if _ALLTIME is None:
+            _ALLTIME = Leaderboard({u: d.get("points", 0) for u, d in load_points().items()})
+        return _ALLTIME
+    if _WINDOWS is None:
+        _WINDOWS = WindowedScores(FILE_BOARDS)
+    return _WINDOWS.board(w)
+
+def add_points(uid, prof, pts):
+    """تسجيل نقاط مكتسبة في كل لوحات الترتيب"""
+    uid = str(uid)
+    get_board("a").set(uid, prof["points"])
+    get_board("w")
+    _WINDOWS.add(uid, pts)
+
+def flush_boards():
+    if _WINDOWS is not None:
+        _WINDOWS.flush()
+
 def apply_achievements(prof):
     badges, new = set(prof.get("badges", [])), []
     for thr, badge in ACHIEVEMENTS:
@@ -386,7 +1745,7 @@ def delete_note(uid, idx):
 # ================================================================
 
 def load_likes(): return _load(FILE_LIKES, {})
-def save_likes(l): _save(FILE_LIKES, l)
+def save_likes(l): _save(FILE_LIKES, l, defer=shedding(1))
 
 def toggle_like(key, uid, title="", subj=""):
     l = load_likes()
@@ -410,20 +1769,380 @@ def user_liked(key, uid):
     return str(uid) in load_likes().get(key, {}).get("users", [])
 
 
+# ================================================================
+#  ١١-أ. الأكثر فائدة
+#  أوائل محدودة (TopK) لكل نطاق: الكل، كل سداسي، كل مادة — ولكل مقياس:
+#  الإعجاب (l) والفتح/التحميل (o). كل حدث يحدّث ثلاث قوائم صغيرة فقط،
+#  والعرض يقرأ القائمة مباشرة دون المرور على الدروس.
+# ================================================================
+
+TOPK_SHOW = 10
+TOPK_KEEP = 2 * TOPK_SHOW      # هامش حتى لا يُفقد الترتيب عند إلغاء إعجاب
+METRICS   = {"l": "❤️ إعجاباً", "o": "📥 تحميلاً"}
+
+
+class TopK:
+    """أعلى cap عنصراً بقيمها — التحديث O(cap) لقائمة صغيرة ثابتة الحجم"""
+
+    __slots__ = ("cap", "items")
+
+    def __init__(self, cap=TOPK_KEEP):
+        self.cap   = cap
+        self.items = {}
+
+    def update(self, key, score):
+        items = self.items
+        if key in items or len(items) < self.cap:
+            if score > 0: items[key] = score
+            else:         items.pop(key, None)
+            return
+        low = min(items, key=items.get)
+        if score > items[low]:
+            del items[low]
+            items[key] = score
+
+    def top(self, n):
+        return heapq.nlargest(n, self.items.items(), key=lambda kv: kv[1])
+
+
+def lesson_scopes(les):
+    """النطاقات التي يُحسب فيها الدرس: الكل، السداسي، المادة"""
+    return ("", "M|" + les.path.rsplit("|", 1)[0], "B|" + les.path)
+
+def node_scope(cat, nid):
+    if nid == ROOT_ID: return ""
+    if cat.level[nid] == LVL_SEM:  return "M|" + "|".join(cat.path(nid))
+    if cat.level[nid] == LVL_SUBJ: return "B|" + "|".join(cat.path(nid))
+    return None
+
+
+class Popularity:
+    def __init__(self, cat):
+        self.opens = _load(FILE_OPENS, {})
+        self.tops  = {}
+        self.dirty = False
+        likes = load_likes()
+        for les in cat.lesson:
+            if les is None: continue
+            self.bump("l", les, likes.get(les.like_key, {}).get("count", 0))
+            self.bump("o", les, self.opens.get(les.like_key, 0))
+
+    def bump(self, metric, les, value):
+        for scope in lesson_scopes(les):
+            top = self.tops.get((metric, scope))
+            if top is None:
+                if value <= 0: continue
+                top = self.tops[(metric, scope)] = TopK()
+            top.update(les.like_key, value)
+
+    def opened(self, les, n=1):
+        k = les.like_key
+        self.opens[k] = self.opens.get(k, 0) + n
+        self.bump("o", les, self.opens[k])
+        self.dirty = True
+
+    def top(self, metric, scope, n=TOPK_SHOW):
+        t = self.tops.get((metric, scope))
+        return t.top(n) if t else []
+
+    def flush(self):
+        if not self.dirty: return
+        self.dirty = False
+        _save(FILE_OPENS, self.opens)
+
+
+_POPULARITY = None
+
+def get_popularity():
+    global _POPULARITY
+    if _POPULARITY is None:
+        _POPULARITY = Popularity(get_catalog())
+    return _POPULARITY
+
+def record_open(*lessons):
+    pop = get_popularity()
+    for les in lessons:
+        pop.opened(les)
+
+def record_like(cat, key, count):
+    nid = cat.by_like.get(key)
+    if nid is not None:
+        get_popularity().bump("l", cat.lesson[nid], count)
+
+def popular_lessons(cat, metric, scope, n=TOPK_SHOW):
+    """[(Lesson, قيمة)] — الدروس المحذوفة تُتخطّى"""
+    out = []
+    for key, v in get_popularity().top(metric, scope, TOPK_KEEP):
+        nid = cat.by_like.get(key)
+        if nid is not None:
+            out.append((cat.lesson[nid], v))
+            if len(out) >= n: break
+    return out
+
+
 # ================================================================
 #  ١٢. استطلاع الرأي
 # ================================================================
 
 def load_poll(): return _load(FILE_POLL, {"active": False})
-def save_poll(p): _save(FILE_POLL, p)
+def save_poll(p): _save(FILE_POLL, p, defer=shedding(1))
+
+# عدة استطلاعات معاً: {"polls": {pid: {active, question, options, votes}}, "next": n}
+# الصيغة القديمة (استطلاع واحد) تصبح الاستطلاع "0" — وهو ما تشير إليه
+# أزرار POLL:v:<i> القديمة. الأصوات تُعدّ في الذاكرة وتُحفظ دورياً،
+# ورسائل النتائج الحيّة تُحدَّث كل POLL_REFRESH ثانية إن تغيّر شيء.
+POLL_REFRESH  = 10
+POLL_LIVE_MAX = 5               # رسائل نتائج حيّة لكل استطلاع
+
+class Polls:
+    def __init__(self):
+        d = load_poll()
+        if "polls" not in d:
+            d = {"polls": {"0": d} if d.get("question") else {}, "next": 1}
+        self.polls  = d["polls"]
+        self.next   = d.get("next", len(self.polls))
+        self.counts = {pid: self._count(p) for pid, p in self.polls.items()}
+        self.ver    = dict.fromkeys(self.polls, 0)
+        self.live   = {}        # pid ← {(chat, message): النسخة المعروضة}
+        self.dirty  = False
+
+    @staticmethod
+    def _count(p):
+        c = [0] * len(p.get("options", []))
+        for v in p.get("votes", {}).values():
+            if 0 <= v < len(c): c[v] += 1
+        return c
+
+    def get(self, pid):
+        return self.polls.get(pid)
+
+    def latest(self, active=False):
+        pids = [p for p, v in self.polls.items() if v.get("active") or not active]
+        return max(pids, key=int, default=None)
+
+    def active(self):
+        return sorted((p for p, v in self.polls.items() if v.get("active")), key=int)
+
+    def create(self, question, options):
+        pid = str(self.next)
+        self.next += 1
+        self.polls[pid]  = {"active": True, "question": question,
+                            "options": options, "votes": {}}
+        self.counts[pid] = [0] * len(options)
+        self.ver[pid]    = 0
+        self.save()
+        return pid
+
+    def vote(self, pid, uid, choice):
+        p, uid = self.polls[pid], str(uid)
+        old = p["votes"].get(uid)
+        if old == choice: return
+        if old is not None: self.counts[pid][old] -= 1
+        p["votes"][uid] = choice
+        self.counts[pid][choice] += 1
+        self.ver[pid] += 1
+        self.dirty = True
+
+    def end(self, pid):
+        self.polls[pid]["active"] = False
+        self.ver[pid] += 1
+        self.save()
+
+    def watch(self, pid, chat_id, message_id):
+        live = self.live.setdefault(pid, {})
+        live[(chat_id, message_id)] = self.ver[pid]
+        while len(live) > POLL_LIVE_MAX:
+            del live[next(iter(live))]
+
+    def save(self):
+        self.dirty = False
+        save_poll({"polls": self.polls, "next": self.next})
+
+    def flush(self):
+        if self.dirty: self.save()
+
+
+_POLLS = None
+
+def get_polls():
+    global _POLLS
+    if _POLLS is None:
+        _POLLS = Polls()
+    return _POLLS
+
+def poll_results_text(pid):
+    polls = get_polls()
+    p, counts = polls.get(pid), polls.counts[pid]
+    total = sum(counts)
+    state = "🟢 مفتوح" if p.get("active") else "🔒 مغلق"
+    lines = [f"📊 *نتائج الاستطلاع #{pid}* — {state}\n\n*{p['question']}*\n\nالمشاركون: {total}\n"]
+    for i, opt in enumerate(p["options"]):
+        pct = round(counts[i] / total * 100) if total else 0
+        bar = "█" * (pct // 10) + "░" * (10 - pct // 10)
+        lines.append(f"{i+1}. {opt}\n   {bar} {counts[i]} ({pct}%)\n")
+    return "\n".join(lines)
+
+async def _poll_refresh_pass(app):
+    polls = get_polls()
+    for pid, live in list(polls.live.items()):
+        poll = polls.get(pid)
+        if not poll:
+            del polls.live[pid]; continue    # حُذف الاستطلاع
+        ver = polls.ver.get(pid, 0)
+        for (chat_id, mid), shown in list(live.items()):
+            if shown == ver: continue
+            live[(chat_id, mid)] = ver
+            try:
+                await app.bot.edit_message_text(poll_results_text(pid), chat_id=chat_id,
+                                                message_id=mid, parse_mode="Markdown")
+            except BadRequest as e:
+                if "not modified" not in str(e):
+                    print(f"⚠️ poll refresh: {e}")
+                    del live[(chat_id, mid)]
+            except Exception as e:
+                print(f"⚠️ poll refresh: {e}")
+        if not poll.get("active"):
+            del polls.live[pid]             # عُرضت النتيجة النهائية
+
+async def poll_refresh_loop(app):
+    """تحديث رسائل النتائج الحيّة: تعديل واحد لكل رسالة كل POLL_REFRESH ثانية على الأكثر"""
+    while True:
+        await asyncio.sleep(POLL_REFRESH)
+        try:
+            await _poll_refresh_pass(app)
+        except Exception as e:
+            print(f"⚠️ poll refresh: {e}")
 
 
 # ================================================================
 #  ١٣. قاموس المصطلحات
 # ================================================================
 
+TERMS_VERSION = 0           # يزداد مع كل حفظ — يُبطل فهرس المصطلحات
+
 def load_terms(): return _load(FILE_TERMS, {})
-def save_terms(t): _save(FILE_TERMS, t)
+
+def save_terms(t):
+    global TERMS_VERSION
+    _save(FILE_TERMS, t)
+    TERMS_VERSION += 1
+    get_stats().gauge("terms", len(t))
+
+
+def edit_distance(a, b, maxd):
+    """مسافة Levenshtein مع توقف مبكر: maxd+1 إذا تجاوزت maxd"""
+    if abs(len(a) - len(b)) > maxd: return maxd + 1
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb)))
+        if min(cur) > maxd: return maxd + 1
+        prev = cur
+    return prev[-1]
+
+
+class TermIndex:
+    """القاموس مُجمَّعاً: ترتيب أبجدي بمعرّفات ثابتة + شجرة بادئات (trie).
+    البحث بالبادئة يمشي في الشجرة، والاحتياط الإملائي يمشي فيها أيضاً حاملاً
+    صف Levenshtein ويقطع كل فرع تتجاوز مسافته الحد.
+    المصطلح المعرَّف بـ"ال" يُفهرس بالصيغتين فيطابق "زكاة" مصطلح "الزكاة"."""
+
+    __slots__ = ("version", "terms", "defs", "ids", "by_id", "order", "rank", "trie")
+
+    def __init__(self, terms, version, reg):
+        self.version = version
+        self.terms   = list(terms)
+        self.defs    = list(terms.values())
+        self.ids     = [reg.get(t) for t in self.terms]
+        reg.retain(terms)
+        reg.flush()
+        self.by_id   = {tid: n for n, tid in enumerate(self.ids)}
+        keys = sorted((ar_normalize(t), n) for n, t in enumerate(self.terms))
+        self.order = [n for _, n in keys]                 # الترتيب الأبجدي
+        self.rank  = array("i", [0]) * len(keys)          # موضع المصطلح فيه
+        for r, n in enumerate(self.order):
+            self.rank[n] = r
+        keys += [(k[2:], n) for k, n in keys if k.startswith("ال") and len(k) > 3]
+        self.trie = {}          # حرف ← عقدة؛ "" ← أرقام المصطلحات المنتهية هنا
+        for k, n in sorted(keys):
+            node = self.trie
+            for ch in k:
+                node = node.setdefault(ch, {})
+            node.setdefault("", []).append(n)
+
+    def __len__(self):
+        return len(self.terms)
+
+    def page(self, p, size):
+        return self.order[p * size:(p + 1) * size]
+
+    @staticmethod
+    def _collect(node, out, limit):
+        """المصطلحات تحت العقدة بالترتيب الأبجدي حتى limit"""
+        stack = [node]
+        while stack and len(out) < limit:
+            node = stack.pop()
+            for n in node.get("", ()):
+                out.setdefault(n, None)
+            stack.extend(reversed([c for ch, c in node.items() if ch]))
+
+    def _near(self, q, maxd):
+        """عُقد الشجرة التي تبعد بادئتها عن q بـ maxd تعديلات على الأكثر"""
+        found = []
+        stack = [(self.trie, list(range(len(q) + 1)))]
+        while stack:
+            node, prev = stack.pop()
+            for ch, child in node.items():
+                if not ch: continue
+                cur = [prev[0] + 1]
+                for j, qc in enumerate(q, 1):
+                    cur.append(min(cur[j - 1] + 1, prev[j] + 1, prev[j - 1] + (qc != ch)))
+                if cur[-1] <= maxd:
+                    found.append((cur[-1], len(found), child))
+                if min(cur) <= maxd:
+                    stack.append((child, cur))
+        found.sort()
+        return [node for _, _, node in found]
+
+    def lookup(self, query, limit=10):
+        """أرقام المصطلحات: المطابقة بالبادئة أولاً، ثم الأقرب إملائياً"""
+        q = ar_normalize(" ".join(query.split()))
+        if not q: return []
+        out  = {}
+        node = self.trie
+        for ch in q:
+            node = node.get(ch)
+            if node is None: break
+        else:
+            self._collect(node, out, limit)
+        if len(out) < limit and len(q) >= 3:
+            for node in self._near(q, 1 if len(q) <= 5 else 2):
+                self._collect(node, out, limit)
+                if len(out) >= limit: break
+        return list(out)[:limit]
+
+    def exact(self, query):
+        """رقم المصطلح المطابق تماماً (بعد التطبيع) أو None"""
+        node = self.trie
+        for ch in ar_normalize(" ".join(query.split())):
+            node = node.get(ch)
+            if node is None: return None
+        hits = node.get("")
+        return hits[0] if hits else None
+
+
+_TERM_INDEX = None
+_TERM_IDS   = None
+
+def get_term_index():
+    """يُعاد البناء عند تغيّر القاموس فقط — التصفّح نفسه بلا بناء قوائم"""
+    global _TERM_INDEX, _TERM_IDS
+    if _TERM_INDEX is None or _TERM_INDEX.version != TERMS_VERSION:
+        if _TERM_IDS is None:
+            _TERM_IDS = IdRegistry(FILE_TERM_IDS)
+        _TERM_INDEX = TermIndex(load_terms(), TERMS_VERSION, _TERM_IDS)
+    return _TERM_INDEX
 
 
 # ================================================================
@@ -438,16 +2157,31 @@ def save_map(m): _save(FILE_MAP, m)
 #  ١٥. البث للجميع
 # ================================================================
 
-async def send_to_all(bot, text, parse_mode=None, reply_markup=None):
-    users, dead = load_users(), set()
-    for uid in list(users):
+# عدّادات البث: الإنتاجية = sent / seconds
+BROADCAST_STATS = {"runs": 0, "sent": 0, "failed": 0, "blocked": 0, "seconds": 0.0}
+
+def count_broadcast(ok, bad, dead, t0):
+    st = BROADCAST_STATS
+    st["runs"]    += 1
+    st["sent"]    += ok
+    st["failed"]  += bad
+    st["blocked"] += dead
+    st["seconds"] += time.perf_counter() - t0
+
+async def send_to_all(bot, text, parse_mode=None, reply_markup=None, active_days=None):
+    users, targets = broadcast_targets(active_days)
+    dead, ok, t0 = set(), 0, time.perf_counter()
+    for uid in list(targets):
+        await broadcast_pause()
         try:
             await bot.send_message(uid, text, parse_mode=parse_mode,
                                    reply_markup=reply_markup)
+            ok += 1
         except Forbidden:
             dead.add(uid)
         except Exception:
             pass
+    count_broadcast(ok, len(targets) - ok, len(dead), t0)
     if dead: save_users(users - dead)
 
 
@@ -533,17 +2267,57 @@ async def scheduler_loop(app: Application):
 
 
 async def on_startup(app: Application):
+    get_catalog()
+    st = get_stats()                     # بعدها تُحدَّث من مسارات الحفظ فقط
+    st.gauge("users", len(load_users()))
+    st.gauge("quiz",  len(load_quiz()))
+    st.gauge("terms", len(load_terms()))
     app.create_task(scheduler_loop(app))
+    app.create_task(catalog_watch_loop())
+    app.create_task(decks_flush_loop())
+    app.create_task(prune_loop())
+    app.create_task(LOAD.run())
+    app.create_task(poll_refresh_loop(app))
     print("✅ البوت يعمل")
 
+async def on_shutdown(app: Application):
+    await flush_all()
+    print("💾 حُفظت البيانات")
+
 
 # ================================================================
 #  ١٨. لوحات المفاتيح
 # ================================================================
 
+# InlineKeyboardMarkup كائن مجمَّد في PTB فيمكن مشاركته بين المستخدمين.
+# المفتاح: (اسم الدالة، نسخة الفهرس الممرَّر، الوسائط النصية والرقمية)،
+# فمن يتنقّل على نسخة قديمة يحصل على لوحات تلك النسخة.
+_KB_CACHE      = {}
+KB_CACHE_MAX   = 2048
+KB_CACHE_STATS = {"hits": 0, "misses": 0}
+
+def kb_cached(fn):
+    name = fn.__name__
+    @functools.wraps(fn)
+    def wrapper(*args):
+        key = (name,
+               *(a.version if isinstance(a, Catalog) else a for a in args))
+        kb = _KB_CACHE.get(key)
+        if kb is not None:
+            KB_CACHE_STATS["hits"] += 1
+            return kb
+        KB_CACHE_STATS["misses"] += 1
+        if len(_KB_CACHE) >= KB_CACHE_MAX:
+            _KB_CACHE.clear()
+        kb = _KB_CACHE[key] = fn(*args)
+        return kb
+    return wrapper
+
+@kb_cached
 def kb_main():
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton("📚 الدروس",            callback_data="D:years")],
+        [InlineKeyboardButton("📚 الدروس",            callback_data="D:years"),
+         InlineKeyboardButton("🔎 بحث",               callback_data="SR:start")],
         [InlineKeyboardButton("📝 اختبار قصير",       callback_data="Q:start"),
          InlineKeyboardButton("🏆 نقاطي",             callback_data="P:show")],
         [InlineKeyboardButton("🗓️ التقويم",            callback_data="C:home"),
@@ -556,79 +2330,137 @@ def kb_main():
          InlineKeyboardButton("👤 ملفي",               callback_data="PROF:show")],
         [InlineKeyboardButton("💬 اقتراح درس",          callback_data="SUG:start"),
          InlineKeyboardButton("❓ مساعدة",             callback_data="H:show")],
-        [InlineKeyboardButton("🤖 المساعد الذكي",       callback_data="AI:show")],
+        [InlineKeyboardButton("🤖 المساعد الذكي",       callback_data="AI:show"),
+         InlineKeyboardButton("🔥 الأكثر فائدة",        callback_data="TOP:l:0")],
         [InlineKeyboardButton("🔄 تحديث",              callback_data="REFRESH")],
     ])
 
-def kb_years(lessons):
-    if not lessons:
-        return InlineKeyboardMarkup([
-            [InlineKeyboardButton("⚠️ لا توجد دروس — تحقق من lessons.py", callback_data="home")],
-            [InlineKeyboardButton("🏠 الرئيسية", callback_data="home")],
-        ])
-    rows = [[InlineKeyboardButton(y, callback_data=f"D:y:{i}")]
-            for i, y in enumerate(lessons)]
-    rows.append([InlineKeyboardButton("🏠 الرئيسية", callback_data="home")])
-    return InlineKeyboardMarkup(rows)
+def _count_label(cat, k):
+    n = cat.count(k)
+    return f"{cat.name[k]}  ·  {n} 📄" if n else cat.name[k]
 
-def kb_specs(lessons, year):
-    rows = [[InlineKeyboardButton(s, callback_data=f"D:s:{i}")]
-            for i, s in enumerate(lessons[year])]
-    rows += [[InlineKeyboardButton("⬅️ رجوع", callback_data="D:years")],
+def _kb_nodes(cat, nid, back, extra=()):
+    rows = [[InlineKeyboardButton(_count_label(cat, k), callback_data=f"D:n:{k}")]
+            for k in cat.kids(nid)]
+    rows += [[b] for b in extra]
+    rows += [[InlineKeyboardButton("⬅️ رجوع", callback_data=back)],
              [InlineKeyboardButton("🏠 الرئيسية", callback_data="home")]]
     return InlineKeyboardMarkup(rows)
 
-def kb_sems(lessons, year, spec):
-    rows = [[InlineKeyboardButton(sm, callback_data=f"D:sm:{i}")]
-            for i, sm in enumerate(lessons[year][spec])]
-    rows += [[InlineKeyboardButton("⬅️ رجوع", callback_data="D:specs")],
-             [InlineKeyboardButton("🏠 الرئيسية", callback_data="home")]]
-    return InlineKeyboardMarkup(rows)
+def d_back(cat, nid):
+    """زر الرجوع من عقدة إلى أبيها"""
+    par = cat.parent[nid]
+    return "D:years" if par <= ROOT_ID else f"D:n:{par}"
 
-def kb_subjects(lessons, year, spec, sem):
-    subs = lessons[year][spec][sem]
-    rows = []
-    for i, (name, items) in enumerate(subs.items()):
-        label = f"{name}  ·  {len(items)} 📄" if items else name
-        rows.append([InlineKeyboardButton(label, callback_data=f"D:sb:{i}")])
-    rows += [[InlineKeyboardButton("⬅️ رجوع", callback_data="D:sems")],
-             [InlineKeyboardButton("🏠 الرئيسية", callback_data="home")]]
+@kb_cached
+def kb_years(cat):
+    if not cat.child_count[ROOT_ID]:
+        return InlineKeyboardMarkup([
+            [InlineKeyboardButton("⚠️ لا توجد دروس — تحقق من lessons.py", callback_data="home")],
+            [InlineKeyboardButton("🏠 الرئيسية", callback_data="home")],
+        ])
+    rows = [[InlineKeyboardButton(_count_label(cat, y), callback_data=f"D:n:{y}")]
+            for y in cat.kids(ROOT_ID)]
+    rows.append([InlineKeyboardButton("🏠 الرئيسية", callback_data="home")])
     return InlineKeyboardMarkup(rows)
 
-def kb_files(items, year, spec, sem, subj, cat_filter="all"):
+@kb_cached
+def kb_specs(cat, year_id):
+    return _kb_nodes(cat, year_id, "D:years")
+
+@kb_cached
+def kb_sems(cat, spec_id):
+    return _kb_nodes(cat, spec_id, d_back(cat, spec_id))
+
+@kb_cached
+def kb_subjects(cat, sem_id):
+    return _kb_nodes(cat, sem_id, d_back(cat, sem_id), [
+        InlineKeyboardButton("🔥 الأكثر فائدة في السداسي", callback_data=f"TOP:l:{sem_id}")])
+
+# تصفية الملفات: (الرمز في الزر، الاسم، التصنيف أو None للكل)
+CAT_FILTERS = [("all", "الكل", None), ("d", "📖 دروس", Cat.DARS),
+               ("m", "📋 ملخص", Cat.MULAKH), ("x", "📝 امتحان", Cat.IMTIHAN)]
+
+def subject_lessons(cat, subj_id, cat_filter="all"):
+    """دروس المادة بترتيبها بعد تطبيق التصفية"""
+    want = next((w for k, _, w in CAT_FILTERS if k == cat_filter), None)
+    for f in cat.kids(subj_id):
+        les = cat.lesson[f]
+        if want is None or les.cat == want:
+            yield les
+
+@kb_cached
+def kb_files(cat, subj_id, cat_filter="all"):
     rows = []
-    for i, item in enumerate(items):
-        cat = get_cat(item)
-        if cat_filter != "all" and cat != cat_filter:
-            continue
-        icon = cat_icon(cat)
-        if is_url(item[1]):
-            rows.append([InlineKeyboardButton(f"{icon} {item[0]}", url=item[1])])
+    for les in subject_lessons(cat, subj_id, cat_filter):
+        f    = les.id
+        text = f"{cat_icon(les.label)} {les.title}"
+        if is_url(les.value):
+            rows.append([InlineKeyboardButton(text, url=les.value)])
         else:
-            rows.append([InlineKeyboardButton(f"{icon} {item[0]}", callback_data=f"D:f:{i}")])
+            rows.append([InlineKeyboardButton(text, callback_data=f"D:n:{f}")])
+    shown = len(rows)
     # أزرار التصفية
-    filter_row = [
-        InlineKeyboardButton("📄 الكل" if cat_filter == "all" else "الكل", callback_data="D:cat:all"),
-        InlineKeyboardButton("📖 دروس",  callback_data="D:cat:درس"),
-        InlineKeyboardButton("📋 ملخص",  callback_data="D:cat:ملخص"),
-        InlineKeyboardButton("📝 امتحان", callback_data="D:cat:امتحان"),
-    ]
+    filter_row = []
+    for k, label, c in CAT_FILTERS:
+        n = cat.count(subj_id, c)
+        if c is not None and not n:
+            continue            # لا نعرض تصنيفاً فارغاً
+        text = f"{label} ({n})"
+        filter_row.append(InlineKeyboardButton(
+            f"• {text} •" if k == cat_filter else text,
+            callback_data=f"D:cat:{subj_id}:{k}"))
     rows.append(filter_row)
-    rows += [[InlineKeyboardButton("⬅️ رجوع", callback_data="D:subjects")],
+    if shown > 1:
+        rows.append([InlineKeyboardButton(
+            f"📥 تحميل الكل ({shown})",
+            callback_data=f"D:all:{subj_id}:{cat_filter}")])
+        rows.append([InlineKeyboardButton("🔥 الأكثر فائدة", callback_data=f"TOP:l:{subj_id}")])
+    rows += [[InlineKeyboardButton("⬅️ رجوع", callback_data=d_back(cat, subj_id))],
              [InlineKeyboardButton("🏠 الرئيسية", callback_data="home")]]
     return InlineKeyboardMarkup(rows)
 
+@kb_cached
 def kb_back(target):
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("⬅️ رجوع",     callback_data=target)],
         [InlineKeyboardButton("🏠 الرئيسية", callback_data="home")],
     ])
 
-def kb_like(key, count, liked):
+_LIKE_TEXT = re.compile(r"^(?:❤️|🤍) (.*) \(\d+\)$", re.S)
+
+def like_button(key, count, liked, label="أعجبني"):
     icon = "❤️" if liked else "🤍"
-    return InlineKeyboardMarkup([[
-        InlineKeyboardButton(f"{icon} أعجبني ({count})", callback_data=f"LIKE:{key}")
-    ]])
+    return InlineKeyboardButton(f"{icon} {label} ({count})", callback_data=f"LIKE:{key}")
+
+def kb_like(key, count, liked):
+    return InlineKeyboardMarkup([[like_button(key, count, liked)]])
+
+LIKE_ROWS_MAX = 100          # حد تيليغرام لأزرار اللوحة الواحدة
+
+def kb_like_many(lessons, uid):
+    """زر إعجاب لكل درس — بعد «تحميل الكل»"""
+    likes = load_likes()
+    rows  = []
+    for les in lessons[:LIKE_ROWS_MAX]:
+        entry = likes.get(les.like_key, {})
+        rows.append([like_button(les.like_key, entry.get("count", 0),
+                                 str(uid) in entry.get("users", []), les.title[:40])])
+    return InlineKeyboardMarkup(rows)
+
+def kb_like_replace(markup, key, count, liked):
+    """نفس اللوحة مع استبدال زر الدرس المضغوط فقط (العنوان يبقى كما هو)"""
+    data = f"LIKE:{key}"
+    rows = []
+    for row in markup.inline_keyboard:
+        out = []
+        for b in row:
+            if b.callback_data == data:
+                m = _LIKE_TEXT.match(b.text)
+                b = like_button(key, count, liked, m.group(1) if m else "أعجبني")
+            out.append(b)
+        rows.append(out)
+    return InlineKeyboardMarkup(rows)
 
 def kb_dhikr(s, h, a):
     done_s = "✅" if s >= 33 else ""
@@ -643,10 +2475,11 @@ def kb_dhikr(s, h, a):
     ])
 
 def kb_poll_vote(options, poll_id="0"):
-    rows = [[InlineKeyboardButton(f"  {opt}", callback_data=f"POLL:v:{i}")]
+    rows = [[InlineKeyboardButton(f"  {opt}", callback_data=f"POLL:v:{poll_id}:{i}")]
             for i, opt in enumerate(options)]
     return InlineKeyboardMarkup(rows)
 
+@kb_cached
 def kb_wilayas():
     rows = []
     items = list(WILAYAS.items())
@@ -658,6 +2491,26 @@ def kb_wilayas():
     rows.append([InlineKeyboardButton("🏠 الرئيسية", callback_data="home")])
     return InlineKeyboardMarkup(rows)
 
+def kb_notes(notes):
+    rows = []
+    for i, note in enumerate(notes):
+        label = note["text"][:30] + ("..." if len(note["text"]) > 30 else "")
+        rows.append([
+            InlineKeyboardButton(f"📄 {label}", callback_data=f"NOTE:view:{i}"),
+            InlineKeyboardButton("🗑️", callback_data=f"NOTE:del:{i}"),
+        ])
+    rows += [[InlineKeyboardButton("➕ إضافة ملاحظة", callback_data="NOTE:add")],
+             [InlineKeyboardButton("🏠 الرئيسية",      callback_data="home")]]
+    return InlineKeyboardMarkup(rows)
+
+def kb_profile():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("✏️ تعديل الاسم", callback_data="PROF:name")],
+        [InlineKeyboardButton("🎓 التخصص",      callback_data="PROF:spec")],
+        [InlineKeyboardButton("📅 السنة",        callback_data="PROF:year")],
+        [InlineKeyboardButton("🏠 الرئيسية",     callback_data="home")],
+    ])
+
 
 # ================================================================
 #  ١٩. النصوص الثابتة
@@ -675,6 +2528,8 @@ TXT_WELCOME = (
 TXT_HELP = (
     "❓ *دليل الاستخدام*\n\n"
     "📚 *الدروس* — تصفّح حسب السنة والمادة\n"
+    "🔎 *بحث* — اكتب اسم درس أو مادة، أو `/search كلمات`\n"
+    "📤 *المشاركة* — في أي محادثة اكتب معرّف البوت ثم كلمة لإرسال درس أو مصطلح\n"
     "📝 *الاختبار* — أسئلة عشوائية مع نقاط\n"
     "🏆 *نقاطي* — نقاطك وإنجازاتك وترتيبك\n"
     "🗓️ *التقويم* — امتحانات وعطل وآجال\n"
@@ -708,19 +2563,23 @@ TXT_ADMIN = (
     "`/adddars سنة | تخصص | سداسي | مادة | عنوان | https://... | امتحان`\n\n"
     "_التصنيفات: درس / ملخص / امتحان_\n\n"
     "📋 `/listdars سنة | تخصص | سداسي | مادة`\n"
-    "🗑️ `/deldars سنة | تخصص | سداسي | مادة | رقم`\n\n"
+    "🗑️ `/deldars سنة | تخصص | سداسي | مادة | رقم`\n"
+    "📥 `/importdars` — Reply على بيان CSV/JSON، أو دفعة ملفات\n\n"
     "━━━ 📝 الكويز ━━━\n"
     "➕ `/addquiz سؤال | خ1 | خ2 | خ3 | خ4 | رقم | نقاط`\n"
-    "📋 `/listquiz`   🗑️ `/delquiz رقم`\n\n"
+    "📋 `/listquiz [صفحة]`   🗑️ `/delquiz رقم`\n"
+    "📥 `/importquiz` (Reply على CSV/JSON)   📤 `/exportquiz`\n\n"
     "━━━ 🗳️ الاستطلاع ━━━\n"
     "➕ `/poll السؤال | خيار1 | خيار2 | خيار3`\n"
-    "📊 `/pollresults`   🔒 `/endpoll`\n\n"
+    "📊 `/pollresults [رقم]` (تتحدّث تلقائياً)   🔒 `/endpoll [رقم]`\n\n"
     "━━━ 📚 القاموس ━━━\n"
     "➕ `/addterm مصطلح | تعريف`\n"
-    "🗑️ `/delterm مصطلح`   📋 `/listterms`\n\n"
+    "🗑️ `/delterm مصطلح`   📋 `/listterms [صفحة]`\n"
+    "📥 `/importterms` (Reply على CSV/JSON)   📤 `/exportterms`\n\n"
     "━━━ 📢 عام ━━━\n"
-    "📊 `/stats`   🏓 `/ping`\n"
-    "📢 `/broadcast النص` أو Reply + `/broadcast`\n"
+    "📊 `/stats`   ⏱️ `/routestats`   🏓 `/ping`\n"
+    "📢 `/broadcast النص` أو Reply + `/broadcast`"
+    " (`@7` بعده = النشطون في آخر 7 أيام)\n"
     "🗓️ `/setcal القسم | النص`\n"
     "📎 أرسل PDF في الخاص للحصول على file\\_id"
 )
@@ -744,37 +2603,114 @@ async def cmd_ping(update: Update, context: ContextTypes.DEFAULT_TYPE):
     t = datetime.now(TZ).strftime("%H:%M:%S")
     await update.message.reply_text(f"🏓 البوت يعمل ✅\n🕐 {t}")
 
+async def cmd_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg   = update.message
+    query = " ".join(context.args or []).strip()
+    if not query:
+        context.user_data["awaiting"] = "search"
+        await msg.reply_text(TXT_SEARCH_PROMPT, reply_markup=kb_search_cancel())
+        return
+    context.user_data["search_q"] = query
+    text, kb = search_view(get_catalog(), query, 0)
+    await msg.reply_text(text, reply_markup=kb)
+
 async def cmd_adminhelp(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_IDS: return
     await update.message.reply_text(TXT_ADMIN, parse_mode="Markdown")
 
 async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id, update.effective_chat.id): return
-    users   = load_users()
-    lessons = load_lessons()
-    quiz    = load_quiz()
-    points  = load_points()
-    terms   = load_terms()
-    top3    = sorted([(u, d.get("points", 0)) for u, d in points.items()],
-                     key=lambda x: x[1], reverse=True)[:3]
-    top_txt = "\n".join(f"  {r+1}. `{u}` — {p} نقطة" for r, (u, p) in enumerate(top3)) \
-              or "  لا توجد بيانات"
+    st  = get_stats()
+    g   = st.gauges
+    cat = get_catalog()
+    dau, wau, mau = st.active(1), st.active(7), st.active(30)
+    def top_lessons(metric):
+        return "\n".join(f"  {r+1}. {les.title} — {v}"
+                         for r, (les, v) in enumerate(popular_lessons(cat, metric, "", 3))) \
+               or "  لا توجد بيانات"
+    def top_txt(w):
+        return "\n".join(f"  {r+1}. `{u}` — {p} نقطة"
+                         for r, (u, p) in enumerate(get_board(w).top(3))) \
+               or "  لا توجد بيانات"
+    def feats(span):
+        return " · ".join(f"`{f}` {n}" for f, n in st.features(span, 6)) or "لا توجد بيانات"
     await update.message.reply_text(
         "📊 *إحصائيات البوت*\n\n"
-        f"👥 الطلاب : *{len(users)}*\n"
-        f"📚 الدروس : *{total_lessons(lessons)}*\n"
-        f"📝 الكويز : *{len(quiz)}*\n"
-        f"📚 القاموس: *{len(terms)}* مصطلح\n"
-        f"🏆 النشطون: *{len(points)}*\n\n"
-        f"🥇 *أعلى الطلاب:*\n{top_txt}",
+        f"👥 الطلاب : *{g.get('users', 0)}*"
+        f" (جدد اليوم {st.new_users(1)} · الأسبوع {st.new_users(7)})\n"
+        f"🟢 النشطون: اليوم *{dau}* · الأسبوع *{wau}* · الشهر *{mau}*"
+        f" (الثبات {dau / max(mau, 1):.0%})\n"
+        f"📚 الدروس : *{cat.count(ROOT_ID)}*"
+        f" ({cat.count(ROOT_ID, Cat.DARS)} درس · {cat.count(ROOT_ID, Cat.MULAKH)} ملخص"
+        f" · {cat.count(ROOT_ID, Cat.IMTIHAN)} امتحان)\n"
+        f"📝 الكويز : *{g.get('quiz', 0)}*\n"
+        f"📚 القاموس: *{g.get('terms', 0)}* مصطلح\n"
+        f"🏆 أصحاب النقاط: *{len(get_board('a'))}*\n\n"
+        f"🖱️ *الأكثر استخداماً اليوم:* {feats(1)}\n"
+        f"🖱️ *هذا الأسبوع:* {feats(7)}\n\n"
+        f"🥇 *أعلى الطلاب:*\n{top_txt('a')}\n"
+        f"📆 *هذا الأسبوع:*\n{top_txt('w')}\n"
+        f"🗓️ *هذا الشهر:*\n{top_txt('m')}\n\n"
+        f"❤️ *الأكثر إعجاباً:*\n{top_lessons('l')}\n"
+        f"📥 *الأكثر تحميلاً:*\n{top_lessons('o')}",
         parse_mode="Markdown"
     )
 
+async def cmd_routestats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id, update.effective_chat.id): return
+    if not CB_STATS:
+        await update.message.reply_text("لا توجد بيانات بعد."); return
+    hot   = sorted(CB_STATS.items(), key=lambda kv: kv[1].n, reverse=True)[:25]
+    lines = [f"🔄 تأخّر الحلقة: p50 {LOAD.lag(0.5)*1000:.1f}ms · p99 {LOAD.lag(0.99)*1000:.1f}ms"
+             f" · مستوى الحمل *{LOAD.level}*\n",
+             f"✏️ تعديلات مؤجَّلة: {EDIT_STATS['requested']} طلب ← {EDIT_STATS['sent']} مُرسل"
+             f" · ضغطات محدودة: {CB_LIMIT_STATS['limited']}\n",
+             "⏱️ *الشاشات الأكثر استخداماً*\n"]
+    for route, h in hot:
+        avg = h.total / h.n * 1000
+        lines.append(f"`{route}` — {h.n}× · {avg:.1f}ms · p99≤{h.quantile(0.99)*1000:g}ms")
+    await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
+
 
 # ================================================================
 #  ٢١. إدارة الدروس
 # ================================================================
 
+async def ask_notify(msg, context, lessons):
+    """خيار إشعار الطلاب — إشعار واحد مهما كان عدد الدروس المضافة"""
+    what = "بهذا الدرس الجديد" if len(lessons) == 1 else f"بـ {len(lessons)} دروس جديدة"
+    await msg.reply_text(
+        f"📢 هل تريد إشعار الطلاب {what}؟",
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton("✅ نعم أرسل إشعاراً", callback_data="NOTIFYYES"),
+            InlineKeyboardButton("⏭️ تخطي",             callback_data="NOTIFYNO"),
+        ]])
+    )
+    # حفظ معلومات الإشعار مؤقتاً
+    context.bot_data[f"notify_{msg.from_user.id}"] = {"lessons": lessons}
+
+def notify_text(lessons):
+    if len(lessons) == 1:
+        les = lessons[0]
+        return (
+            f"📚 *درس جديد أُضيف!*\n\n"
+            f"📖 المادة : *{les['subj']}*\n"
+            f"📅 السنة  : *{les['year']}*\n"
+            f"{cat_icon(les['cat'])} *{les['title']}*\n\n"
+            f"اضغط 🔄 تحديث في البوت لرؤيته"
+        )
+    per = {}
+    for les in lessons:
+        key = (les["subj"], les["year"])
+        per[key] = per.get(key, 0) + 1
+    lines = [f"📖 *{subj}* ({year}) — {n}" for (subj, year), n in per.items()]
+    if len(lines) > 15:
+        lines = lines[:15] + [f"… و{len(lines) - 15} مواد أخرى"]
+    return (
+        f"📚 *{len(lessons)} دروس جديدة أُضيفت!*\n\n" + "\n".join(lines) +
+        "\n\nاضغط 🔄 تحديث في البوت لرؤيتها"
+    )
+
 async def cmd_adddars(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.message
     if not msg or not is_admin(update.effective_user.id, update.effective_chat.id):
@@ -820,13 +2756,7 @@ async def cmd_adddars(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await msg.reply_text("⚠️ صيغة خاطئة. /adminhelp للتفاصيل.")
         return
 
-    lessons = load_lessons()
-    (lessons.setdefault(year, {})
-            .setdefault(spec, {})
-            .setdefault(sem, {})
-            .setdefault(subj, [])
-            .append([title, value, cat]))
-    save_lessons(lessons)
+    await catalog_add(year, spec, sem, subj, [title, value, cat])
 
     await msg.reply_text(
         f"✅ *تمت الإضافة!*\n\n"
@@ -836,19 +2766,8 @@ async def cmd_adddars(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode="Markdown"
     )
 
-    # خيار إشعار الطلاب
-    notify_text = f"NOTIFY:{year}|||{subj}|||{title}"
-    await msg.reply_text(
-        "📢 هل تريد إشعار الطلاب بهذا الدرس الجديد؟",
-        reply_markup=InlineKeyboardMarkup([[
-            InlineKeyboardButton("✅ نعم أرسل إشعاراً", callback_data="NOTIFYYES"),
-            InlineKeyboardButton("⏭️ تخطي",             callback_data="NOTIFYNO"),
-        ]])
-    )
-    # حفظ معلومات الإشعار مؤقتاً
-    context.bot_data[f"notify_{msg.from_user.id}"] = {
-        "year": year, "subj": subj, "title": title, "cat": cat
-    }
+    await ask_notify(msg, context, [
+        {"year": year, "subj": subj, "title": title, "cat": cat}])
 
 async def cmd_listdars(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.message
@@ -883,16 +2802,170 @@ async def cmd_deldars(update: Update, context: ContextTypes.DEFAULT_TYPE):
         assert idx >= 0
     except:
         await msg.reply_text("⚠️ رقم غير صحيح."); return
-    lessons = load_lessons()
-    try:    items = lessons[year][spec][sem][subj]
+    try:    items = load_lessons()[year][spec][sem][subj]
     except: await msg.reply_text("⚠️ المسار غير موجود."); return
     if idx >= len(items):
         await msg.reply_text(f"⚠️ يوجد {len(items)} درس فقط."); return
-    removed = items.pop(idx)
-    save_lessons(lessons)
+    removed = await catalog_remove(year, spec, sem, subj, idx)
     await msg.reply_text(f"✅ حُذف: *{removed[0]}*", parse_mode="Markdown")
 
 
+# ── الاستيراد الجماعي ──────────────────────────────────────
+# ١) Reply على ملف بيان CSV/JSON ثم /importdars
+# ٢) /importdars سنة | تخصص | سداسي | مادة [| تصنيف] ← أرسل/حوّل الملفات ← /importdars تم
+# كل الصفوف تُفحص أولاً؛ أي خطأ يلغي الاستيراد كله، وإلا حفظ واحد ونسخة واحدة.
+
+LESSON_FIELDS  = ("year", "spec", "sem", "subj", "title", "value", "cat")
+LESSON_ALIASES = {
+    "file": "value", "file_id": "value", "url": "value", "link": "value",
+    "subject": "subj", "semester": "sem", "specialty": "spec", "category": "cat",
+    "السنة": "year", "التخصص": "spec", "السداسي": "sem", "المادة": "subj",
+    "العنوان": "title", "الملف": "value", "الرابط": "value", "التصنيف": "cat",
+}
+MANIFEST_MAX_BYTES = 2 * 1024 * 1024
+IMPORT_ERRORS_SHOWN = 10
+
+async def fetch_manifest(msg, context, doc, fields, aliases, prepare=None):
+    """تنزيل ملف البيان وقراءته ← صفوف، أو None بعد الرد بسبب الفشل"""
+    if (doc.file_size or 0) > MANIFEST_MAX_BYTES:
+        await msg.reply_text("⚠️ ملف البيان كبير جداً (الحد 2MB)."); return None
+    try:
+        data = await (await context.bot.get_file(doc.file_id)).download_as_bytearray()
+        rows = parse_manifest(data)
+        if prepare: rows = [prepare(r) for r in rows]
+        return read_manifest(rows, fields, aliases)
+    except (ValueError, csv.Error, TelegramError) as e:    # TelegramError يشمل أخطاء الشبكة
+        await msg.reply_text(f"⚠️ تعذّرت قراءة البيان: {e}")
+        return None
+
+def report_errors(errors):
+    shown = "\n".join(errors[:IMPORT_ERRORS_SHOWN])
+    more  = f"\n… و{len(errors) - IMPORT_ERRORS_SHOWN} أخطاء أخرى" if len(errors) > IMPORT_ERRORS_SHOWN else ""
+    return f"❌ {len(errors)} خطأ — لم يُستورد شيء:\n{shown}{more}"
+
+def _json_buffer(data):
+    """في خيط التخزين: json.dump على دفعات في BytesIO دون بناء نص كامل"""
+    for _ in range(3):
+        buf = io.BytesIO()
+        w   = io.TextIOWrapper(buf, encoding="utf-8", write_through=True)
+        try:
+            json.dump(data, w, ensure_ascii=False, indent=1)
+            break
+        except RuntimeError:        # عُدّل الكائن المشترك أثناء التسلسل ← نعيد
+            time.sleep(0.01)
+    else:
+        raise RuntimeError("export: data changed during serialization")
+    w.detach()
+    buf.seek(0)
+    return buf
+
+async def send_json_file(msg, data, filename, caption):
+    """تصدير البيانات كملف — التسلسل خارج حلقة الأحداث كما في _save"""
+    buf = await asyncio.get_running_loop().run_in_executor(_IO, _json_buffer, data)
+    await msg.reply_document(document=buf, filename=filename, caption=caption)
+
+def parse_cat(s):
+    """نص التصنيف ← إحدى قيم CATS (الفارغ = درس) أو None"""
+    if not s: return CAT_DARS
+    return next((c for c in CATS if s in c), None)
+
+def validate_lessons(rows, lessons):
+    """← (entries, skipped, errors). rows = [سنة، تخصص، سداسي، مادة، عنوان، قيمة، تصنيف]
+    المكرر (نفس الملف في نفس المادة، في الملف الحالي أو في البيان) يُتخطّى."""
+    entries, errors, skipped = [], [], 0
+    seen = set()
+    for i, (year, spec, sem, subj, title, value, cat_s) in enumerate(rows, 1):
+        if not all((year, spec, sem, subj, title, value)):
+            errors.append(f"{i}: حقل فارغ"); continue
+        if not is_url(value) and (len(value) < 10 or any(c.isspace() for c in value)):
+            errors.append(f"{i}: file_id أو رابط غير صالح"); continue
+        cat = parse_cat(cat_s)
+        if cat is None:
+            errors.append(f"{i}: تصنيف غير معروف «{cat_s}»"); continue
+        key = (year, spec, sem, subj, value)
+        existing = lessons.get(year, {}).get(spec, {}).get(sem, {}).get(subj, [])
+        if key in seen or any(it[1] == value for it in existing):
+            skipped += 1; continue
+        seen.add(key)
+        entries.append((year, spec, sem, subj, [title, value, cat]))
+    return entries, skipped, errors
+
+async def apply_import(msg, context, rows):
+    t0 = time.perf_counter()
+    entries, skipped, errors = validate_lessons(rows, load_lessons())
+    if errors:
+        await msg.reply_text(report_errors(errors)); return
+    if not entries:
+        await msg.reply_text(f"ℹ️ لا جديد (تخطّي {skipped} مكرر)."); return
+    await catalog_add_many(entries)
+    subjects = {e[:4] for e in entries}
+    await msg.reply_text(
+        f"✅ *تم الاستيراد:* {len(entries)} درس في {len(subjects)} مادة"
+        + (f"\n⏭️ تخطّي {skipped} مكرر" if skipped else "")
+        + f"\n⏱️ {time.perf_counter() - t0:.2f}s",
+        parse_mode="Markdown")
+    await ask_notify(msg, context, [
+        {"year": y, "subj": b, "title": it[0], "cat": it[2]} for y, _, _, b, it in entries])
+
+# دفعات /importdars المفتوحة: معرّف المشرف ← دفعة. خارج user_data لأن
+# الرجوع للرئيسية يمسحها (user_data.clear) فتضيع الملفات المحوّلة بصمت.
+_IMPORTS = {}
+
+async def cmd_importdars(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.message
+    if not msg or not is_admin(update.effective_user.id, update.effective_chat.id): return
+    raw   = (msg.text or "").split(maxsplit=1)[1:]
+    raw   = raw[0].strip() if raw else ""
+    doc   = getattr(getattr(msg, "reply_to_message", None), "document", None)
+    uid   = update.effective_user.id
+    batch = _IMPORTS.get(uid)
+
+    # ١) ملف بيان
+    if doc and not raw:
+        rows = await fetch_manifest(msg, context, doc, LESSON_FIELDS, LESSON_ALIASES)
+        if rows is not None:
+            await apply_import(msg, context, rows)
+        return
+
+    # ٢) دفعة ملفات محوّلة
+    if raw in ("تم", "done"):
+        if not batch:
+            await msg.reply_text("⚠️ لا توجد دفعة مفتوحة."); return
+        _IMPORTS.pop(uid, None)
+        year, spec, sem, subj = batch["path"]
+        await apply_import(msg, context, [
+            [year, spec, sem, subj, title, fid, batch["cat"]] for title, fid in batch["items"]])
+        return
+    if raw in ("إلغاء", "cancel"):
+        _IMPORTS.pop(uid, None)
+        await msg.reply_text("🗑️ أُلغيت الدفعة."); return
+    parts = [p.strip() for p in raw.split("|")] if raw else []
+    if len(parts) in (4, 5):
+        if update.effective_chat.type != "private":
+            await msg.reply_text("⚠️ الدفعات في الخاص فقط."); return
+        cat = parse_cat(parts[4] if len(parts) == 5 else "")
+        if cat is None:
+            await msg.reply_text("⚠️ التصنيف: درس / ملخص / امتحان"); return
+        _IMPORTS[uid] = {"path": parts[:4], "cat": cat, "items": []}
+        await msg.reply_text(
+            f"📥 *دفعة جديدة:* {' ← '.join(parts[:4])}\n"
+            "أرسل أو حوّل ملفات PDF الآن (التعليق أو اسم الملف = العنوان)\n"
+            "ثم `/importdars تم` — أو `/importdars إلغاء`",
+            parse_mode="Markdown")
+        return
+    if batch:
+        await msg.reply_text(
+            f"📥 دفعة مفتوحة: {' ← '.join(batch['path'])} — {len(batch['items'])} ملف\n"
+            "`/importdars تم` للحفظ أو `/importdars إلغاء`", parse_mode="Markdown")
+        return
+    await msg.reply_text(
+        "📥 *الاستيراد الجماعي*\n\n"
+        "• Reply على ملف CSV/JSON ثم `/importdars`\n"
+        "  الأعمدة: year, spec, sem, subj, title, file, cat\n"
+        "• أو `/importdars سنة | تخصص | سداسي | مادة | تصنيف` ثم أرسل الملفات",
+        parse_mode="Markdown")
+
+
 # ================================================================
 #  ٢٢. إدارة الكويز
 # ================================================================
@@ -918,15 +2991,25 @@ async def cmd_addquiz(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await msg.reply_text(f"✅ تمت الإضافة!\n❓ {q}\n✅ *{[c1,c2,c3,c4][ans]}*",
                          parse_mode="Markdown")
 
+LISTQUIZ_PAGE = 15
+
 async def cmd_listquiz(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.message
     if not msg or not is_admin(update.effective_user.id, update.effective_chat.id): return
     quiz = load_quiz()
     if not quiz: await msg.reply_text("لا توجد أسئلة."); return
-    lines = [f"📝 *الكويز ({len(quiz)}):*\n"]
-    for i, q in enumerate(quiz, 1):
-        lines.append(f"{i}. {q['q']}\n   ✅ {q['choices'][q['answer']]}  ⭐{q['points']}")
-    lines.append("\n🗑️ `/delquiz رقم`")
+    pages = (len(quiz) + LISTQUIZ_PAGE - 1) // LISTQUIZ_PAGE
+    try:    page = min(max(int(context.args[0]) - 1, 0), pages - 1) if context.args else 0
+    except ValueError: page = 0
+    start = page * LISTQUIZ_PAGE
+    lines = [f"📝 *الكويز ({len(quiz)}) — صفحة {page + 1}/{pages}:*\n"]
+    for i, q in enumerate(quiz[start:start + LISTQUIZ_PAGE], start + 1):
+        st   = question_stats(q)
+        rate = f"  📊 {st[1]:.0%} من {st[0]}" if st else ""
+        lines.append(f"{i}. {q['q'][:150]}\n   ✅ {q['choices'][q['answer']][:60]}  ⭐{q['points']}{rate}")
+    if page < pages - 1:
+        lines.append(f"\n▶️ `/listquiz {page + 2}`")
+    lines.append("🗑️ `/delquiz رقم`   📤 `/exportquiz`")
     await msg.reply_text("\n".join(lines), parse_mode="Markdown")
 
 async def cmd_delquiz(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -943,6 +3026,68 @@ async def cmd_delquiz(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await msg.reply_text(f"✅ حُذف: *{removed['q']}*", parse_mode="Markdown")
 
 
+# ── استيراد وتصدير الكويز ───────────────────────────────────
+# البيان: q, c1, c2, c3, c4, answer (1-4), points — أو ملف /exportquiz نفسه.
+
+QUIZ_FIELDS  = ("q", "c1", "c2", "c3", "c4", "answer", "points")
+QUIZ_ALIASES = {"question": "q", "السؤال": "q", "correct": "answer",
+                "الإجابة": "answer", "pts": "points", "النقاط": "points"}
+
+def _quiz_row(r):
+    """صف بصيغة quiz_data.json (choices + answer من 0) ← صيغة البيان"""
+    if isinstance(r, dict) and isinstance(r.get("choices"), list):
+        c = (r["choices"] + [""] * 4)[:4]
+        a = r.get("answer")
+        return {"q": r.get("q"), "c1": c[0], "c2": c[1], "c3": c[2], "c4": c[3],
+                "answer": a + 1 if isinstance(a, int) else a, "points": r.get("points")}
+    return r
+
+def validate_quiz(rows, quiz):
+    entries, errors, skipped = [], [], 0
+    seen = {q["q"] for q in quiz}
+    for i, (q, c1, c2, c3, c4, ans_s, pts_s) in enumerate(rows, 1):
+        if not all((q, c1, c2, c3, c4)):
+            errors.append(f"{i}: سؤال أو خيار فارغ"); continue
+        try:
+            ans = int(ans_s) - 1; pts = int(pts_s or QUIZ_DEFAULT_POINTS)
+            assert 0 <= ans <= 3 and pts > 0
+        except (ValueError, AssertionError):
+            errors.append(f"{i}: رقم الإجابة 1-4 والنقاط موجبة"); continue
+        if q in seen:
+            skipped += 1; continue
+        seen.add(q)
+        entries.append({"q": q, "choices": [c1, c2, c3, c4], "answer": ans, "points": pts})
+    return entries, skipped, errors
+
+async def cmd_importquiz(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.message
+    if not msg or not is_admin(update.effective_user.id, update.effective_chat.id): return
+    doc = getattr(getattr(msg, "reply_to_message", None), "document", None)
+    if not doc:
+        await msg.reply_text(
+            "📥 Reply على ملف CSV/JSON ثم `/importquiz`\n"
+            "الأعمدة: q, c1, c2, c3, c4, answer (1-4), points"
+            f" (اختياري، الافتراضي {QUIZ_DEFAULT_POINTS})", parse_mode="Markdown"); return
+    rows = await fetch_manifest(msg, context, doc, QUIZ_FIELDS, QUIZ_ALIASES, _quiz_row)
+    if rows is None: return
+    quiz = load_quiz()
+    entries, skipped, errors = validate_quiz(rows, quiz)
+    if errors:
+        await msg.reply_text(report_errors(errors)); return
+    if entries:
+        quiz.extend(entries)
+        save_quiz(quiz)
+    await msg.reply_text(
+        f"✅ أُضيف {len(entries)} سؤال (المجموع {len(quiz)})"
+        + (f"\n⏭️ تخطّي {skipped} مكرر" if skipped else ""))
+
+async def cmd_exportquiz(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.message
+    if not msg or not is_admin(update.effective_user.id, update.effective_chat.id): return
+    quiz = load_quiz()
+    await send_json_file(msg, quiz, FILE_QUIZ, f"📝 {len(quiz)} سؤال")
+
+
 # ================================================================
 #  ٢٣. الاستطلاع
 # ================================================================
@@ -957,38 +3102,46 @@ async def cmd_poll(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     question = parts[0]
     options  = parts[1:]
-    poll_data = {"active": True, "question": question,
-                 "options": options, "votes": {}}
-    save_poll(poll_data)
+    pid = get_polls().create(question, options)
 
     text = (f"🗳️ *استطلاع رأي*\n\n*{question}*\n\n"
             "اضغط على خيارك 👇")
-    kb = kb_poll_vote(options)
+    kb = kb_poll_vote(options, pid)
     await send_to_all(context.bot, text, parse_mode="Markdown", reply_markup=kb)
-    await msg.reply_text("✅ تم إرسال الاستطلاع لجميع الطلاب.")
+    await msg.reply_text(f"✅ تم إرسال الاستطلاع #{pid} لجميع الطلاب.\n"
+                         f"📊 `/pollresults {pid}`   🔒 `/endpoll {pid}`", parse_mode="Markdown")
+
+def poll_arg(context, active=False):
+    """رقم الاستطلاع من الأمر، وإلا الأحدث ← (pid، رسالة خطأ)"""
+    polls = get_polls()
+    pid = context.args[0].lstrip("#") if context.args else polls.latest(active)
+    if pid is None:
+        return None, "لا يوجد استطلاع."
+    if polls.get(pid) is None:
+        return None, f"⚠️ لا يوجد استطلاع #{pid}."
+    return pid, None
 
 async def cmd_pollresults(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id, update.effective_chat.id): return
-    poll = load_poll()
-    if not poll.get("question"):
-        await update.message.reply_text("لا يوجد استطلاع."); return
-    votes   = poll.get("votes", {})
-    options = poll.get("options", [])
-    total   = len(votes)
-    lines   = [f"📊 *نتائج الاستطلاع*\n\n*{poll['question']}*\n\nالمشاركون: {total}\n"]
-    counts = [sum(1 for v in votes.values() if v == i) for i in range(len(options))]
-    for i, opt in enumerate(options):
-        pct  = round(counts[i]/total*100) if total else 0
-        bar  = "█" * (pct // 10) + "░" * (10 - pct // 10)
-        lines.append(f"{i+1}. {opt}\n   {bar} {counts[i]} ({pct}%)\n")
-    await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
+    pid, err = poll_arg(context)
+    if err:
+        await update.message.reply_text(err); return
+    polls = get_polls()
+    text  = poll_results_text(pid)
+    others = [p for p in polls.active() if p != pid]
+    if others:
+        text += "\nاستطلاعات مفتوحة أخرى: " + " · ".join(f"#{p}" for p in others)
+    sent = await update.message.reply_text(text, parse_mode="Markdown")
+    if polls.get(pid).get("active"):
+        polls.watch(pid, sent.chat_id, sent.message_id)     # تُحدَّث تلقائياً
 
 async def cmd_endpoll(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id, update.effective_chat.id): return
-    poll = load_poll()
-    poll["active"] = False
-    save_poll(poll)
-    await update.message.reply_text("🔒 تم إغلاق الاستطلاع.")
+    pid, err = poll_arg(context, active=True)
+    if err:
+        await update.message.reply_text(err); return
+    get_polls().end(pid)
+    await update.message.reply_text(f"🔒 تم إغلاق الاستطلاع #{pid}.")
 
 
 # ================================================================
@@ -1017,17 +3170,60 @@ async def cmd_delterm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     del terms[term]; save_terms(terms)
     await msg.reply_text(f"✅ حُذف: *{term}*", parse_mode="Markdown")
 
+LISTTERMS_PAGE = 30
+
 async def cmd_listterms(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.message
     if not msg or not is_admin(update.effective_user.id, update.effective_chat.id): return
-    terms = load_terms()
-    if not terms: await msg.reply_text("القاموس فارغ."); return
-    lines = [f"📚 *القاموس ({len(terms)} مصطلح):*\n"]
-    for t, d in list(terms.items())[:30]:
+    tix = get_term_index()
+    if not len(tix): await msg.reply_text("القاموس فارغ."); return
+    pages = (len(tix) + LISTTERMS_PAGE - 1) // LISTTERMS_PAGE
+    try:    page = min(max(int(context.args[0]) - 1, 0), pages - 1) if context.args else 0
+    except ValueError: page = 0
+    lines = [f"📚 *القاموس ({len(tix)} مصطلح) — صفحة {page + 1}/{pages}:*\n"]
+    for n in tix.page(page, LISTTERMS_PAGE):
+        t, d = tix.terms[n], tix.defs[n]
         lines.append(f"• *{t}*: {d[:60]}{'...' if len(d) > 60 else ''}")
+    if page < pages - 1:
+        lines.append(f"\n▶️ `/listterms {page + 2}`")
     await msg.reply_text("\n".join(lines), parse_mode="Markdown")
 
 
+# ── استيراد وتصدير القاموس ─────────────────────────────────
+# البيان: term, definition — أو ملف /exportterms نفسه ({مصطلح: تعريف}).
+# مصطلح موجود بتعريف مختلف يُحدَّث.
+
+TERM_FIELDS  = ("term", "definition")
+TERM_ALIASES = {"def": "definition", "المصطلح": "term", "التعريف": "definition"}
+
+async def cmd_importterms(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.message
+    if not msg or not is_admin(update.effective_user.id, update.effective_chat.id): return
+    doc = getattr(getattr(msg, "reply_to_message", None), "document", None)
+    if not doc:
+        await msg.reply_text(
+            "📥 Reply على ملف CSV/JSON ثم `/importterms`\nالأعمدة: term, definition",
+            parse_mode="Markdown"); return
+    rows = await fetch_manifest(msg, context, doc, TERM_FIELDS, TERM_ALIASES)
+    if rows is None: return
+    errors = [f"{i}: مصطلح أو تعريف فارغ" for i, (t, d) in enumerate(rows, 1) if not (t and d)]
+    if errors:
+        await msg.reply_text(report_errors(errors)); return
+    terms = load_terms()
+    added   = sum(1 for t, _ in dict(rows).items() if t not in terms)
+    updated = sum(1 for t, d in dict(rows).items() if t in terms and terms[t] != d)
+    if added or updated:
+        terms.update(rows)
+        save_terms(terms)
+    await msg.reply_text(f"✅ أُضيف {added} وحُدّث {updated} (المجموع {len(terms)})")
+
+async def cmd_exportterms(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.message
+    if not msg or not is_admin(update.effective_user.id, update.effective_chat.id): return
+    terms = load_terms()
+    await send_json_file(msg, terms, FILE_TERMS, f"📚 {len(terms)} مصطلح")
+
+
 # ================================================================
 #  ٢٥. التقويم والبث
 # ================================================================
@@ -1050,13 +3246,19 @@ async def cmd_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except:
         await update.message.reply_text("❌ تعذّر التحقق."); return
 
-    users = load_users()
-    if not users: await update.message.reply_text("لا يوجد طلاب."); return
-    ok = bad = 0; dead = set()
-
-    if context.args:
-        text = " ".join(context.args)
-        for uid in list(users):
+    # /broadcast @N ... ← النشطون في آخر N يوم فقط
+    args = list(context.args or [])
+    days = None
+    if args and args[0].startswith("@") and args[0][1:].isdigit():
+        days = int(args.pop(0)[1:]) or None
+    users, targets = broadcast_targets(days)
+    if not targets: await update.message.reply_text("لا يوجد طلاب."); return
+    ok = bad = 0; dead = set(); t0 = time.perf_counter()
+
+    if args:
+        text = " ".join(args)
+        for uid in list(targets):
+            await broadcast_pause()
             try:
                 await context.bot.send_message(uid, f"📢 *إعلان:*\n\n{text}", parse_mode="Markdown")
                 ok += 1
@@ -1064,7 +3266,8 @@ async def cmd_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
             except: bad += 1
     elif update.message.reply_to_message:
         src = update.message.reply_to_message
-        for uid in list(users):
+        for uid in list(targets):
+            await broadcast_pause()
             try:
                 await context.bot.copy_message(uid, ADMIN_CHAT_ID, src.message_id)
                 ok += 1
@@ -1072,9 +3275,11 @@ async def cmd_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
             except: bad += 1
     else:
         await update.message.reply_text(
-            "اكتب `/broadcast النص`\nأو Reply + `/broadcast`",
+            "اكتب `/broadcast النص`\nأو Reply + `/broadcast`\n"
+            "`/broadcast @7 ...` للنشطين في آخر 7 أيام فقط",
             parse_mode="Markdown"); return
 
+    count_broadcast(ok, bad, len(dead), t0)
     if dead: save_users(users - dead)
     await update.message.reply_text(f"✅ أُرسلت إلى *{ok}*\n⚠️ فشل: *{bad}*", parse_mode="Markdown")
 
@@ -1083,660 +3288,1021 @@ async def cmd_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
 #  ٢٦. معالج الكولباك الرئيسي
 # ================================================================
 
-async def handle_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q    = update.callback_query
-    await q.answer()
-    data = q.data
-    uid  = update.effective_user.id
-    ud   = context.user_data
+def _greet(uid):
+    prof = get_student_profile(uid)
+    return f"أهلاً *{prof['name']}* 🌿\n\n" if prof.get("name") else ""
 
-    # ── إشعار درس جديد ─────────────────────────────────────────
-    if data == "NOTIFYYES":
-        info = context.bot_data.get(f"notify_{uid}", {})
-        if info:
-            year  = info.get("year", "")
-            subj  = info.get("subj", "")
-            title = info.get("title", "")
-            cat   = info.get("cat", CAT_DARS)
-            text  = (
-                f"📚 *درس جديد أُضيف!*\n\n"
-                f"📖 المادة : *{subj}*\n"
-                f"📅 السنة  : *{year}*\n"
-                f"{cat_icon(cat)} *{title}*\n\n"
-                f"اضغط 🔄 تحديث في البوت لرؤيته"
-            )
-            await send_to_all(context.bot, text, parse_mode="Markdown")
-            context.bot_data.pop(f"notify_{uid}", None)
-            await q.answer("✅ تم إرسال الإشعار للجميع!")
-            await q.message.edit_text("📢 *تم إرسال الإشعار لجميع الطلاب* ✅",
-                                      parse_mode="Markdown")
-        return
+def txt_profile(prof):
+    return (f"👤 *ملفي الشخصي*\n\n"
+            f"📛 الاسم   : *{prof.get('name','غير محدد')}*\n"
+            f"🎓 التخصص : *{prof.get('spec','غير محدد')}*\n"
+            f"📅 السنة   : *{prof.get('year','غير محددة')}*")
 
-    if data == "NOTIFYNO":
-        context.bot_data.pop(f"notify_{uid}", None)
-        await q.answer("تم التخطي")
-        await q.message.edit_text("✅ تم إضافة الدرس بدون إشعار.")
-        return
 
-    # ── تحديث ──────────────────────────────────────────────────
-    if data == "REFRESH":
-        context.user_data.clear()
-        if update.effective_chat.type == "private":
-            add_user(update.effective_chat.id)
-        lessons  = load_lessons()
-        prof     = get_student_profile(uid)
-        greet    = f"أهلاً *{prof['name']}* 🌿\n\n" if prof.get("name") else ""
-        total    = total_lessons(lessons)
-        await q.answer("✅ تم التحديث!")
-        return await q.message.edit_text(
-            greet + TXT_WELCOME +
-            f"\n\n📚 _إجمالي الدروس المتاحة: {total}_",
-            reply_markup=kb_main(),
-            parse_mode="Markdown"
-        )
+# ── إشعار درس جديد ─────────────────────────────────────────
 
-    # ── الرئيسية ──────────────────────────────────────────────
-    if data == "home":
-        context.user_data.clear()
-        if update.effective_chat.type == "private":
-            add_user(update.effective_chat.id)
-        prof   = get_student_profile(uid)
-        greet  = f"أهلاً *{prof['name']}* 🌿\n\n" if prof.get("name") else ""
-        return await q.message.edit_text(
-            greet + TXT_WELCOME, reply_markup=kb_main(), parse_mode="Markdown"
-        )
+async def cb_notify_yes(update, context, arg):
+    q, uid = update.callback_query, update.effective_user.id
+    info = context.bot_data.get(f"notify_{uid}", {})
+    if not info.get("lessons"): return
+    await send_to_all(context.bot, notify_text(info["lessons"]), parse_mode="Markdown")
+    context.bot_data.pop(f"notify_{uid}", None)
+    await q.answer("✅ تم إرسال الإشعار للجميع!")
+    await edit_now(q.message, "📢 *تم إرسال الإشعار لجميع الطلاب* ✅",
+                              parse_mode="Markdown")
 
-    # ── مساعدة ──────────────────────────────────────────────
-    if data == "H:show":
-        return await q.message.edit_text(TXT_HELP, reply_markup=kb_back("home"),
-                                         parse_mode="Markdown")
-
-    # ── الكويز ──────────────────────────────────────────────
-    if data == "Q:start":
-        quiz = load_quiz()
-        if not quiz:
-            return await q.message.edit_text("⚠️ بنك الكويز فارغ.",
-                                             reply_markup=kb_back("home"))
-        qid  = random.randint(0, len(quiz)-1)
-        item = quiz[qid]
-        ud["qid"] = qid
-        kb = InlineKeyboardMarkup(
-            [[InlineKeyboardButton(c, callback_data=f"Q:a:{qid}:{i}")]
-             for i, c in enumerate(item["choices"])]
-            + [[InlineKeyboardButton("🏠 الرئيسية", callback_data="home")]]
-        )
-        return await q.message.edit_text(f"📝 *اختبار قصير*\n\n{item['q']}",
-                                         reply_markup=kb, parse_mode="Markdown")
-
-    if data.startswith("Q:a:"):
-        parts   = data.split(":")
-        qid     = int(parts[2]); choice = int(parts[3])
-        quiz    = load_quiz()
-        if qid >= len(quiz): return
-        item     = quiz[qid]
-        correct  = item["answer"]; pts = item.get("points", 1)
-        is_right = choice == correct
-        prof     = get_profile_points(uid)
-        prof["points"] = prof.get("points", 0) + (pts if is_right else 0)
-        prof["last_quiz"] = datetime.utcnow().isoformat()
-        new_badges = apply_achievements(prof)
-        save_profile_points(uid, prof)
-        result = (f"✅ صحيحة! +{pts} نقطة" if is_right
-                  else f"❌ خاطئة.\n✅ الصحيح: *{item['choices'][correct]}*")
-        extra  = ("\n\n🏆 " + " | ".join(new_badges)) if new_badges else ""
-        return await q.message.edit_text(
-            f"📝 *اختبار قصير*\n\n{item['q']}\n\n{result}\n"
-            f"⭐ نقاطك: *{prof['points']}*{extra}\n\nاضغط لسؤال جديد:",
+async def cb_notify_no(update, context, arg):
+    q = update.callback_query
+    context.bot_data.pop(f"notify_{update.effective_user.id}", None)
+    await q.answer("تم التخطي")
+    await edit_now(q.message, "✅ تمت الإضافة بدون إشعار.")
+
+
+# ── الرئيسية والتحديث والمساعدة ─────────────────────────────
+
+async def cb_refresh(update, context, arg):
+    q = update.callback_query
+    context.user_data.clear()
+    if update.effective_chat.type == "private":
+        add_user(update.effective_chat.id)
+    total = get_catalog().count(ROOT_ID)
+    await q.answer("✅ تم التحديث!")
+    return await edit_now(q.message,
+        _greet(update.effective_user.id) + TXT_WELCOME +
+        f"\n\n📚 _إجمالي الدروس المتاحة: {total}_",
+        reply_markup=kb_main(),
+        parse_mode="Markdown"
+    )
+
+async def cb_home(update, context, arg):
+    context.user_data.clear()
+    if update.effective_chat.type == "private":
+        add_user(update.effective_chat.id)
+    return await edit_now(update.callback_query.message,
+        _greet(update.effective_user.id) + TXT_WELCOME,
+        reply_markup=kb_main(), parse_mode="Markdown"
+    )
+
+async def cb_help(update, context, arg):
+    return await edit_now(update.callback_query.message,
+        TXT_HELP, reply_markup=kb_back("home"), parse_mode="Markdown")
+
+
+# ── الكويز والنقاط ──────────────────────────────────────────
+
+async def cb_quiz_start(update, context, arg):
+    global _DECKS_DIRTY
+    q    = update.callback_query
+    quiz = load_quiz()
+    if not quiz:
+        return await edit_now(q.message, "⚠️ بنك الكويز فارغ.",
+                                         reply_markup=kb_back("home"))
+    deck = get_deck(update.effective_user.id)
+    qid  = deck.draw(len(quiz), quiz_sig(quiz))
+    _DECKS_DIRTY = True
+    item = quiz[qid]
+    kb = InlineKeyboardMarkup(
+        [[InlineKeyboardButton(c, callback_data=f"Q:a:{qid}:{i}")]
+         for i, c in enumerate(item["choices"])]
+        + [[InlineKeyboardButton("🏠 الرئيسية", callback_data="home")]]
+    )
+    review = "🔁 *مراجعة* — " if deck.box else ""
+    return await edit_now(q.message, f"📝 *اختبار قصير*\n\n{review}{item['q']}",
+                                     reply_markup=kb, parse_mode="Markdown")
+
+async def cb_quiz_answer(update, context, arg):
+    q, uid  = update.callback_query, update.effective_user.id
+    qid_s, _, choice_s = arg.partition(":")
+    qid     = int(qid_s); choice = int(choice_s)
+    quiz    = load_quiz()
+    if qid >= len(quiz): return
+    item     = quiz[qid]
+    correct  = item["answer"]; pts = item.get("points", QUIZ_DEFAULT_POINTS)
+    is_right = choice == correct
+    if not record_answer(uid, qid, item, is_right):
+        # زر قديم أو ضغطة ثانية — لا نقاط مرتين على نفس السؤال
+        return await edit_now(q.message,
+            "⌛ تمت الإجابة على هذا السؤال.",
             reply_markup=InlineKeyboardMarkup([
                 [InlineKeyboardButton("🔁 سؤال جديد", callback_data="Q:start")],
-                [InlineKeyboardButton("🏆 نقاطي",      callback_data="P:show")],
                 [InlineKeyboardButton("🏠 الرئيسية",   callback_data="home")],
-            ]),
-            parse_mode="Markdown"
-        )
+            ]))
+    prof     = get_profile_points(uid)
+    prof["points"] = prof.get("points", 0) + (pts if is_right else 0)
+    prof["last_quiz"] = datetime.utcnow().isoformat()
+    new_badges = apply_achievements(prof)
+    save_profile_points(uid, prof)
+    if is_right:
+        add_points(uid, prof, pts)
+    result = (f"✅ صحيحة! +{pts} نقطة" if is_right
+              else f"❌ خاطئة.\n✅ الصحيح: *{item['choices'][correct]}*\n"
+                   f"🔁 سيعود إليك هذا السؤال للمراجعة")
+    extra  = ("\n\n🏆 " + " | ".join(new_badges)) if new_badges else ""
+    return await edit_now(q.message,
+        f"📝 *اختبار قصير*\n\n{item['q']}\n\n{result}\n"
+        f"⭐ نقاطك: *{prof['points']}*{extra}\n\nاضغط لسؤال جديد:",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔁 سؤال جديد", callback_data="Q:start")],
+            [InlineKeyboardButton("🏆 نقاطي",      callback_data="P:show")],
+            [InlineKeyboardButton("🏠 الرئيسية",   callback_data="home")],
+        ]),
+        parse_mode="Markdown"
+    )
 
-    # ── النقاط ──────────────────────────────────────────────
-    if data == "P:show":
-        prof   = get_profile_points(uid)
-        badges = prof.get("badges", [])
-        b_txt  = "\n".join(f"  {b}" for b in badges) if badges else "  لا توجد إنجازات بعد"
-        all_pts = sorted(load_points().values(), key=lambda x: x.get("points",0), reverse=True)
-        rank    = next((i+1 for i, p in enumerate(all_pts)
-                        if p.get("points",0) == prof.get("points",0)), "—")
-        return await q.message.edit_text(
-            f"🏆 *نقاطي وإنجازاتي*\n\n"
-            f"⭐ النقاط  : *{prof.get('points',0)}*\n"
-            f"🏅 الترتيب : *{rank}*\n\n"
-            f"🎖️ الإنجازات:\n{b_txt}",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("📝 سؤال جديد", callback_data="Q:start")],
-                [InlineKeyboardButton("🏠 الرئيسية",  callback_data="home")],
-            ]),
-            parse_mode="Markdown"
-        )
+def _rank_line(w, uid):
+    board = get_board(w)
+    pts, rank = board.score.get(uid, 0), board.rank(uid)
+    return f"*{pts}* نقطة · الترتيب *{rank or '—'}*"
+
+async def cb_points(update, context, arg):
+    q      = update.callback_query
+    uid    = str(update.effective_user.id)
+    prof   = get_profile_points(uid)
+    badges = prof.get("badges", [])
+    b_txt  = "\n".join(f"  {b}" for b in badges) if badges else "  لا توجد إنجازات بعد"
+    return await edit_now(q.message,
+        f"🏆 *نقاطي وإنجازاتي*\n\n"
+        f"⭐ النقاط  : *{prof.get('points',0)}*\n"
+        f"🏅 الترتيب : *{get_board('a').rank(uid) or '—'}*\n"
+        f"📆 هذا الأسبوع: {_rank_line('w', uid)}\n"
+        f"🗓️ هذا الشهر : {_rank_line('m', uid)}\n\n"
+        f"🎖️ الإنجازات:\n{b_txt}",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🥇 الأسبوع", callback_data="P:top:w"),
+             InlineKeyboardButton("🥇 الشهر",   callback_data="P:top:m"),
+             InlineKeyboardButton("🥇 الكل",    callback_data="P:top:a")],
+            [InlineKeyboardButton("📝 سؤال جديد", callback_data="Q:start")],
+            [InlineKeyboardButton("🏠 الرئيسية",  callback_data="home")],
+        ]),
+        parse_mode="Markdown"
+    )
 
-    # ── التقويم ──────────────────────────────────────────────
-    if data == "C:home":
-        cal = load_cal()
-        kb  = [[InlineKeyboardButton(k, callback_data=f"C:i:{k}")] for k in cal]
-        kb.append([InlineKeyboardButton("🏠 الرئيسية", callback_data="home")])
-        return await q.message.edit_text("🗓️ *التقويم الجامعي*\nاختر القسم:",
-                                         reply_markup=InlineKeyboardMarkup(kb),
-                                         parse_mode="Markdown")
-    if data.startswith("C:i:"):
-        key = data[4:]; cal = load_cal()
-        return await q.message.edit_text(
-            f"🗓️ *{key}*\n\n{cal.get(key, 'لا توجد معلومات.')}",
-            reply_markup=kb_back("C:home"), parse_mode="Markdown"
-        )
+LEADERBOARD_TOP = 10
+_MD_STRIP = str.maketrans("", "", "*_`[]")    # أسماء يكتبها الطلاب داخل Markdown
+
+def leaderboard_lines(w, n, uid=None):
+    """أوائل النافذة — الاسم من الملف الشخصي إن وُجد"""
+    medals = ["🥇", "🥈", "🥉"]
+    board, lines = get_board(w), []
+    profiles = load_profiles()
+    for i, (u, pts) in enumerate(board.top(n)):
+        name = profiles.get(u, {}).get("name") or f"طالب {u[-4:]}"
+        name = name.translate(_MD_STRIP)[:30]
+        mark = " ⬅️" if u == uid else ""
+        lines.append(f"{medals[i] if i < 3 else f'{i + 1}.'} {name} — {pts}{mark}")
+    return lines
+
+async def cb_points_top(update, context, arg):
+    w     = arg if arg in WINDOW_NAMES else "w"
+    uid   = str(update.effective_user.id)
+    lines = leaderboard_lines(w, LEADERBOARD_TOP, uid) or ["لا توجد نقاط في هذه الفترة بعد."]
+    return await edit_now(update.callback_query.message,
+        f"🥇 *الأوائل — {WINDOW_NAMES[w]}*\n\n" + "\n".join(lines),
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton(("• " if k == w else "") + WINDOW_NAMES[k], callback_data=f"P:top:{k}")
+             for k in ("w", "m", "a")],
+            [InlineKeyboardButton("⬅️ رجوع", callback_data="P:show")],
+        ]),
+        parse_mode="Markdown"
+    )
 
-    # ── مواقيت الصلاة ──────────────────────────────────────
-    if data == "PRAY:cities":
-        return await q.message.edit_text(
-            "🕌 *مواقيت الصلاة*\nاختر ولايتك:",
-            reply_markup=kb_wilayas(), parse_mode="Markdown"
-        )
 
-    if data.startswith("PRAY:w:"):
-        city_en = data[7:]
-        city_ar = next((k for k,v in WILAYAS.items() if v == city_en), city_en)
-        await q.message.edit_text("⏳ جاري جلب مواقيت الصلاة...")
-        timings, date_str = await fetch_prayer_times(city_en)
-        if not timings:
-            return await q.message.edit_text(
-                "⚠️ تعذّر جلب المواقيت، حاول لاحقاً.",
-                reply_markup=kb_back("PRAY:cities")
-            )
-        text = (
-            f"🕌 *مواقيت الصلاة — {city_ar}*\n"
-            f"📅 {date_str}\n\n"
-            f"🌅 الفجر    : `{timings['Fajr']}`\n"
-            f"🌄 الشروق   : `{timings['Sunrise']}`\n"
-            f"☀️ الظهر    : `{timings['Dhuhr']}`\n"
-            f"🌤️ العصر    : `{timings['Asr']}`\n"
-            f"🌇 المغرب   : `{timings['Maghrib']}`\n"
-            f"🌙 العشاء   : `{timings['Isha']}`"
-        )
-        return await q.message.edit_text(
-            text,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔄 ولاية أخرى", callback_data="PRAY:cities")],
-                [InlineKeyboardButton("🏠 الرئيسية",   callback_data="home")],
-            ]),
-            parse_mode="Markdown"
-        )
+# ── التقويم ──────────────────────────────────────────────
 
-    # ── آية اليوم ──────────────────────────────────────────
-    if data == "AY:show":
-        ayah = AYAT_YAWM[datetime.now(TZ).timetuple().tm_yday % len(AYAT_YAWM)]
-        text = (f"📖 *آية اليوم*\n\n"
-                f"*{ayah['ref']}*\n\n"
-                f"{ayah['text']}"
-                + (f"\n\n_{ayah['note']}_" if ayah['note'] else ""))
-        return await q.message.edit_text(text, reply_markup=kb_back("home"),
-                                         parse_mode="Markdown")
-
-    # ── دعاء اليوم ──────────────────────────────────────────
-    if data == "DUA:show":
-        dua = ADYIA_YAWM[datetime.now(TZ).timetuple().tm_yday % len(ADYIA_YAWM)]
-        return await q.message.edit_text(
-            f"🤲 *دعاء اليوم*\n\n*{dua['title']}*\n\n{dua['text']}",
-            reply_markup=kb_back("home"), parse_mode="Markdown"
-        )
+async def cb_cal_home(update, context, arg):
+    cal = load_cal()
+    kb  = [[InlineKeyboardButton(k, callback_data=f"C:i:{k}")] for k in cal]
+    kb.append([InlineKeyboardButton("🏠 الرئيسية", callback_data="home")])
+    return await edit_now(update.callback_query.message,
+        "🗓️ *التقويم الجامعي*\nاختر القسم:",
+        reply_markup=InlineKeyboardMarkup(kb), parse_mode="Markdown")
 
-    # ── عداد الأذكار ──────────────────────────────────────
-    if data == "DHKR:show":
-        ud["dhkr_s"] = 0; ud["dhkr_h"] = 0; ud["dhkr_a"] = 0
-        return await q.message.edit_text(
-            "📿 *عداد الأذكار*\n\nاضغط لزيادة العداد:",
-            reply_markup=kb_dhikr(0, 0, 0), parse_mode="Markdown"
-        )
+async def cb_cal_item(update, context, arg):
+    cal = load_cal()
+    return await edit_now(update.callback_query.message,
+        f"🗓️ *{arg}*\n\n{cal.get(arg, 'لا توجد معلومات.')}",
+        reply_markup=kb_back("C:home"), parse_mode="Markdown"
+    )
 
-    if data.startswith("DHKR:+:"):
-        t = data[-1]
-        s = ud.get("dhkr_s", 0); h = ud.get("dhkr_h", 0); a = ud.get("dhkr_a", 0)
-        if t == "s" and s < 33: s += 1; ud["dhkr_s"] = s
-        if t == "h" and h < 33: h += 1; ud["dhkr_h"] = h
-        if t == "a" and a < 34: a += 1; ud["dhkr_a"] = a
-        done = s >= 33 and h >= 33 and a >= 34
-        txt = ("📿 *عداد الأذكار*\n\n✅ *اكتمل العدد!*\nبارك الله فيك 🌿"
-               if done else "📿 *عداد الأذكار*\n\nاضغط لزيادة العداد:")
-        try:
-            return await q.message.edit_text(
-                txt, reply_markup=kb_dhikr(s, h, a) if not done else
-                InlineKeyboardMarkup([[InlineKeyboardButton("🔄 إعادة", callback_data="DHKR:show"),
-                                        InlineKeyboardButton("🏠 الرئيسية", callback_data="home")]]),
-                parse_mode="Markdown"
-            )
-        except: pass
 
-    if data == "DHKR:reset":
-        ud["dhkr_s"] = 0; ud["dhkr_h"] = 0; ud["dhkr_a"] = 0
-        return await q.message.edit_text(
-            "📿 *عداد الأذكار*\n\nاضغط لزيادة العداد:",
-            reply_markup=kb_dhikr(0, 0, 0), parse_mode="Markdown"
-        )
+# ── مواقيت الصلاة ──────────────────────────────────────
 
-    if data == "DHKR:close":
-        return await q.message.edit_text(TXT_WELCOME, reply_markup=kb_main(),
-                                         parse_mode="Markdown")
-
-    # ── القاموس ──────────────────────────────────────────
-    if data == "TERM:home":
-        terms = load_terms()
-        if not terms:
-            return await q.message.edit_text(
-                "📚 *القاموس الفقهي*\n\nلم يُضف أي مصطلح بعد.",
-                reply_markup=kb_back("home"), parse_mode="Markdown"
-            )
-        rows = []
-        for i, term in enumerate(list(terms.keys())[:20]):
-            rows.append([InlineKeyboardButton(term, callback_data=f"TERM:t:{i}")])
-        rows.append([InlineKeyboardButton("🏠 الرئيسية", callback_data="home")])
-        return await q.message.edit_text(
-            f"📚 *القاموس الفقهي* ({len(terms)} مصطلح)\nاختر مصطلحاً:",
-            reply_markup=InlineKeyboardMarkup(rows), parse_mode="Markdown"
-        )
+async def cb_pray_cities(update, context, arg):
+    return await edit_now(update.callback_query.message,
+        "🕌 *مواقيت الصلاة*\nاختر ولايتك:",
+        reply_markup=kb_wilayas(), parse_mode="Markdown"
+    )
 
-    if data.startswith("TERM:t:"):
-        idx   = int(data[7:])
-        terms = load_terms()
-        items = list(terms.items())
-        if idx >= len(items): return
-        term, defn = items[idx]
-        return await q.message.edit_text(
-            f"📚 *{term}*\n\n{defn}",
-            reply_markup=kb_back("TERM:home"), parse_mode="Markdown"
+async def cb_pray_city(update, context, arg):
+    q       = update.callback_query
+    city_en = arg
+    city_ar = next((k for k,v in WILAYAS.items() if v == city_en), city_en)
+    if shedding(2):
+        return await edit_now(q.message, SHED_NOTICE, reply_markup=kb_back("PRAY:cities"))
+    await edit_now(q.message, "⏳ جاري جلب مواقيت الصلاة...")
+    timings, date_str = await fetch_prayer_times(city_en)
+    if not timings:
+        return await edit_now(q.message,
+            "⚠️ تعذّر جلب المواقيت، حاول لاحقاً.",
+            reply_markup=kb_back("PRAY:cities")
         )
+    text = (
+        f"🕌 *مواقيت الصلاة — {city_ar}*\n"
+        f"📅 {date_str}\n\n"
+        f"🌅 الفجر    : `{timings['Fajr']}`\n"
+        f"🌄 الشروق   : `{timings['Sunrise']}`\n"
+        f"☀️ الظهر    : `{timings['Dhuhr']}`\n"
+        f"🌤️ العصر    : `{timings['Asr']}`\n"
+        f"🌇 المغرب   : `{timings['Maghrib']}`\n"
+        f"🌙 العشاء   : `{timings['Isha']}`"
+    )
+    return await edit_now(q.message,
+        text,
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔄 ولاية أخرى", callback_data="PRAY:cities")],
+            [InlineKeyboardButton("🏠 الرئيسية",   callback_data="home")],
+        ]),
+        parse_mode="Markdown"
+    )
 
-    # ── الاستطلاع ──────────────────────────────────────────
-    if data.startswith("POLL:v:"):
-        poll = load_poll()
-        if not poll.get("active"):
-            await q.answer("الاستطلاع مغلق.", show_alert=True); return
-        choice = int(data[7:])
-        if choice >= len(poll.get("options", [])):
-            await q.answer("خيار غير صحيح.", show_alert=True); return
-        poll["votes"][str(uid)] = choice
-        save_poll(poll)
-        opt = poll["options"][choice]
-        await q.answer(f"✅ تم تسجيل صوتك: {opt}", show_alert=True)
-        # إظهار نتائج مؤقتة
-        votes = poll["votes"]; total = len(votes)
-        options = poll["options"]
-        counts = [sum(1 for v in votes.values() if v == i) for i in range(len(options))]
-        lines = [f"🗳️ *{poll['question']}*\n\nنتائج مؤقتة:\n"]
-        for i, opt in enumerate(options):
-            pct = round(counts[i]/total*100) if total else 0
-            lines.append(f"{i+1}. {opt}: {counts[i]} ({pct}%)")
-        try:
-            await q.message.edit_text(
-                "\n".join(lines),
-                reply_markup=kb_poll_vote(options),
-                parse_mode="Markdown"
-            )
-        except: pass
-        return
 
-    # ── الإعجاب ──────────────────────────────────────────
-    if data.startswith("LIKE:"):
-        key    = data[5:]
-        added, count = toggle_like(key, uid)
-        liked  = added
-        icon   = "❤️" if liked else "🤍"
-        msg_txt = "✅ أُضيف إلى إعجاباتك!" if liked else "💔 أُزيل من إعجاباتك"
-        await q.answer(msg_txt)
-        try:
-            await q.message.edit_reply_markup(
-                reply_markup=kb_like(key, count, liked)
-            )
-        except: pass
-        return
+# ── آية ودعاء اليوم ──────────────────────────────────────
 
-    # ── الملاحظات ──────────────────────────────────────────
-    if data == "NOTE:list":
-        notes = get_user_notes(uid)
-        if not notes:
-            return await q.message.edit_text(
-                "📝 *ملاحظاتي*\n\nلا توجد ملاحظات بعد.\nاضغط ➕ لإضافة ملاحظة.",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("➕ إضافة ملاحظة", callback_data="NOTE:add")],
-                    [InlineKeyboardButton("🏠 الرئيسية",      callback_data="home")],
-                ]),
-                parse_mode="Markdown"
-            )
-        rows = []
-        for i, note in enumerate(notes):
-            label = note["text"][:30] + ("..." if len(note["text"]) > 30 else "")
-            rows.append([
-                InlineKeyboardButton(f"📄 {label}", callback_data=f"NOTE:view:{i}"),
-                InlineKeyboardButton("🗑️", callback_data=f"NOTE:del:{i}"),
-            ])
-        rows += [
-            [InlineKeyboardButton("➕ إضافة ملاحظة", callback_data="NOTE:add")],
-            [InlineKeyboardButton("🏠 الرئيسية",      callback_data="home")],
-        ]
-        return await q.message.edit_text(
-            f"📝 *ملاحظاتي* ({len(notes)})\nاختر ملاحظة:",
-            reply_markup=InlineKeyboardMarkup(rows), parse_mode="Markdown"
-        )
+async def cb_ayah(update, context, arg):
+    ayah = AYAT_YAWM[datetime.now(TZ).timetuple().tm_yday % len(AYAT_YAWM)]
+    text = (f"📖 *آية اليوم*\n\n"
+            f"*{ayah['ref']}*\n\n"
+            f"{ayah['text']}"
+            + (f"\n\n_{ayah['note']}_" if ayah['note'] else ""))
+    return await edit_now(update.callback_query.message,
+        text, reply_markup=kb_back("home"), parse_mode="Markdown")
 
-    if data.startswith("NOTE:view:"):
-        idx = int(data[10:])
-        notes = get_user_notes(uid)
-        if idx >= len(notes): return
-        note = notes[idx]
-        return await q.message.edit_text(
-            f"📝 *ملاحظة #{idx+1}*\n📅 {note['date']}\n\n{note['text']}",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🗑️ حذف", callback_data=f"NOTE:del:{idx}")],
-                [InlineKeyboardButton("⬅️ رجوع", callback_data="NOTE:list")],
-            ]),
-            parse_mode="Markdown"
-        )
+async def cb_dua(update, context, arg):
+    dua = ADYIA_YAWM[datetime.now(TZ).timetuple().tm_yday % len(ADYIA_YAWM)]
+    return await edit_now(update.callback_query.message,
+        f"🤲 *دعاء اليوم*\n\n*{dua['title']}*\n\n{dua['text']}",
+        reply_markup=kb_back("home"), parse_mode="Markdown"
+    )
 
-    if data.startswith("NOTE:del:"):
-        idx = int(data[9:])
-        delete_note(uid, idx)
-        await q.answer("✅ حُذفت الملاحظة.")
-        notes = get_user_notes(uid)
-        if not notes:
-            return await q.message.edit_text(
-                "📝 *ملاحظاتي*\n\nلا توجد ملاحظات.",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("➕ إضافة ملاحظة", callback_data="NOTE:add")],
-                    [InlineKeyboardButton("🏠 الرئيسية",      callback_data="home")],
-                ]),
-                parse_mode="Markdown"
-            )
-        rows = []
-        for i, note in enumerate(notes):
-            label = note["text"][:30] + ("..." if len(note["text"]) > 30 else "")
-            rows.append([
-                InlineKeyboardButton(f"📄 {label}", callback_data=f"NOTE:view:{i}"),
-                InlineKeyboardButton("🗑️", callback_data=f"NOTE:del:{i}"),
-            ])
-        rows += [[InlineKeyboardButton("➕ إضافة ملاحظة", callback_data="NOTE:add")],
-                 [InlineKeyboardButton("🏠 الرئيسية", callback_data="home")]]
-        return await q.message.edit_text(
-            f"📝 *ملاحظاتي* ({len(notes)})\nاختر ملاحظة:",
-            reply_markup=InlineKeyboardMarkup(rows), parse_mode="Markdown"
-        )
 
-    if data == "NOTE:add":
-        ud["awaiting"] = "note_add"
-        return await q.message.edit_text(
-            "📝 *إضافة ملاحظة*\n\n✍️ اكتب ملاحظتك الآن:",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("❌ إلغاء", callback_data="NOTE:list")]
-            ]),
-            parse_mode="Markdown"
-        )
+# ── عداد الأذكار ──────────────────────────────────────
 
-    # ── الملف الشخصي ──────────────────────────────────────
-    if data == "PROF:show":
-        prof = get_student_profile(uid)
-        name = prof.get("name", "غير محدد")
-        spec = prof.get("spec", "غير محدد")
-        year = prof.get("year", "غير محددة")
-        return await q.message.edit_text(
-            f"👤 *ملفي الشخصي*\n\n"
-            f"📛 الاسم     : *{name}*\n"
-            f"🎓 التخصص   : *{spec}*\n"
-            f"📅 السنة     : *{year}*",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("✏️ تعديل الاسم",   callback_data="PROF:name")],
-                [InlineKeyboardButton("🎓 التخصص",        callback_data="PROF:spec")],
-                [InlineKeyboardButton("📅 السنة",          callback_data="PROF:year")],
-                [InlineKeyboardButton("🏠 الرئيسية",       callback_data="home")],
-            ]),
-            parse_mode="Markdown"
-        )
+async def cb_dhikr_show(update, context, arg):
+    ud = context.user_data
+    ud["dhkr_s"] = 0; ud["dhkr_h"] = 0; ud["dhkr_a"] = 0
+    return await edit_now(update.callback_query.message,
+        "📿 *عداد الأذكار*\n\nاضغط لزيادة العداد:",
+        reply_markup=kb_dhikr(0, 0, 0), parse_mode="Markdown"
+    )
 
-    if data == "PROF:name":
-        ud["awaiting"] = "profile_name"
-        return await q.message.edit_text(
-            "✏️ *تعديل الاسم*\n\nاكتب اسمك:",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("❌ إلغاء", callback_data="PROF:show")]
-            ]),
-            parse_mode="Markdown"
-        )
+async def cb_dhikr_tap(update, context, arg):
+    ud = context.user_data
+    s = ud.get("dhkr_s", 0); h = ud.get("dhkr_h", 0); a = ud.get("dhkr_a", 0)
+    if arg == "s" and s < 33: s += 1; ud["dhkr_s"] = s
+    if arg == "h" and h < 33: h += 1; ud["dhkr_h"] = h
+    if arg == "a" and a < 34: a += 1; ud["dhkr_a"] = a
+    done = s >= 33 and h >= 33 and a >= 34
+    txt = ("📿 *عداد الأذكار*\n\n✅ *اكتمل العدد!*\nبارك الله فيك 🌿"
+           if done else "📿 *عداد الأذكار*\n\nاضغط لزيادة العداد:")
+    await edit_debounced(
+        update.callback_query.message,
+        text=txt, reply_markup=kb_dhikr(s, h, a) if not done else
+        InlineKeyboardMarkup([[InlineKeyboardButton("🔄 إعادة", callback_data="DHKR:show"),
+                               InlineKeyboardButton("🏠 الرئيسية", callback_data="home")]]),
+        parse_mode="Markdown"
+    )
 
-    if data == "PROF:spec":
-        lessons = load_lessons()
-        specs   = set()
-        for yr in lessons.values():
-            for sp in yr: specs.add(sp)
-        custom_specs = ["شعبة أصول الفقه", "شعبة أصول الدين", "بدون تخصص"]
-        all_specs = list(specs) or custom_specs
-        rows = [[InlineKeyboardButton(s, callback_data=f"PROF:setspec:{s}")]
-                for s in all_specs[:10]]
-        rows.append([InlineKeyboardButton("❌ إلغاء", callback_data="PROF:show")])
-        return await q.message.edit_text(
-            "🎓 *اختر تخصصك:*",
-            reply_markup=InlineKeyboardMarkup(rows), parse_mode="Markdown"
+async def cb_dhikr_reset(update, context, arg):
+    return await cb_dhikr_show(update, context, arg)
+
+async def cb_dhikr_close(update, context, arg):
+    return await edit_now(update.callback_query.message,
+        TXT_WELCOME, reply_markup=kb_main(), parse_mode="Markdown")
+
+
+# ── القاموس ──────────────────────────────────────────
+
+# TERM:p:<صفحة> تصفّح أبجدي، TERM:i:<معرّف ثابت> عرض مصطلح، TERM:s بحث بالكتابة
+
+TERM_PAGE = 15
+
+def term_pages(tix):
+    return max((len(tix) + TERM_PAGE - 1) // TERM_PAGE, 1)
+
+def kb_terms_page(tix, page):
+    pages = term_pages(tix)
+    rows  = [[InlineKeyboardButton(tix.terms[n], callback_data=f"TERM:i:{tix.ids[n]}")]
+             for n in tix.page(page, TERM_PAGE)]
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("◀️", callback_data=f"TERM:p:{page - 1}"))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton("▶️", callback_data=f"TERM:p:{page + 1}"))
+    if nav: rows.append(nav)
+    rows += [[InlineKeyboardButton("🔎 ابحث عن مصطلح", callback_data="TERM:s")],
+             [InlineKeyboardButton("🏠 الرئيسية", callback_data="home")]]
+    return InlineKeyboardMarkup(rows)
+
+def kb_term_matches(tix, hits):
+    rows = [[InlineKeyboardButton(tix.terms[n], callback_data=f"TERM:i:{tix.ids[n]}")]
+            for n in hits]
+    rows += [[InlineKeyboardButton("🔎 بحث آخر", callback_data="TERM:s")],
+             [InlineKeyboardButton("📚 القاموس", callback_data="TERM:home")]]
+    return InlineKeyboardMarkup(rows)
+
+def term_view(tix, n):
+    page = tix.rank[n] // TERM_PAGE
+    return f"📚 *{tix.terms[n]}*\n\n{tix.defs[n]}", kb_back(f"TERM:p:{page}")
+
+async def cb_term_home(update, context, arg):
+    return await cb_term_page(update, context, "0")
+
+async def cb_term_page(update, context, arg):
+    q, tix = update.callback_query, get_term_index()
+    if not len(tix):
+        return await edit_now(q.message,
+            "📚 *القاموس الفقهي*\n\nلم يُضف أي مصطلح بعد.",
+            reply_markup=kb_back("home"), parse_mode="Markdown"
         )
+    try:    page = int(arg)
+    except ValueError: page = 0
+    pages = term_pages(tix)
+    page  = min(max(page, 0), pages - 1)
+    where = f" — صفحة {page + 1}/{pages}" if pages > 1 else ""
+    return await edit_now(q.message,
+        f"📚 *القاموس الفقهي* ({len(tix)} مصطلح){where}\nاختر مصطلحاً:",
+        reply_markup=kb_terms_page(tix, page), parse_mode="Markdown"
+    )
 
-    if data.startswith("PROF:setspec:"):
-        spec = data[13:]
-        prof = get_student_profile(uid)
-        prof["spec"] = spec
-        save_student_profile(uid, prof)
-        await q.answer("✅ تم تحديث التخصص")
-        return await handle_cb(update, context)  # won't work, need to re-call
-
-    if data == "PROF:year":
-        rows = [[InlineKeyboardButton(y, callback_data=f"PROF:setyear:{y}")]
-                for y in ["سنة أولى", "سنة ثانية", "سنة ثالثة"]]
-        rows.append([InlineKeyboardButton("❌ إلغاء", callback_data="PROF:show")])
-        return await q.message.edit_text(
-            "📅 *اختر سنتك الدراسية:*",
-            reply_markup=InlineKeyboardMarkup(rows), parse_mode="Markdown"
+async def cb_term_show(update, context, arg):
+    tix = get_term_index()
+    try:    n = tix.by_id.get(int(arg))
+    except ValueError: n = None
+    if n is None:
+        # مصطلح حُذف بعد إرسال الزر
+        return await cb_term_page(update, context, "0")
+    text, kb = term_view(tix, n)
+    return await edit_now(update.callback_query.message,
+        text, reply_markup=kb, parse_mode="Markdown")
+
+async def cb_term_search(update, context, arg):
+    context.user_data["awaiting"] = "term_search"
+    return await edit_now(update.callback_query.message,
+        "🔎 اكتب المصطلح (أو بدايته):",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ إلغاء", callback_data="TERM:home")]])
+    )
+
+
+# ── الاستطلاع والإعجاب ──────────────────────────────────
+
+async def cb_poll_vote(update, context, arg):
+    q, uid = update.callback_query, update.effective_user.id
+    pid, _, choice = arg.rpartition(":")
+    pid   = pid or "0"                # POLL:v:<i> قديم ← الاستطلاع الأول
+    polls = get_polls()
+    poll  = polls.get(pid)
+    if not poll or not poll.get("active"):
+        await q.answer("الاستطلاع مغلق.", show_alert=True); return
+    try:
+        choice = int(choice)
+    except ValueError:
+        choice = -1
+    if not 0 <= choice < len(poll.get("options", [])):
+        await q.answer("خيار غير صحيح.", show_alert=True); return
+    polls.vote(pid, uid, choice)
+    # النتائج المؤقتة في التنبيه نفسه بدل تعديل رسالة المصوّت مع كل صوت
+    counts, total = polls.counts[pid], sum(polls.counts[pid])
+    lines = [f"✅ تم تسجيل صوتك: {poll['options'][choice]}", ""]
+    lines += [f"{opt[:25]}: {round(c / total * 100)}%"
+              for opt, c in zip(poll["options"], counts)]
+    await q.answer("\n".join(lines)[:200], show_alert=True)
+
+async def cb_like(update, context, arg):
+    q = update.callback_query
+    added, count = toggle_like(arg, update.effective_user.id)
+    record_like(get_catalog(), arg, count)
+    await q.answer("✅ أُضيف إلى إعجاباتك!" if added else "💔 أُزيل من إعجاباتك")
+    markup = current_markup(q.message)
+    await edit_debounced(q.message,
+                         reply_markup=kb_like_replace(markup, arg, count, added) if markup
+                                      else kb_like(arg, count, added))
+
+
+# ── الملاحظات ──────────────────────────────────────────
+
+async def cb_note_list(update, context, arg):
+    q     = update.callback_query
+    notes = get_user_notes(update.effective_user.id)
+    if not notes:
+        return await edit_now(q.message,
+            "📝 *ملاحظاتي*\n\nلا توجد ملاحظات بعد.\nاضغط ➕ لإضافة ملاحظة.",
+            reply_markup=kb_notes([]), parse_mode="Markdown"
         )
+    return await edit_now(q.message,
+        f"📝 *ملاحظاتي* ({len(notes)})\nاختر ملاحظة:",
+        reply_markup=kb_notes(notes), parse_mode="Markdown"
+    )
 
-    if data.startswith("PROF:setyear:"):
-        year = data[13:]
-        prof = get_student_profile(uid)
-        prof["year"] = year
-        save_student_profile(uid, prof)
-        await q.answer("✅ تم تحديث السنة")
-        prof_disp = get_student_profile(uid)
-        return await q.message.edit_text(
-            f"👤 *ملفي الشخصي*\n\n"
-            f"📛 الاسم   : *{prof_disp.get('name','غير محدد')}*\n"
-            f"🎓 التخصص : *{prof_disp.get('spec','غير محدد')}*\n"
-            f"📅 السنة   : *{prof_disp.get('year','غير محددة')}*",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("✏️ تعديل الاسم", callback_data="PROF:name")],
-                [InlineKeyboardButton("🎓 التخصص",      callback_data="PROF:spec")],
-                [InlineKeyboardButton("📅 السنة",        callback_data="PROF:year")],
-                [InlineKeyboardButton("🏠 الرئيسية",     callback_data="home")],
-            ]),
-            parse_mode="Markdown"
+async def cb_note_view(update, context, arg):
+    idx   = int(arg)
+    notes = get_user_notes(update.effective_user.id)
+    if idx >= len(notes): return
+    note = notes[idx]
+    return await edit_now(update.callback_query.message,
+        f"📝 *ملاحظة #{idx+1}*\n📅 {note['date']}\n\n{note['text']}",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🗑️ حذف", callback_data=f"NOTE:del:{idx}")],
+            [InlineKeyboardButton("⬅️ رجوع", callback_data="NOTE:list")],
+        ]),
+        parse_mode="Markdown"
+    )
+
+async def cb_note_del(update, context, arg):
+    q, uid = update.callback_query, update.effective_user.id
+    delete_note(uid, int(arg))
+    await q.answer("✅ حُذفت الملاحظة.")
+    notes = get_user_notes(uid)
+    if not notes:
+        return await edit_now(q.message,
+            "📝 *ملاحظاتي*\n\nلا توجد ملاحظات.",
+            reply_markup=kb_notes([]), parse_mode="Markdown"
         )
+    return await edit_now(q.message,
+        f"📝 *ملاحظاتي* ({len(notes)})\nاختر ملاحظة:",
+        reply_markup=kb_notes(notes), parse_mode="Markdown"
+    )
+
+async def cb_note_add(update, context, arg):
+    context.user_data["awaiting"] = "note_add"
+    return await edit_now(update.callback_query.message,
+        "📝 *إضافة ملاحظة*\n\n✍️ اكتب ملاحظتك الآن:",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("❌ إلغاء", callback_data="NOTE:list")]
+        ]),
+        parse_mode="Markdown"
+    )
+
+
+# ── الملف الشخصي ──────────────────────────────────────
+
+async def cb_prof_show(update, context, arg):
+    prof = get_student_profile(update.effective_user.id)
+    return await edit_now(update.callback_query.message,
+        txt_profile(prof), reply_markup=kb_profile(), parse_mode="Markdown")
+
+async def cb_prof_name(update, context, arg):
+    context.user_data["awaiting"] = "profile_name"
+    return await edit_now(update.callback_query.message,
+        "✏️ *تعديل الاسم*\n\nاكتب اسمك:",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("❌ إلغاء", callback_data="PROF:show")]
+        ]),
+        parse_mode="Markdown"
+    )
+
+async def cb_prof_spec(update, context, arg):
+    specs = set()
+    for yr in load_lessons().values():
+        for sp in yr: specs.add(sp)
+    custom_specs = ["شعبة أصول الفقه", "شعبة أصول الدين", "بدون تخصص"]
+    all_specs = list(specs) or custom_specs
+    rows = [[InlineKeyboardButton(s, callback_data=f"PROF:setspec:{s}")]
+            for s in all_specs[:10]]
+    rows.append([InlineKeyboardButton("❌ إلغاء", callback_data="PROF:show")])
+    return await edit_now(update.callback_query.message,
+        "🎓 *اختر تخصصك:*",
+        reply_markup=InlineKeyboardMarkup(rows), parse_mode="Markdown"
+    )
+
+async def cb_prof_year(update, context, arg):
+    rows = [[InlineKeyboardButton(y, callback_data=f"PROF:setyear:{y}")]
+            for y in ["سنة أولى", "سنة ثانية", "سنة ثالثة"]]
+    rows.append([InlineKeyboardButton("❌ إلغاء", callback_data="PROF:show")])
+    return await edit_now(update.callback_query.message,
+        "📅 *اختر سنتك الدراسية:*",
+        reply_markup=InlineKeyboardMarkup(rows), parse_mode="Markdown"
+    )
 
-    if data.startswith("PROF:setspec:"):
-        spec = data[13:]
+def cb_prof_set(field, notice):
+    async def handler(update, context, arg):
+        q, uid = update.callback_query, update.effective_user.id
         prof = get_student_profile(uid)
-        prof["spec"] = spec
+        prof[field] = arg
         save_student_profile(uid, prof)
-        await q.answer("✅ تم تحديث التخصص")
-        prof_disp = get_student_profile(uid)
-        return await q.message.edit_text(
-            f"👤 *ملفي الشخصي*\n\n"
-            f"📛 الاسم   : *{prof_disp.get('name','غير محدد')}*\n"
-            f"🎓 التخصص : *{spec}*\n"
-            f"📅 السنة   : *{prof_disp.get('year','غير محددة')}*",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("✏️ تعديل الاسم", callback_data="PROF:name")],
-                [InlineKeyboardButton("🎓 التخصص",      callback_data="PROF:spec")],
-                [InlineKeyboardButton("📅 السنة",        callback_data="PROF:year")],
-                [InlineKeyboardButton("🏠 الرئيسية",     callback_data="home")],
-            ]),
-            parse_mode="Markdown"
-        )
+        await q.answer(notice)
+        return await edit_now(q.message,
+            txt_profile(prof), reply_markup=kb_profile(), parse_mode="Markdown")
+    return handler
+
+
+# ── المساعد الذكي واقتراح درس ─────────────────────────────
+
+async def cb_ai_show(update, context, arg):
+    if shedding(2):
+        return await edit_now(update.callback_query.message,
+            SHED_NOTICE, reply_markup=kb_back("home"))
+    context.user_data["awaiting"] = "ai_question"
+    return await edit_now(update.callback_query.message,
+        "🤖 *المساعد الذكي*\n\n"
+        "مرحباً! أنا مساعدك العلمي المتخصص في الدراسات الإسلامية.\n\n"
+        "يمكنني مساعدتك في:\n"
+        "📖 الفقه وأصول الفقه\n"
+        "📜 الحديث النبوي وعلومه\n"
+        "🌟 التفسير والقرآن الكريم\n"
+        "🕌 العقيدة الإسلامية\n"
+        "📚 التاريخ الإسلامي\n"
+        "🔤 شرح المصطلحات الصعبة\n\n"
+        "✍️ *اكتب سؤالك الآن:*",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("❌ إلغاء", callback_data="home")]
+        ]),
+        parse_mode="Markdown"
+    )
 
-    # ── المساعد الذكي ─────────────────────────────────────────
-    if data == "AI:show":
-        ud["awaiting"] = "ai_question"
-        return await q.message.edit_text(
-            "🤖 *المساعد الذكي*\n\n"
-            "مرحباً! أنا مساعدك العلمي المتخصص في الدراسات الإسلامية.\n\n"
-            "يمكنني مساعدتك في:\n"
-            "📖 الفقه وأصول الفقه\n"
-            "📜 الحديث النبوي وعلومه\n"
-            "🌟 التفسير والقرآن الكريم\n"
-            "🕌 العقيدة الإسلامية\n"
-            "📚 التاريخ الإسلامي\n"
-            "🔤 شرح المصطلحات الصعبة\n\n"
-            "✍️ *اكتب سؤالك الآن:*",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("❌ إلغاء", callback_data="home")]
-            ]),
-            parse_mode="Markdown"
-        )
+async def cb_suggest(update, context, arg):
+    context.user_data["awaiting"] = "suggest"
+    return await edit_now(update.callback_query.message,
+        "💬 *اقتراح درس*\n\n"
+        "✍️ اكتب اسم المادة والسداسي والسنة وأي تفاصيل مفيدة:",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("❌ إلغاء", callback_data="home")]
+        ]),
+        parse_mode="Markdown"
+    )
 
-    # ── اقتراح درس ──────────────────────────────────────────
-    if data == "SUG:start":
-        ud["awaiting"] = "suggest"
-        return await q.message.edit_text(
-            "💬 *اقتراح درس*\n\n"
-            "✍️ اكتب اسم المادة والسداسي والسنة وأي تفاصيل مفيدة:",
+
+# ── تنقل الدروس ──────────────────────────────────────────
+# كل الحالة في callback_data: D:n:<id> لأي عقدة، D:cat:<مادة>:<تصفية>
+
+async def cb_d_years(update, context, arg):
+    context.user_data.clear()
+    return await edit_now(update.callback_query.message,
+        "📘 اختر السنة الدراسية:", reply_markup=kb_years(get_catalog()))
+
+async def cb_d_node(update, context, arg):
+    q, cat = update.callback_query, get_catalog()
+    try:    nid = int(arg)
+    except ValueError: nid = -1
+    if not cat.has(nid) or nid == ROOT_ID:
+        # زر قديم لعنصر حُذف أو من قبل التحديث
+        return await cb_d_years(update, context, "")
+    lvl = cat.level[nid]
+    if lvl == LVL_FILE:
+        return await send_lesson(q.message, cat, nid, update.effective_user.id)
+    if lvl == LVL_YEAR:
+        return await edit_now(q.message,
+            f"📙 *{cat.name[nid]}*\nاختر التخصص:",
+            reply_markup=kb_specs(cat, nid), parse_mode="Markdown")
+    if lvl == LVL_SPEC:
+        year, spec = cat.path(nid)
+        return await edit_now(q.message,
+            f"📗 *{year}  ·  {spec}*\nاختر السداسي:",
+            reply_markup=kb_sems(cat, nid), parse_mode="Markdown")
+    if lvl == LVL_SEM:
+        return await edit_now(q.message,
+            f"📚 *{cat.name[nid]}*\nاختر المادة:",
+            reply_markup=kb_subjects(cat, nid), parse_mode="Markdown")
+    return await show_subject(q.message, cat, nid, "all")
+
+async def show_subject(message, cat, subj_id, cat_filter):
+    subj = cat.name[subj_id]
+    if not cat.count(subj_id):
+        return await edit_now(message,
+            f"📭 لا توجد دروس بعد في مادة *{subj}*",
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("❌ إلغاء", callback_data="home")]
+                [InlineKeyboardButton("💬 اقتراح إضافة هذا الدرس", callback_data="SUG:start")],
+                [InlineKeyboardButton("⬅️ رجوع", callback_data=d_back(cat, subj_id))],
+                [InlineKeyboardButton("🏠 الرئيسية", callback_data="home")],
             ]),
             parse_mode="Markdown"
         )
+    return await edit_now(message,
+        f"📖 *{subj}*\nاختر الدرس:",
+        reply_markup=kb_files(cat, subj_id, cat_filter),
+        parse_mode="Markdown"
+    )
 
-    # ── تنقل الدروس ──────────────────────────────────────────
-    lessons = load_lessons()
-
-    if data == "D:years":
-        ud.clear()
-        return await q.message.edit_text("📘 اختر السنة الدراسية:",
-                                         reply_markup=kb_years(lessons))
-
-    if data.startswith("D:y:"):
-        idx = int(data[4:]); keys = list(lessons.keys())
-        if idx >= len(keys): return
-        ud["year"] = keys[idx]
-        return await q.message.edit_text(
-            f"📙 *{ud['year']}*\nاختر التخصص:",
-            reply_markup=kb_specs(lessons, ud["year"]), parse_mode="Markdown"
-        )
+async def cb_d_cat(update, context, arg):
+    cat = get_catalog()
+    subj_s, _, cat_f = arg.partition(":")
+    try:    subj_id = int(subj_s)
+    except ValueError: subj_id = -1
+    if not cat.has(subj_id) or cat.level[subj_id] != LVL_SUBJ:
+        return await cb_d_years(update, context, "")
+    return await show_subject(update.callback_query.message, cat, subj_id, cat_f or "all")
+
+# ── البحث ───────────────────────────────────────────────
+# SR:p:<صفحة> — نص الاستعلام في user_data["search_q"] (callback_data محدود بـ 64 بايت)
+
+TXT_SEARCH_PROMPT = "🔎 اكتب كلمة أو أكثر من عنوان الدرس أو اسم المادة:"
+
+def kb_search_cancel():
+    return InlineKeyboardMarkup([[InlineKeyboardButton("❌ إلغاء", callback_data="home")]])
+
+def search_view(cat, query, page):
+    """نص صفحة النتائج ولوحتها — الأزرار تفتح الدرس مباشرة (D:n:<id>)"""
+    hits = cat.index.search(query, SEARCH_LIMIT + 1)    # الزائد يعني أن هناك المزيد
+    more = len(hits) > SEARCH_LIMIT
+    hits = hits[:SEARCH_LIMIT]
+    if not hits:
+        return (f"🔎 لا نتائج لـ «{query}»\nجرّب كلمة أقصر أو بلا ال التعريف.",
+                InlineKeyboardMarkup([
+                    [InlineKeyboardButton("🔎 بحث جديد", callback_data="SR:start")],
+                    [InlineKeyboardButton("🏠 الرئيسية", callback_data="home")],
+                ]))
+    pages = (len(hits) + SEARCH_PAGE - 1) // SEARCH_PAGE
+    page  = min(max(page, 0), pages - 1)
+    start = page * SEARCH_PAGE
+    lines = [f"🔎 «{query}» — {len(hits)}{'+' if more else ''} نتيجة"
+             + (f"  ({page + 1}/{pages})" if pages > 1 else "") + "\n"]
+    rows  = []
+    for i, nid in enumerate(hits[start:start + SEARCH_PAGE], start + 1):
+        les = cat.lesson[nid]
+        lines.append(f"{i}. {cat_icon(CATS[les.cat])} {les.title}\n    📚 {les.subj}")
+        rows.append([InlineKeyboardButton(f"{i}. {les.title}"[:60], callback_data=f"D:n:{nid}")])
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("◀️ السابق", callback_data=f"SR:p:{page - 1}"))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton("التالي ▶️", callback_data=f"SR:p:{page + 1}"))
+    if nav: rows.append(nav)
+    rows += [[InlineKeyboardButton("🔎 بحث جديد", callback_data="SR:start")],
+             [InlineKeyboardButton("🏠 الرئيسية", callback_data="home")]]
+    return "\n".join(lines), InlineKeyboardMarkup(rows)
 
-    if data == "D:specs":
-        for k in ("spec","sem","subj","items"): ud.pop(k, None)
-        return await q.message.edit_text(
-            f"📙 *{ud.get('year','')}*\nاختر التخصص:",
-            reply_markup=kb_specs(lessons, ud.get("year","")), parse_mode="Markdown"
-        )
+async def cb_search_start(update, context, arg):
+    context.user_data["awaiting"] = "search"
+    return await edit_now(update.callback_query.message,
+        TXT_SEARCH_PROMPT, reply_markup=kb_search_cancel())
 
-    if data.startswith("D:s:"):
-        idx = int(data[4:]); year = ud.get("year")
-        if not year: return
-        keys = list(lessons[year].keys())
-        if idx >= len(keys): return
-        ud["spec"] = keys[idx]
-        return await q.message.edit_text(
-            f"📗 *{ud['year']}  ·  {ud['spec']}*\nاختر السداسي:",
-            reply_markup=kb_sems(lessons, year, ud["spec"]), parse_mode="Markdown"
-        )
+async def cb_search_page(update, context, arg):
+    query = context.user_data.get("search_q")
+    if not query:
+        return await cb_search_start(update, context, "")
+    try:    page = int(arg)
+    except ValueError: page = 0
+    text, kb = search_view(get_catalog(), query, page)
+    return await edit_now(update.callback_query.message, text, reply_markup=kb)
 
-    if data == "D:sems":
-        for k in ("sem","subj","items"): ud.pop(k, None)
-        return await q.message.edit_text(
-            f"📗 *{ud.get('year','')}  ·  {ud.get('spec','')}*\nاختر السداسي:",
-            reply_markup=kb_sems(lessons, ud.get("year",""), ud.get("spec","")),
-            parse_mode="Markdown"
-        )
+MEDIA_GROUP_MAX = 10
 
-    if data.startswith("D:sm:"):
-        idx = int(data[5:]); year = ud.get("year"); spec = ud.get("spec")
-        if not (year and spec): return
-        keys = list(lessons[year][spec].keys())
-        if idx >= len(keys): return
-        ud["sem"] = keys[idx]
-        return await q.message.edit_text(
-            f"📚 *{ud['sem']}*\nاختر المادة:",
-            reply_markup=kb_subjects(lessons, year, spec, ud["sem"]),
-            parse_mode="Markdown"
-        )
+FLOOD_TRIES = 3
 
-    if data == "D:subjects":
-        for k in ("subj","items"): ud.pop(k, None)
-        year = ud.get("year"); spec = ud.get("spec"); sem = ud.get("sem")
-        if not (year and spec and sem): return
-        return await q.message.edit_text(
-            f"📚 *{sem}*\nاختر المادة:",
-            reply_markup=kb_subjects(lessons, year, spec, sem),
-            parse_mode="Markdown"
-        )
+async def flood_retry(send):
+    """await send() مع انتظار retry_after عند 429 وإعادة المحاولة بدل احتسابها فشلاً"""
+    for _ in range(FLOOD_TRIES - 1):
+        try:
+            return await send()
+        except RetryAfter as e:
+            await asyncio.sleep(e.retry_after + 0.5)
+    return await send()
+
+async def cb_d_all(update, context, arg):
+    """إرسال دروس المادة (حسب التصفية) في مجموعات وسائط من 10"""
+    q, cat = update.callback_query, get_catalog()
+    subj_s, _, cat_f = arg.partition(":")
+    try:    subj_id = int(subj_s)
+    except ValueError: subj_id = -1
+    if not cat.has(subj_id) or cat.level[subj_id] != LVL_SUBJ:
+        return await cb_d_years(update, context, "")
+    lessons = list(subject_lessons(cat, subj_id, cat_f or "all"))
+    if not lessons:
+        return await show_subject(q.message, cat, subj_id, "all")
+    record_open(*lessons)
+    docs    = [les for les in lessons if not is_url(les.value)]
+    links   = [les for les in lessons if is_url(les.value)]
+    failed  = 0
+    for i in range(0, len(docs), MEDIA_GROUP_MAX):
+        chunk = docs[i:i + MEDIA_GROUP_MAX]
+        try:
+            if len(chunk) == 1:
+                await flood_retry(lambda: q.message.reply_document(
+                    document=chunk[0].value, caption=f"📄 {chunk[0].title}"))
+            else:
+                await flood_retry(lambda: q.message.reply_media_group(media=[
+                    InputMediaDocument(media=les.value, caption=f"📄 {les.title}")
+                    for les in chunk]))
+        except BadRequest:
+            # file_id منتهٍ يُسقط المجموعة كلها ← إرسال الدفعة ملفاً ملفاً
+            for les in chunk:
+                try:
+                    await flood_retry(lambda: q.message.reply_document(
+                        document=les.value, caption=f"📄 {les.title}"))
+                except Exception as e:
+                    print(f"⚠️ d_all {les.title}: {e}")
+                    failed += 1
+        except Exception as e:
+            print(f"⚠️ d_all {cat.name[subj_id]} ({len(chunk)} ملف): {e}")
+            failed += len(chunk)
+    if links:
+        await q.message.reply_text(
+            "\n\n".join(f"🔗 {les.title}\n{les.value}" for les in links),
+            disable_web_page_preview=True)
+    note = f"\n⚠️ تعذّر إرسال {failed} ملف." if failed else ""
+    await q.message.reply_text(
+        f"📚 {cat.name[subj_id]} — {len(lessons)} درس{note}\nهل أفادتك هذه الدروس؟",
+        reply_markup=kb_like_many(lessons, update.effective_user.id))
+
+# TOP:<l|o>:<عقدة> — 0 للكل، أو سداسي، أو مادة
+
+async def cb_top(update, context, arg):
+    cat = get_catalog()
+    metric, _, nid_s = arg.partition(":")
+    metric = metric if metric in METRICS else "l"
+    try:    nid = int(nid_s or 0)
+    except ValueError: nid = ROOT_ID
+    scope = node_scope(cat, nid) if cat.has(nid) else None
+    if scope is None:
+        nid, scope = ROOT_ID, ""
+    where = "" if nid == ROOT_ID else f" — {cat.name[nid]}"
+    unit  = "❤️" if metric == "l" else "📥"
+    items = popular_lessons(cat, metric, scope)
+    rows  = [[InlineKeyboardButton(f"{unit} {v} · {les.title}"[:60], callback_data=f"D:n:{les.id}")]
+             for les, v in items]
+    rows.append([InlineKeyboardButton(("• " if k == metric else "") + label,
+                                      callback_data=f"TOP:{k}:{nid}")
+                 for k, label in METRICS.items()])
+    rows += [[InlineKeyboardButton("⬅️ رجوع", callback_data="home" if nid == ROOT_ID else f"D:n:{nid}")],
+             [InlineKeyboardButton("🏠 الرئيسية", callback_data="home")]]
+    return await edit_now(update.callback_query.message,
+        f"🔥 *الأكثر فائدة{where}*\n"
+        + ("الدروس الأكثر " + METRICS[metric].split()[1] if items else "لا توجد بيانات بعد."),
+        reply_markup=InlineKeyboardMarkup(rows), parse_mode="Markdown")
+
+async def send_lesson(message, cat, nid, uid):
+    les   = cat.lesson[nid]
+    record_open(les)
+    title, fid, lkey = les.title, les.value, les.like_key
+    count = get_like_count(lkey)
+    liked = user_liked(lkey, uid)
+    if is_url(fid):
+        await message.reply_text(f"🔗 {fid}")
+    else:
+        try:
+            await message.reply_document(document=fid, caption=f"📄 {title}")
+        except BadRequest:
+            await message.reply_text("⚠️ الملف غير متاح (file_id منتهي).")
+            return
+        except Exception:
+            await message.reply_text("⚠️ حدث خطأ أثناء الإرسال.")
+            return
+    # إرسال زر الإعجاب
+    await message.reply_text(
+        f"هل أفادك هذا الدرس؟",
+        reply_markup=kb_like(lkey, count, liked)
+    )
 
-    if data.startswith("D:sb:"):
-        idx = int(data[5:]); year = ud.get("year")
-        spec = ud.get("spec"); sem = ud.get("sem")
-        if not (year and spec and sem): return
-        keys = list(lessons[year][spec][sem].keys())
-        if idx >= len(keys): return
-        subj  = keys[idx]
-        items = lessons[year][spec][sem][subj]
-        ud["subj"] = subj; ud["items"] = items; ud["cat_filter"] = "all"
-        if not items:
-            return await q.message.edit_text(
-                f"📭 لا توجد دروس بعد في مادة *{subj}*",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("💬 اقتراح إضافة هذا الدرس", callback_data="SUG:start")],
-                    [InlineKeyboardButton("⬅️ رجوع", callback_data="D:subjects")],
-                    [InlineKeyboardButton("🏠 الرئيسية", callback_data="home")],
-                ]),
-                parse_mode="Markdown"
-            )
-        return await q.message.edit_text(
-            f"📖 *{subj}*\nاختر الدرس:",
-            reply_markup=kb_files(items, year, spec, sem, subj, "all"),
-            parse_mode="Markdown"
-        )
 
-    if data.startswith("D:cat:"):
-        cat_f = data[6:]; year = ud.get("year")
-        spec = ud.get("spec"); sem = ud.get("sem"); subj = ud.get("subj")
-        items = ud.get("items", [])
-        if not items: return
-        ud["cat_filter"] = cat_f
-        return await q.message.edit_text(
-            f"📖 *{subj}*\nاختر الدرس:",
-            reply_markup=kb_files(items, year, spec, sem, subj, cat_f),
-            parse_mode="Markdown"
-        )
+# ── جدول التوجيه ──────────────────────────────────────────
+# المفتاح = أول مقطعين من callback_data ("D:f") أو المقطع الأول فقط
+# ("LIKE")؛ الباقي يُمرَّر كوسيط للمعالج.
+
+CB_ROUTES = {
+    "D:n":          cb_d_node,
+    "D:cat":        cb_d_cat,
+    "D:all":        cb_d_all,
+    "TOP":          cb_top,
+    "D:years":      cb_d_years,
+    # أزرار التنقل القديمة (فهارس موضعية) ← إعادة من البداية
+    "D":            cb_d_years,
+    "home":         cb_home,
+    "REFRESH":      cb_refresh,
+    "H:show":       cb_help,
+    "NOTIFYYES":    cb_notify_yes,
+    "NOTIFYNO":     cb_notify_no,
+    "Q:start":      cb_quiz_start,
+    "Q:a":          cb_quiz_answer,
+    "P:show":       cb_points,
+    "P:top":        cb_points_top,
+    "C:home":       cb_cal_home,
+    "C:i":          cb_cal_item,
+    "PRAY:cities":  cb_pray_cities,
+    "PRAY:w":       cb_pray_city,
+    "AY:show":      cb_ayah,
+    "DUA:show":     cb_dua,
+    "DHKR:show":    cb_dhikr_show,
+    "DHKR:+":       cb_dhikr_tap,
+    "DHKR:reset":   cb_dhikr_reset,
+    "DHKR:close":   cb_dhikr_close,
+    "TERM:home":    cb_term_home,
+    "TERM:p":       cb_term_page,
+    "TERM:i":       cb_term_show,
+    "TERM:s":       cb_term_search,
+    # أزرار القاموس القديمة (فهارس موضعية تتغير مع كل إضافة) ← الصفحة الأولى
+    "TERM:t":       cb_term_home,
+    "POLL:v":       cb_poll_vote,
+    "LIKE":         cb_like,
+    "NOTE:list":    cb_note_list,
+    "NOTE:view":    cb_note_view,
+    "NOTE:del":     cb_note_del,
+    "NOTE:add":     cb_note_add,
+    "PROF:show":    cb_prof_show,
+    "PROF:name":    cb_prof_name,
+    "PROF:spec":    cb_prof_spec,
+    "PROF:year":    cb_prof_year,
+    "PROF:setspec": cb_prof_set("spec", "✅ تم تحديث التخصص"),
+    "PROF:setyear": cb_prof_set("year", "✅ تم تحديث السنة"),
+    "AI:show":      cb_ai_show,
+    "SUG:start":    cb_suggest,
+    "SR:start":     cb_search_start,
+    "SR:p":         cb_search_page,
+}
 
-    if data.startswith("D:f:"):
-        i     = int(data[4:]); items = ud.get("items", [])
-        year  = ud.get("year"); spec = ud.get("spec")
-        sem   = ud.get("sem"); subj = ud.get("subj")
-        if not items or not (0 <= i < len(items)): return
-        item  = items[i]
-        title, fid = item[0], item[1]
-        lkey  = lesson_key(year or "", spec or "", sem or "", subj or "", i)
-        count = get_like_count(lkey)
-        liked = user_liked(lkey, uid)
-        if is_url(fid):
-            await q.message.reply_text(f"🔗 {fid}")
+# route -> Histogram (العدد = hist.n)
+CB_STATS = {}
+
+# ── حدّ الضغطات لكل مستخدم (token bucket) ──
+# CB_BURST ضغطة دفعة واحدة ثم CB_RATE في الثانية؛ الزائد يُجاب بتنبيه دون تنفيذ.
+# عدّاد الأذكار مستثنى: ضغطاته محلية وتعديلاته مؤجَّلة فلا تُفقد.
+CB_RATE       = float(os.environ.get("CB_RATE", "4"))
+CB_BURST      = 8
+CB_FREE       = {"DHKR:+"}
+CB_SELF_ANSWER = {"POLL:v"}     # تجيب بنفسها (تنبيه بالنتيجة) — لا يُجاب عنها مسبقاً
+_CB_BUCKETS   = {}              # uid ← [رموز، آخر وقت]
+CB_LIMIT_STATS = {"limited": 0}
+
+def cb_allow(uid, now=None):
+    now = time.monotonic() if now is None else now
+    b = _CB_BUCKETS.get(uid)
+    if b is None:
+        if len(_CB_BUCKETS) > 10000:            # حذف الدلاء الممتلئة (خاملة)
+            idle = CB_BURST / CB_RATE
+            for u in [u for u, (_, t) in _CB_BUCKETS.items() if now - t > idle]:
+                del _CB_BUCKETS[u]
+        b = _CB_BUCKETS[uid] = [CB_BURST, now]
+    tokens = min(CB_BURST, b[0] + (now - b[1]) * CB_RATE)
+    b[1] = now
+    if tokens < 1:
+        b[0] = tokens
+        CB_LIMIT_STATS["limited"] += 1
+        return False
+    b[0] = tokens - 1
+    return True
+
+
+# ── تعديلات مؤجَّلة للشاشات كثيرة الضغط (أذكار، إعجاب، استطلاع) ──
+# أول ضغطة تُعدِّل فوراً، وما يليها خلال EDIT_INTERVAL يُدمج في تعديل
+# واحد بآخر حالة — تعديل واحد على الأكثر لكل رسالة في كل فترة.
+# كل تعديل آخر لرسالة من callback يمر عبر edit_now: يلغي المؤجَّل أولاً
+# حتى لا يعيد الرسالةَ إلى حالة قديمة بعد الانتقال لشاشة أخرى.
+EDIT_INTERVAL = 1.0
+_EDITS        = {}              # (chat, message) ← {"last", "kw", "task", "markup"}
+EDIT_STATS    = {"requested": 0, "sent": 0}
+
+async def _send_edit(msg, kw):
+    EDIT_STATS["sent"] += 1
+    try:
+        if "text" in kw:
+            await msg.edit_text(**kw)
         else:
-            try:
-                await q.message.reply_document(document=fid, caption=f"📄 {title}")
-            except BadRequest:
-                await q.message.reply_text("⚠️ الملف غير متاح (file_id منتهي).")
-                return
-            except Exception:
-                await q.message.reply_text("⚠️ حدث خطأ أثناء الإرسال.")
-                return
-        # إرسال زر الإعجاب
-        await q.message.reply_text(
-            f"هل أفادك هذا الدرس؟",
-            reply_markup=kb_like(lkey, count, liked)
-        )
+            await msg.edit_reply_markup(**kw)
+    except BadRequest as e:
+        if "not modified" not in str(e):
+            print(f"⚠️ edit: {e}")
+    except Exception as e:
+        print(f"⚠️ edit: {e}")
+
+async def _trailing_edit(key, msg, delay):
+    # المهمة تبقى مسجَّلة أثناء الإرسال كي يستطيع edit_now إلغاءها
+    slot = _EDITS[key]
+    while slot["kw"] is not None:
+        await asyncio.sleep(delay)
+        kw, slot["kw"] = slot["kw"], None
+        slot["last"] = time.monotonic()
+        await _send_edit(msg, kw)
+        delay = EDIT_INTERVAL
+    slot["task"] = None
+
+async def edit_debounced(msg, **kw):
+    """kw كما في edit_text (مع text) أو edit_reply_markup (بدونه)"""
+    EDIT_STATS["requested"] += 1
+    key  = (msg.chat_id, msg.message_id)
+    now  = time.monotonic()
+    slot = _EDITS.get(key)
+    if slot is None or (slot["task"] is None and now - slot["last"] >= EDIT_INTERVAL):
+        if len(_EDITS) > 1000:
+            for k in [k for k, v in _EDITS.items()
+                      if v["task"] is None and now - v["last"] >= EDIT_INTERVAL]:
+                del _EDITS[k]
+        _EDITS[key] = {"last": now, "kw": None, "task": None,
+                       "markup": kw.get("reply_markup")}
+        return await _send_edit(msg, kw)
+    slot["kw"], slot["markup"] = kw, kw.get("reply_markup")
+    if slot["task"] is None:
+        slot["task"] = asyncio.create_task(
+            _trailing_edit(key, msg, slot["last"] + EDIT_INTERVAL - now))
+
+async def edit_now(msg, text, **kw):
+    """msg.edit_text بعد إلغاء أي تعديل مؤجَّل لنفس الرسالة"""
+    slot = _EDITS.get((msg.chat_id, msg.message_id))
+    if slot is not None:
+        if slot["task"] is not None:
+            slot["task"].cancel()
+        slot["kw"] = slot["task"] = None
+        slot["last"], slot["markup"] = time.monotonic(), kw.get("reply_markup")
+    return await msg.edit_text(text, **kw)
+
+def current_markup(msg):
+    """لوحة الرسالة بعد تعديلاتنا المعلّقة — reply_markup في التحديث قديمة أثناء التأجيل"""
+    slot = _EDITS.get((msg.chat_id, msg.message_id))
+    if slot is not None and slot.get("markup") is not None:
+        return slot["markup"]
+    return msg.reply_markup
+
+def route_of(data):
+    """تحليل callback_data مرة واحدة ← (route, handler, arg)"""
+    head, _, rest = data.partition(":")
+    if rest:
+        sub, _, arg = rest.partition(":")
+        route   = f"{head}:{sub}"
+        handler = CB_ROUTES.get(route)
+        if handler:
+            return route, handler, arg
+    return head, CB_ROUTES.get(head), rest
+
+
+async def handle_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    route, handler, arg = route_of(q.data or "")
+    if route not in CB_FREE and not cb_allow(update.effective_user.id):
+        await q.answer("⏳ تمهّل قليلاً…")
+        return
+    if route not in CB_SELF_ANSWER:
+        await q.answer()
+    if handler is None:
+        route = "?"
+    t0 = time.perf_counter()
+    try:
+        if handler:
+            await handler(update, context, arg)
+    finally:
+        hist = CB_STATS.get(route)
+        if hist is None:
+            hist = CB_STATS[route] = Histogram()
+        hist.observe(time.perf_counter() - t0)
+
+
+# ================================================================
+#  ٢٦-أ. البحث المضمَّن (@البوت كلمة)
+#  يصل استعلام مع كل حرف يكتبه المستخدم ← النتائج محفوظة لكل
+#  (استعلام مُطبَّع، نسخة الدروس، نسخة القاموس) وتُقسَّم بالإزاحة.
+# ================================================================
+
+INLINE_PAGE       = 20          # تيليغرام يقبل 50 نتيجة كحد أقصى لكل رد
+INLINE_CACHE_TIME = 300         # ثوانٍ — ذاكرة تيليغرام لنفس الاستعلام
+INLINE_CACHE_MAX  = 512
+INLINE_TERMS      = 5
+
+_INLINE_CACHE = OrderedDict()   # LRU: المفتاح ← قائمة النتائج كاملة
+INLINE_STATS  = {"hits": 0, "misses": 0}
+
+
+def _inline_lesson(les):
+    desc = f"{les.subj}  ·  {les.label}"
+    if is_url(les.value):
+        return InlineQueryResultArticle(
+            id=f"l{les.id}", title=les.title, description=desc, url=les.value,
+            input_message_content=InputTextMessageContent(f"📄 {les.title}\n🔗 {les.value}"))
+    return InlineQueryResultCachedDocument(
+        id=f"l{les.id}", title=les.title, description=desc,
+        document_file_id=les.value, caption=f"📄 {les.title}")
+
+def _inline_term(tix, n):
+    term, defn = tix.terms[n], tix.defs[n]
+    return InlineQueryResultArticle(
+        id=f"t{tix.ids[n]}",
+        title=f"📚 {term}", description=defn[:100],
+        input_message_content=InputTextMessageContent(f"📚 {term}\n\n{defn}"))
+
+def inline_results(query):
+    """كل نتائج الاستعلام (مصطلحات ثم دروس) — من الذاكرة إن وُجدت"""
+    cat, tix = get_catalog(), get_term_index()
+    key = (ar_normalize(" ".join(query.split())), cat.version, tix.version)
+    res = _INLINE_CACHE.get(key)
+    if res is not None:
+        INLINE_STATS["hits"] += 1
+        _INLINE_CACHE.move_to_end(key)
+        return res
+    INLINE_STATS["misses"] += 1
+    res = [_inline_term(tix, n) for n in tix.lookup(query, INLINE_TERMS)]
+    res += [_inline_lesson(cat.lesson[nid]) for nid in cat.index.search(query)]
+    _INLINE_CACHE[key] = res
+    if len(_INLINE_CACHE) > INLINE_CACHE_MAX:
+        _INLINE_CACHE.popitem(last=False)
+    return res
+
+async def handle_inline(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    iq    = update.inline_query
+    query = iq.query.strip()
+    if not query:
+        await iq.answer([], cache_time=INLINE_CACHE_TIME)
+        return
+    try:    offset = max(int(iq.offset or 0), 0)
+    except ValueError: offset = 0
+    res  = inline_results(query)
+    page = res[offset:offset + INLINE_PAGE]
+    nxt  = str(offset + INLINE_PAGE) if offset + INLINE_PAGE < len(res) else ""
+    await iq.answer(page, cache_time=INLINE_CACHE_TIME, next_offset=nxt)
 
 
 # ================================================================
@@ -1794,7 +4360,28 @@ async def handle_private(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await msg.reply_text("⚠️ حدث خطأ، حاول مجدداً.")
             return
 
+        if awaiting == "search":
+            ud["search_q"] = text
+            body, kb = search_view(get_catalog(), text, 0)
+            await msg.reply_text(body, reply_markup=kb)
+            return
+
+        if awaiting == "term_search":
+            tix = get_term_index()
+            n   = tix.exact(text)
+            if n is not None:
+                body, kb = term_view(tix, n)
+                await msg.reply_text(body, reply_markup=kb, parse_mode="Markdown")
+                return
+            hits = tix.lookup(text, TERM_PAGE)
+            await msg.reply_text(
+                f"🔎 نتائج «{text}»:" if hits else f"🔎 لا يوجد مصطلح قريب من «{text}»",
+                reply_markup=kb_term_matches(tix, hits))
+            return
+
         if awaiting == "ai_question":
+            if shedding(2):
+                await msg.reply_text(SHED_NOTICE, reply_markup=kb_back("home")); return
             # إظهار مؤشر الكتابة
             await context.bot.send_chat_action(
                 chat_id=update.effective_chat.id,
@@ -1814,6 +4401,14 @@ async def handle_private(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
 
+    # ── المشرف: ملفات دفعة /importdars ──
+    batch = _IMPORTS.get(user.id)
+    if batch is not None and user.id in ADMIN_IDS and msg and msg.document:
+        name  = os.path.splitext(msg.document.file_name or "")[0]
+        title = (msg.caption or name or f"ملف {len(batch['items']) + 1}").strip()
+        batch["items"].append([title, msg.document.file_id])
+        return
+
     # ── المشرف: file_id تلقائي ──
     if user.id in ADMIN_IDS:
         if msg and msg.document:
@@ -1879,6 +4474,210 @@ async def handle_admin_reply(update: Update, context: ContextTypes.DEFAULT_TYPE)
         print(f"⚠️ reply error: {e}")
 
 
+# ================================================================
+#  ٢٨-أ. المعالجة المتزامنة مع ترتيب لكل مستخدم
+# ================================================================
+
+def _update_key(update):
+    """مفتاح التسلسل: المستخدم (user_data وحالة awaiting) وإلا المحادثة"""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+
+class BoundedUpdateQueue(asyncio.Queue):
+    """طابور التحديثات مع حدّ للعمل الجاري.
+
+    مع التوازي يسحب PTB كل تحديث من الطابور فوراً ويبدأ له مهمة، فيبقى
+    الطابور فارغاً وتتراكم المهام بلا حد. هنا get ينتظر خانة قبل تسليم
+    التحديث، وtask_done (يستدعيه PTB بعد انتهاء معالجته) يحرّرها — فيمتلئ
+    الطابور فعلاً عند الضغط ويرفض الـ webhook بـ 503.
+
+    التحديث الذي ينتظر دور مستخدمه (park) يعيد خانته حتى لا يوقف تراكمُ
+    مستخدم واحد بقيةَ الطلاب؛ عدد هؤلاء المنتظرين محدود بـ parked_max.
+    """
+
+    def __init__(self, maxsize, inflight_max, parked_max=None):
+        super().__init__(maxsize)
+        self.inflight_max = inflight_max
+        self.parked_max   = maxsize if parked_max is None else parked_max
+        self.inflight     = 0
+        self.parked       = 0
+        self._owed        = 0       # أُلغيت قبل استعادة خانتها: task_done لا يحرّر لها
+        self._slots       = asyncio.Semaphore(inflight_max)
+
+    async def get(self):
+        await self._slots.acquire()
+        try:
+            item = await super().get()
+        except BaseException:
+            self._slots.release()
+            raise
+        self.inflight += 1
+        return item
+
+    def task_done(self):
+        super().task_done()
+        if self._owed:
+            self._owed -= 1
+        elif self.inflight:         # عند الإيقاف يفرّغ PTB الطابور بـ get_nowait
+            self.inflight -= 1
+            self._slots.release()
+
+    async def park(self, lock):
+        """انتظار قفل المستخدم دون حجز خانة، ثم استعادة خانة قبل المعالجة"""
+        if self.parked >= self.parked_max or not self.inflight:
+            return await lock.acquire()     # امتلأ حد المنتظرين: يبقى حاجزاً خانته
+        self.parked   += 1
+        self.inflight -= 1
+        self._slots.release()
+        try:
+            await lock.acquire()
+        except BaseException:
+            self._owed += 1
+            raise
+        finally:
+            self.parked -= 1
+        try:
+            await self._slots.acquire()
+        except BaseException:
+            lock.release()
+            self._owed += 1
+            raise
+        self.inflight += 1
+
+class ChatOrderedProcessor(BaseUpdateProcessor):
+    """تحديثات المستخدمين المختلفين تُعالج بالتوازي، وتحديثات المستخدم
+    الواحد تُعالج واحداً تلو الآخر بترتيب وصولها.
+
+    القفل يُؤخذ قبل الـ semaphore حتى لا يحجز مستخدم كثير الضغط
+    عدة خانات عمل وهو ينتظر نفسه، وللسبب نفسه يعيد المنتظرُ خانتَه في
+    الطابور (queue.park) إلى أن يحين دوره.
+    """
+
+    def __init__(self, max_concurrent_updates, queue=None):
+        super().__init__(max_concurrent_updates)
+        self._queue = queue
+        self._locks = {}            # key -> [Lock, عدد المنتظرين]
+
+    async def process_update(self, update, coroutine):
+        key = _update_key(update)
+        if key is None:
+            return await super().process_update(update, coroutine)
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        lock = entry[0]
+        try:
+            if lock.locked() and self._queue is not None:
+                await self._queue.park(lock)
+            else:
+                await lock.acquire()
+            try:
+                await super().process_update(update, coroutine)
+            finally:
+                lock.release()
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+# ================================================================
+#  ٢٦-ب. تسجيل النشاط
+# ================================================================
+
+def feature_of(update):
+    """اسم الميزة لعدّاد التفاعلات: مسار الكولباك أو الأمر أو نوع التحديث"""
+    if update.callback_query:
+        return route_of(update.callback_query.data or "")[0]
+    if update.inline_query:
+        return "inline"
+    msg = update.message
+    if msg is None:
+        return None
+    text = msg.text or ""
+    if text.startswith("/"):
+        return text.split(None, 1)[0].split("@", 1)[0]
+    return "msg"
+
+async def track_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    get_stats().touch(user.id if user else None, feature_of(update))
+    chat = update.effective_chat
+    if chat is not None and chat.type == "private":
+        # أول ظهور ← add_user يعدّه جديداً إن لم يكن في القائمة؛
+        # عائد بعد التنظيف ← يُعاد لقائمة الإرسال دون عدّه جديداً
+        back = get_last_seen().touch(chat.id)
+        if back is not False:
+            add_user(chat.id, new=back is None)
+
+
+# ================================================================
+#  ٢٦-ج. قياس الأوامر وطلبات Bot API
+#  كل حدث = perf_counter مرتين + Histogram.observe (بحث ثنائي في 12 حداً).
+#  تُعرض بصيغة Prometheus في /metrics (render_webhook.py).
+# ================================================================
+
+CMD_STATS  = {}     # الأمر ← Histogram
+API_STATS  = {}     # دالة Bot API ← Histogram
+API_ERRORS = {}     # (الدالة، رمز الحالة أو نوع الاستثناء) ← عدد
+
+def timed_cmd(name, fn):
+    hist = CMD_STATS.setdefault(name, Histogram())
+    @functools.wraps(fn)
+    async def wrapper(update, context):
+        t0 = time.perf_counter()
+        try:
+            return await fn(update, context)
+        finally:
+            hist.observe(time.perf_counter() - t0)
+    return wrapper
+
+def api_label(url):
+    """…/bot<token>/<method> ← اسم الدالة؛ وغيره (تنزيل الملفات …/file/bot<token>/<path>)
+    ← "file" حتى لا تصير كل مسار ملف تسميةً في المقاييس"""
+    head, _, name = url.rpartition("/")
+    parent = head.rsplit("/", 1)[-1]
+    return name if parent.startswith("bot") and "/file/bot" not in url else "file"
+
+class MeteredRequest(HTTPXRequest):
+    """HTTPXRequest يقيس زمن كل طلب وأخطاءه حسب اسم الدالة (sendMessage، ...)"""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        name = api_label(url)
+        t0   = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception as e:
+            key = (name, type(e).__name__)
+            API_ERRORS[key] = API_ERRORS.get(key, 0) + 1
+            raise
+        finally:
+            hist = API_STATS.get(name)
+            if hist is None:
+                hist = API_STATS[name] = Histogram()
+            hist.observe(time.perf_counter() - t0)
+        if code >= 400:
+            key = (name, str(code))
+            API_ERRORS[key] = API_ERRORS.get(key, 0) + 1
+        return code, payload
+
+
 # ================================================================
 #  ٢٩. بناء التطبيق
 # ================================================================
@@ -1888,22 +4687,39 @@ def build_app() -> Application:
     if not token:
         raise RuntimeError("❌ BOT_TOKEN غير موجود.")
 
-    app = Application.builder().token(token).post_init(on_startup).build()
+    # طابور محدود وعمل جارٍ محدود: عند امتلاء الطابور يرفض الـ webhook
+    # التحديث فيعيد تيليغرام إرساله لاحقاً
+    queue_max = int(os.environ.get("UPDATE_QUEUE_MAX", "1000"))
+    inflight  = int(os.environ.get("UPDATE_INFLIGHT_MAX", "256"))
+    workers   = int(os.environ.get("UPDATE_WORKERS", "16"))
+    queue     = BoundedUpdateQueue(queue_max, inflight)
+    app = (Application.builder().token(token)
+           .request(MeteredRequest(connection_pool_size=256))
+           .update_queue(queue)
+           .concurrent_updates(ChatOrderedProcessor(workers, queue))
+           .post_init(on_startup).post_shutdown(on_shutdown).build())
+
+    # تسجيل النشاط قبل أي معالج (مجموعة -1 لا توقف بقية المعالجات)
+    app.add_handler(TypeHandler(Update, track_activity), group=-1)
 
     # أوامر عامة
     app.add_handler(CommandHandler("start",     cmd_start))
     app.add_handler(CommandHandler("ping",      cmd_ping))
+    app.add_handler(CommandHandler("search",    cmd_search))
     app.add_handler(CommandHandler("adminhelp", cmd_adminhelp))
 
     # الدروس
     app.add_handler(CommandHandler("adddars",  cmd_adddars))
     app.add_handler(CommandHandler("listdars", cmd_listdars))
     app.add_handler(CommandHandler("deldars",  cmd_deldars))
+    app.add_handler(CommandHandler("importdars", cmd_importdars))
 
     # الكويز
     app.add_handler(CommandHandler("addquiz",  cmd_addquiz))
     app.add_handler(CommandHandler("listquiz", cmd_listquiz))
     app.add_handler(CommandHandler("delquiz",  cmd_delquiz))
+    app.add_handler(CommandHandler("importquiz", cmd_importquiz))
+    app.add_handler(CommandHandler("exportquiz", cmd_exportquiz))
 
     # الاستطلاع
     app.add_handler(CommandHandler("poll",        cmd_poll,        filters=filters.Chat(ADMIN_CHAT_ID)))
@@ -1914,14 +4730,18 @@ def build_app() -> Application:
     app.add_handler(CommandHandler("addterm",  cmd_addterm))
     app.add_handler(CommandHandler("delterm",  cmd_delterm))
     app.add_handler(CommandHandler("listterms",cmd_listterms))
+    app.add_handler(CommandHandler("importterms", cmd_importterms))
+    app.add_handler(CommandHandler("exportterms", cmd_exportterms))
 
     # المجموعة فقط
     app.add_handler(CommandHandler("stats",     cmd_stats,     filters=filters.Chat(ADMIN_CHAT_ID)))
+    app.add_handler(CommandHandler("routestats", cmd_routestats))
     app.add_handler(CommandHandler("setcal",    cmd_setcal,    filters=filters.Chat(ADMIN_CHAT_ID)))
     app.add_handler(CommandHandler("broadcast", cmd_broadcast, filters=filters.Chat(ADMIN_CHAT_ID)))
 
     # الكولباك والرسائل
     app.add_handler(CallbackQueryHandler(handle_cb))
+    app.add_handler(InlineQueryHandler(handle_inline))
     app.add_handler(MessageHandler(
         filters.Chat(ADMIN_CHAT_ID) & ~filters.COMMAND, handle_admin_reply
     ))
@@ -1929,6 +4749,10 @@ def build_app() -> Application:
         filters.ChatType.PRIVATE & ~filters.COMMAND, handle_private
     ))
 
+    for h in app.handlers[0]:
+        if isinstance(h, CommandHandler):
+            h.callback = timed_cmd("/" + min(h.commands), h.callback)
+
     return app
 
 
@@ -3,18 +3,38 @@
 # ================================================================
 
 import os
+import time
+import hmac
+import json
 import asyncio
+import hashlib
 from starlette.applications import Starlette
 from starlette.responses import PlainTextResponse, Response
 from starlette.routing import Route
 import uvicorn
 
 from telegram import Update
-from bot import build_app
+import bot
+from bot import build_app, Histogram, LOAD, _clean, _load, _save, FILE_SEEN_UPD
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:             # json.loads يقبل bytes أيضاً
+    _json_loads = json.loads
 
 PORT = int(os.environ.get("PORT", "10000"))
 
 
+def get_webhook_secret():
+    """WEBHOOK_SECRET أو قيمة ثابتة مشتقة من التوكن (تبقى بعد إعادة التشغيل)"""
+    secret = _clean(os.environ.get("WEBHOOK_SECRET", ""))
+    if secret:
+        return secret
+    token = _clean(os.environ.get("BOT_TOKEN", ""))
+    return hashlib.sha256(f"webhook:{token}".encode()).hexdigest()[:48]
+
+
 def get_public_url():
     def clean(s):
         return "".join(str(s).strip().split()) if s else ""
@@ -27,16 +47,111 @@ def get_public_url():
     return base.rstrip("/")
 
 
+class UpdateDeduper:
+    """نافذة آخر N من update_id: حلقة + مجموعة — الفحص والإضافة O(1)"""
+
+    def __init__(self, size=2048, path=FILE_SEEN_UPD):
+        self.size  = size
+        self.path  = path
+        self.ring  = [None] * size
+        self.pos   = 0
+        self.seen  = set()
+        saved = _load(path, [])
+        for upd_id in (saved if isinstance(saved, list) else [])[-size:]:
+            self.add(upd_id)
+        self.dirty = False
+
+    def __contains__(self, update_id):
+        return update_id in self.seen
+
+    def add(self, update_id):
+        old = self.ring[self.pos]
+        if old is not None:
+            self.seen.discard(old)
+        self.ring[self.pos] = update_id
+        self.seen.add(update_id)
+        self.pos   = (self.pos + 1) % self.size
+        self.dirty = True
+
+    def flush(self):
+        if not self.dirty: return
+        ordered = self.ring[self.pos:] + self.ring[:self.pos]
+        _save(self.path, [u for u in ordered if u is not None])
+        self.dirty = False
+
+
+async def dedup_flush_loop(dedup, every=30):
+    while True:
+        await asyncio.sleep(every)
+        try:
+            dedup.flush()
+        except Exception as e:
+            print(f"⚠️ dedup flush: {e}")
+
+
 ptb_app = build_app()
+SECRET  = get_webhook_secret().encode()
+DEDUP   = UpdateDeduper(int(os.environ.get("DEDUP_WINDOW", "2048")))
+
+# إحصاءات الاستقبال
+INGEST = {"accepted": 0, "rejected_auth": 0, "rejected_full": 0,
+          "bad": 0, "duplicates": 0}
+INGEST_LATENCY = Histogram()
 
 
 async def webhook_handler(request):
+    t0 = time.perf_counter()
+
+    # ١) التحقق من السر قبل قراءة الجسم أو تحليله
+    got = request.headers.get("x-telegram-bot-api-secret-token", "").encode()
+    if not hmac.compare_digest(got, SECRET):
+        INGEST["rejected_auth"] += 1
+        return Response(status_code=403)
+
+    # ٢) امتلاء الطابور ← 503 فيعيد تيليغرام الإرسال لاحقاً بدل ضياع التحديث.
+    #    العمل الجاري محدود (BoundedUpdateQueue)، فلا يمتلئ الطابور إلا حين
+    #    تكون كل خانات المعالجة مشغولة فعلاً.
+    queue = ptb_app.update_queue
+    if queue.full():
+        INGEST["rejected_full"] += 1
+        return Response(status_code=503, headers={"Retry-After": "1"})
+
+    # ٣) تحليل سريع للبايتات الخام
+    try:
+        data = _json_loads(await request.body())
+    except ValueError as e:
+        INGEST["bad"] += 1
+        print(f"⚠️ webhook bad JSON: {e}")
+        return Response(status_code=400)
+
+    # ٤) إعادة إرسال من تيليغرام (مثلاً أثناء البدء البارد) ← نتجاهلها بـ 200
+    update_id = data.get("update_id") if isinstance(data, dict) else None
+    if not isinstance(update_id, int) or isinstance(update_id, bool):
+        INGEST["bad"] += 1
+        print(f"⚠️ webhook bad update_id: {update_id!r}")
+        return Response(status_code=200)
+    if update_id in DEDUP:
+        INGEST["duplicates"] += 1
+        return Response(status_code=200)
+
     try:
-        data   = await request.json()
         update = Update.de_json(data=data, bot=ptb_app.bot)
-        await ptb_app.update_queue.put(update)
     except Exception as e:
-        print(f"⚠️ webhook error: {e}")
+        # تحديث لا يمكن فكّه لن ينجح بإعادة الإرسال — نقبله ونسجّله
+        INGEST["bad"] += 1
+        print(f"⚠️ webhook bad update: {e}")
+        return Response(status_code=200)
+
+    try:
+        queue.put_nowait(update)
+    except asyncio.QueueFull:
+        INGEST["rejected_full"] += 1
+        return Response(status_code=503, headers={"Retry-After": "1"})
+
+    # يُسجَّل بعد نجاح الإدراج فقط، حتى يُقبل التحديث المرفوض عند إعادته
+    DEDUP.add(update_id)
+    INGEST["accepted"] += 1
+    INGEST_LATENCY.observe(time.perf_counter() - t0)
     return Response(status_code=200)
 
 
@@ -44,9 +159,108 @@ async def health_handler(_):
     return PlainTextResponse("OK ✅")
 
 
+async def ingest_handler(_):
+    q = ptb_app.update_queue
+    lines = [f"queue_depth {q.qsize()}", f"queue_max {q.maxsize}",
+             f"inflight {q.inflight}", f"inflight_max {q.inflight_max}"]
+    lines += [f"{k} {v}" for k, v in INGEST.items()]
+    lines += [
+        f"ingest_p50_ms {INGEST_LATENCY.quantile(0.50) * 1000:g}",
+        f"ingest_p99_ms {INGEST_LATENCY.quantile(0.99) * 1000:g}",
+        f"ingest_avg_ms {INGEST_LATENCY.total / max(INGEST_LATENCY.n, 1) * 1000:.3f}",
+        f"loop_lag_p50_ms {LOAD.lag(0.50) * 1000:.1f}",
+        f"loop_lag_p99_ms {LOAD.lag(0.99) * 1000:.1f}",
+        f"shed_level {LOAD.level}",
+    ]
+    return PlainTextResponse("\n".join(lines))
+
+
+# ── /metrics بصيغة Prometheus النصية ──
+# تُبنى عند الطلب من العدّادات الموجودة؛ لا تكلفة إضافية على مسار التحديثات.
+
+def _labels(**kv):
+    if not kv: return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in kv.items()) + "}"
+
+def _prom_hist(out, name, hist, **labels):
+    acc = 0
+    for bound, c in zip(hist.bounds, hist.counts):
+        acc += c
+        out.append(f"{name}_bucket{_labels(**labels, le=bound)} {acc}")
+    out.append(f"{name}_bucket{_labels(**labels, le='+Inf')} {hist.n}")
+    out.append(f"{name}_sum{_labels(**labels)} {hist.total:.6f}")
+    out.append(f"{name}_count{_labels(**labels)} {hist.n}")
+
+def _family(out, name, kind, help_text):
+    out.append(f"# HELP {name} {help_text}")
+    out.append(f"# TYPE {name} {kind}")
+
+def render_metrics():
+    out = []
+    q = ptb_app.update_queue
+
+    _family(out, "bot_updates_total", "counter", "Webhook updates by outcome")
+    out += [f"bot_updates_total{_labels(outcome=k)} {v}" for k, v in INGEST.items()]
+    _family(out, "bot_update_queue_depth", "gauge", "Updates waiting in the queue")
+    out.append(f"bot_update_queue_depth {q.qsize()}")
+    _family(out, "bot_update_queue_max", "gauge", "Update queue capacity")
+    out.append(f"bot_update_queue_max {q.maxsize}")
+    _family(out, "bot_updates_inflight", "gauge", "Updates taken from the queue and not finished")
+    out.append(f"bot_updates_inflight {q.inflight}")
+    _family(out, "bot_ingest_seconds", "histogram", "Webhook handler latency")
+    _prom_hist(out, "bot_ingest_seconds", INGEST_LATENCY)
+
+    _family(out, "bot_command_seconds", "histogram", "Command handler latency")
+    for name, h in list(bot.CMD_STATS.items()):
+        _prom_hist(out, "bot_command_seconds", h, command=name)
+    _family(out, "bot_callback_seconds", "histogram", "Callback route latency")
+    for route, h in list(bot.CB_STATS.items()):
+        _prom_hist(out, "bot_callback_seconds", h, route=route)
+
+    _family(out, "bot_api_seconds", "histogram", "Bot API request latency")
+    for method, h in list(bot.API_STATS.items()):
+        _prom_hist(out, "bot_api_seconds", h, method=method)
+    _family(out, "bot_api_errors_total", "counter", "Bot API errors by method and code")
+    for (method, code), n in list(bot.API_ERRORS.items()):
+        out.append(f"bot_api_errors_total{_labels(method=method, code=code)} {n}")
+
+    _family(out, "bot_broadcast_total", "counter", "Broadcast runs and messages")
+    for k, v in bot.BROADCAST_STATS.items():
+        if k != "seconds":
+            out.append(f"bot_broadcast_total{_labels(kind=k)} {v}")
+    _family(out, "bot_broadcast_seconds_total", "counter", "Time spent broadcasting")
+    out.append(f"bot_broadcast_seconds_total {bot.BROADCAST_STATS['seconds']:.3f}")
+
+    _family(out, "bot_cache_total", "counter", "Cache lookups by cache and result")
+    for cache, st in (("keyboard", bot.KB_CACHE_STATS), ("inline", bot.INLINE_STATS),
+                      ("search", bot.SEARCH_CACHE_STATS)):
+        for result in ("hits", "misses"):
+            out.append(f"bot_cache_total{_labels(cache=cache, result=result)} {st[result]}")
+
+    _family(out, "bot_edits_total", "counter", "Debounced edits requested and sent")
+    out += [f"bot_edits_total{_labels(kind=k)} {v}" for k, v in bot.EDIT_STATS.items()]
+    _family(out, "bot_callbacks_limited_total", "counter", "Callbacks dropped by the rate limit")
+    out.append(f"bot_callbacks_limited_total {bot.CB_LIMIT_STATS['limited']}")
+
+    _family(out, "bot_store_write_seconds", "histogram", "Storage flush (serialise + write) time")
+    _prom_hist(out, "bot_store_write_seconds", bot.STORE_WRITES)
+    _family(out, "bot_loop_lag_seconds", "histogram", "Event-loop wake-up lag")
+    _prom_hist(out, "bot_loop_lag_seconds", LOAD.hist)
+    _family(out, "bot_shed_level", "gauge", "Current load-shedding tier")
+    out.append(f"bot_shed_level {LOAD.level}")
+    return "\n".join(out) + "\n"
+
+
+async def metrics_handler(_):
+    return PlainTextResponse(render_metrics(),
+                             media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 web_app = Starlette(routes=[
     Route("/telegram", webhook_handler, methods=["POST"]),
     Route("/health",   health_handler,  methods=["GET"]),
+    Route("/ingest",   ingest_handler,  methods=["GET"]),
+    Route("/metrics",  metrics_handler, methods=["GET"]),
 ])
 
 
@@ -65,16 +279,26 @@ async def main():
     print(f"🌐 Webhook: {wh}")
 
     try:
-        await ptb_app.bot.set_webhook(url=wh, allowed_updates=Update.ALL_TYPES)
+        await ptb_app.bot.set_webhook(url=wh, allowed_updates=Update.ALL_TYPES,
+                                      secret_token=SECRET.decode())
         print("✅ Webhook registered")
     except Exception as e:
         print(f"⚠️ set_webhook failed: {e}")
 
+    flusher = asyncio.create_task(dedup_flush_loop(DEDUP))
+
     config = uvicorn.Config(
         app=web_app, host="0.0.0.0", port=PORT,
         log_level="info", use_colors=False
     )
-    await uvicorn.Server(config).serve()
+    try:
+        await uvicorn.Server(config).serve()
+    finally:
+        flusher.cancel()
+        DEDUP.flush()
+        # post_shutdown ← flush_all: حفظ الحالة وانتظار الكتابات المجدولة
+        await ptb_app.stop()
+        await ptb_app.shutdown()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,62 @@
+"""التعديل التدريجي للفهرس يعطي ما يعطيه التجميع الكامل (معرّفات ومفاتيح إعجاب)"""
+
+import asyncio
+import copy
+
+import pytest
+
+import bot
+
+PATH = ("2024", "علوم", "س1", "فقه")
+
+
+def lessons_with_duplicates():
+    items = [["أ", "F1", "درس"], ["ب", "F2", "درس"], ["أ2", "F1", "ملخص"],
+             ["أ3", "F1", "درس"], ["ج", "F3", "امتحان"]]
+    y, s, m, b = PATH
+    return {y: {s: {m: {b: items}}}}
+
+
+def snapshot(cat):
+    subj = cat.find(*PATH)
+    return [(f, cat.lesson[f].like_key, cat.lesson[f].title) for f in cat.kids(subj)]
+
+
+@pytest.fixture
+def catalog(monkeypatch):
+    d = lessons_with_duplicates()
+    bot._save(bot.FILE_LESSONS, d)
+    monkeypatch.setattr(bot, "_CATALOG", None)
+    monkeypatch.setattr(bot, "_CATALOG_IDS", None)
+    cat = bot.get_catalog()
+    yield cat
+    bot.store_drain()
+
+
+@pytest.mark.parametrize("idx", [0, 1, 2, 3])
+def test_remove_then_recompile_keeps_ids_and_like_keys(catalog, idx):
+    asyncio.run(bot.catalog_remove(*PATH, idx))
+    incremental = snapshot(bot.get_catalog())
+    fresh = bot.Catalog.compile(bot.load_lessons(), bot._CATALOG_IDS)
+    assert snapshot(fresh) == incremental
+    subj = fresh.find(*PATH)
+    assert fresh.count(subj) == bot.get_catalog().count(subj) == 4
+
+
+def test_remove_then_add_matches_recompile(catalog):
+    asyncio.run(bot.catalog_remove(*PATH, 0))
+    asyncio.run(bot.catalog_add(*PATH, ["أ4", "F1", "درس"]))
+    fresh = bot.Catalog.compile(bot.load_lessons(), bot._CATALOG_IDS)
+    assert snapshot(fresh) == snapshot(bot.get_catalog())
+
+
+def test_likes_follow_the_surviving_duplicate(catalog):
+    base = "|".join(PATH)
+    keys = [bot.lesson_key(base, "F1", n) for n in (1, 2, 3)]
+    likes = {k: {"count": n, "users": [], "title": "", "subj": ""}
+             for n, k in enumerate(keys, 1)}
+    bot.save_likes(copy.deepcopy(likes))
+    asyncio.run(bot.catalog_remove(*PATH, 0))           # حذف النسخة الأولى من F1
+    after = bot.load_likes()
+    assert after[keys[0]]["count"] == 2 and after[keys[1]]["count"] == 3
+    assert keys[2] not in after
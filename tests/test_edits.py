@@ -0,0 +1,59 @@
+"""التعديلات المؤجَّلة: لا تعيد رسالةً إلى حالة قديمة ولا تبني على لوحة قديمة"""
+
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import pytest
+from telegram import InlineKeyboardMarkup
+
+import bot
+
+
+@pytest.fixture(autouse=True)
+def fast_edits(monkeypatch):
+    monkeypatch.setattr(bot, "EDIT_INTERVAL", 0.05)
+    monkeypatch.setattr(bot, "_EDITS", {})
+    yield
+    bot.store_drain()
+
+
+def make_message(markup=None):
+    return SimpleNamespace(chat_id=1, message_id=10, reply_markup=markup,
+                           edit_text=AsyncMock(), edit_reply_markup=AsyncMock())
+
+
+def make_update(msg, uid=7):
+    q = SimpleNamespace(message=msg, answer=AsyncMock())
+    return SimpleNamespace(callback_query=q, effective_user=SimpleNamespace(id=uid))
+
+
+def test_close_after_taps_is_not_reverted_by_trailing_edit():
+    msg, ctx = make_message(), SimpleNamespace(user_data={})
+
+    async def main():
+        for _ in range(5):
+            await bot.cb_dhikr_tap(make_update(msg), ctx, "s")
+        await bot.cb_dhikr_close(make_update(msg), ctx, "")
+        await asyncio.sleep(0.15)             # بعد موعد التعديل المؤجَّل
+
+    asyncio.run(main())
+    last = msg.edit_text.await_args_list[-1]
+    assert bot.TXT_WELCOME in last.args + tuple(last.kwargs.values())
+
+
+def test_rapid_likes_keep_earlier_hearts(monkeypatch):
+    monkeypatch.setattr(bot, "record_like", lambda *a: None)
+    markup = InlineKeyboardMarkup([[bot.like_button("a", 0, False, "أ")],
+                                   [bot.like_button("b", 0, False, "ب")]])
+    msg = make_message(markup)                # reply_markup تبقى كما كانت عند الضغط
+
+    async def main():
+        await bot.cb_like(make_update(msg), None, "a")
+        await bot.cb_like(make_update(msg), None, "b")
+        await asyncio.sleep(0.15)
+
+    asyncio.run(main())
+    final = msg.edit_reply_markup.await_args_list[-1].kwargs["reply_markup"]
+    texts = [row[0].text for row in final.inline_keyboard]
+    assert texts == ["❤️ أ (1)", "❤️ ب (1)"]
@@ -0,0 +1,31 @@
+import asyncio
+
+import pytest
+from telegram.error import RetryAfter
+
+import bot
+
+
+def flaky(fails):
+    calls = []
+
+    async def send():
+        calls.append(1)
+        if len(calls) <= fails:
+            raise RetryAfter(0)
+        return "ok"
+    return send, calls
+
+
+def test_flood_retry_waits_and_resends():
+    send, calls = flaky(1)
+    assert asyncio.run(bot.flood_retry(send)) == "ok"
+    assert len(calls) == 2
+
+
+def test_flood_retry_gives_up_after_limit(monkeypatch):
+    monkeypatch.setattr(bot, "FLOOD_TRIES", 1)
+    send, calls = flaky(5)
+    with pytest.raises(RetryAfter):
+        asyncio.run(bot.flood_retry(send))
+    assert len(calls) == 1
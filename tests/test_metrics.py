@@ -0,0 +1,14 @@
+import pytest
+
+import bot
+
+
+@pytest.mark.parametrize("url, label", [
+    ("https://api.telegram.org/bot1:AB/sendMessage", "sendMessage"),
+    ("http://localhost:8081/bot1:AB/getUpdates", "getUpdates"),
+    ("https://api.telegram.org/file/bot1:AB/documents/file_12.pdf", "file"),
+    ("https://api.telegram.org/file/bot1:AB/x.jpg", "file"),
+    ("https://example.com/lessons.csv", "file"),
+])
+def test_api_label_is_bounded(url, label):
+    assert bot.api_label(url) == label
@@ -0,0 +1,46 @@
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def polls(monkeypatch):
+    monkeypatch.setattr(bot, "_POLLS", None)
+    p = bot.get_polls()
+    yield p
+    bot.store_drain()
+
+
+def vote(uid, data):
+    q = SimpleNamespace(answer=AsyncMock())
+    update = SimpleNamespace(callback_query=q, effective_user=SimpleNamespace(id=uid))
+    asyncio.run(bot.cb_poll_vote(update, None, data))
+    return q.answer.await_args
+
+
+@pytest.mark.parametrize("choice", ["-1", "2", "x", ""])
+def test_vote_rejects_bad_choice(polls, choice):
+    pid = polls.create("سؤال؟", ["أ", "ب"])
+    args = vote(7, f"{pid}:{choice}")
+    assert args.args[0] == "خيار غير صحيح."
+    assert polls.counts[pid] == [0, 0] and not polls.get(pid)["votes"]
+
+
+def test_vote_counts_valid_choice(polls):
+    pid = polls.create("سؤال؟", ["أ", "ب"])
+    vote(7, f"{pid}:1")
+    assert polls.counts[pid] == [0, 1]
+
+
+def test_refresh_pass_skips_missing_poll(polls):
+    pid = polls.create("سؤال؟", ["أ", "ب"])
+    polls.live["99"] = {(1, 2): -1}             # رسالة نتائج لاستطلاع لم يعد موجوداً
+    polls.live[pid]  = {(1, 3): -1}
+    app = SimpleNamespace(bot=SimpleNamespace(edit_message_text=AsyncMock()))
+    asyncio.run(bot._poll_refresh_pass(app))
+    assert "99" not in polls.live
+    assert app.bot.edit_message_text.await_count == 1
@@ -0,0 +1,22 @@
+import random
+
+import bot
+
+
+def test_reshuffle_never_starts_with_last_served_question():
+    rng = random.Random(7)
+    random.seed(7)
+    for _ in range(500):
+        deck, prev = bot.QuizDeck(), None
+        for i in range(40):
+            qid = deck.draw(4, "sig")
+            if i and deck.box == 0 and deck.cur == 1:     # أول سحب من تبديلة جديدة
+                assert qid != prev
+            deck.answer(qid, rng.random() < 0.5)          # الخطأ يدخل المراجعة
+            prev = qid
+
+
+def test_last_served_survives_persistence():
+    deck = bot.QuizDeck()
+    qid  = deck.draw(5, "sig")
+    assert bot.QuizDeck.from_json(deck.to_json()).last == qid
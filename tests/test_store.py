@@ -0,0 +1,87 @@
+"""المخزن: الحفظ لا يوقف حلقة الأحداث، والقراءة من الذاكرة قبل اكتمال الكتابة"""
+
+import asyncio
+import json
+import threading
+import time
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import bot
+
+
+def big_store(n=20000):
+    return {str(i): {"name": f"طالب {i}", "score": i, "hist": list(range(40))}
+            for i in range(n)}
+
+
+async def max_stall(work):
+    """أطول فجوة بين نبضات حلقة الأحداث أثناء تنفيذ work()"""
+    stall, stop = 0.0, False
+
+    async def tick():
+        nonlocal stall
+        last = time.perf_counter()
+        while not stop:
+            await asyncio.sleep(0.001)
+            now = time.perf_counter()
+            stall, last = max(stall, now - last), now
+
+    ticker = asyncio.create_task(tick())
+    await asyncio.sleep(0.02)
+    await work()
+    stop = True
+    await ticker
+    return stall
+
+
+def test_large_save_does_not_stall_event_loop():
+    data = big_store()
+
+    async def sync_write():          # ما كان يحدث قبل: تسلسل وكتابة داخل الحلقة
+        with open("sync.json", "w", encoding="utf-8") as f:
+            f.write(json.dumps(data, ensure_ascii=False, indent=2))
+
+    async def store_write():
+        bot._save("big.json", data)
+        await asyncio.to_thread(bot.store_drain)
+
+    blocking = asyncio.run(max_stall(sync_write))
+    stall    = asyncio.run(max_stall(store_write))
+    assert stall < blocking / 4, (stall, blocking)
+    with open("big.json", encoding="utf-8") as f:
+        assert json.load(f) == data
+
+
+def test_load_sees_save_before_it_reaches_disk():
+    lessons = {"x": {"title": "درس"}}
+    bot._IO.submit(time.sleep, 0.2)          # يشغل خيط التخزين
+    bot._save(bot.FILE_LESSONS, lessons)
+    assert bot.load_lessons() is lessons     # لا إعادة بذر من lessons.py
+    bot.store_drain()
+
+
+def test_default_quiz_is_not_shared_with_store():
+    n = len(bot.DEFAULT_QUIZ)
+    bot.load_quiz()
+    stored = bot._load(bot.FILE_QUIZ, None)   # ما ستعدّله الأوامر لاحقاً
+    stored.append({"q": "جديد"})
+    assert stored is not bot.DEFAULT_QUIZ and len(bot.DEFAULT_QUIZ) == n
+    bot.store_drain()
+
+
+
+def test_export_serializes_off_the_event_loop(monkeypatch):
+    data, threads = big_store(200), []
+    real = bot._json_buffer
+
+    def spy(d):
+        threads.append(threading.current_thread().name)
+        return real(d)
+
+    monkeypatch.setattr(bot, "_json_buffer", spy)
+    msg = SimpleNamespace(reply_document=AsyncMock())
+    asyncio.run(bot.send_json_file(msg, data, "x.json", ""))
+    assert threads and threads[0].startswith("store")
+    doc = msg.reply_document.await_args.kwargs["document"]
+    assert json.loads(doc.read().decode("utf-8")) == data
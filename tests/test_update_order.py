@@ -0,0 +1,148 @@
+"""ترتيب التحديثات وحدّ العمل الجاري — عبر حلقة الجلب الحقيقية في PTB"""
+
+import asyncio
+
+from telegram import CallbackQuery, Update, User
+from telegram.ext import Application, TypeHandler
+
+import bot
+
+
+def make_update(update_id, uid):
+    user = User(uid, f"u{uid}", False)
+    return Update(update_id, callback_query=CallbackQuery(
+        str(update_id), user, chat_instance="c", data="x"))
+
+
+def make_app(handler, queue_max=1000, inflight=256, workers=8):
+    queue = bot.BoundedUpdateQueue(queue_max, inflight)
+    app = (Application.builder().token("1:test")
+           .update_queue(queue)
+           .concurrent_updates(bot.ChatOrderedProcessor(workers, queue))
+           .build())
+    app.add_handler(TypeHandler(Update, handler))
+    # تشغيل حلقة الجلب دون initialize (الذي يتصل بتيليغرام)
+    app.bot._bot_user = User(1, "bot", True)
+    app._initialized = app._running = True
+    return app
+
+
+async def run_fetcher(app, until, timeout=5):
+    fetcher = asyncio.create_task(app._update_fetcher())
+    try:
+        await asyncio.wait_for(until(), timeout)
+    finally:
+        fetcher.cancel()
+        await asyncio.gather(fetcher, return_exceptions=True)
+
+
+def test_same_user_updates_run_one_at_a_time_in_order():
+    events = []
+
+    async def handler(update, context):
+        n = update.update_id
+        events.append(("start", update.effective_user.id, n))
+        await asyncio.sleep(0.01 * (n % 3))       # أزمنة مختلفة تغري بالتداخل
+        events.append(("end", update.effective_user.id, n))
+
+    async def main():
+        app = make_app(handler)
+        for n in range(30):
+            app.update_queue.put_nowait(make_update(n, 100 + n % 3))
+        await run_fetcher(app, app.update_queue.join)
+
+    asyncio.run(main())
+    for uid in (100, 101, 102):
+        mine = [(kind, n) for kind, u, n in events if u == uid]
+        ids  = [n for _, n in mine[::2]]
+        assert ids == sorted(ids) and len(ids) == 10
+        assert mine == [(k, n) for n in ids for k in ("start", "end")]
+
+
+def test_different_users_run_concurrently():
+    running = set()
+
+    async def main():
+        together = asyncio.Event()
+
+        async def handler(update, context):
+            running.add(update.effective_user.id)
+            if len(running) == 2:
+                together.set()
+            await together.wait()                 # يعلق إن عولجا بالتتابع
+
+        app = make_app(handler)
+        app.update_queue.put_nowait(make_update(1, 200))
+        app.update_queue.put_nowait(make_update(2, 201))
+        await run_fetcher(app, app.update_queue.join, timeout=2)
+
+    asyncio.run(main())
+    assert running == {200, 201}
+
+
+def test_busy_user_backlog_does_not_delay_other_users():
+    async def main():
+        release, other_done = asyncio.Event(), asyncio.Event()
+
+        async def handler(update, context):
+            if update.effective_user.id == 300:
+                await release.wait()          # إجابة بطيئة لمستخدم ضغط كثيراً
+            else:
+                other_done.set()
+
+        app   = make_app(handler, inflight=8)
+        queue = app.update_queue
+        for n in range(20):
+            queue.put_nowait(make_update(n, 300))
+        queue.put_nowait(make_update(20, 301))
+
+        async def check():
+            await asyncio.wait_for(other_done.wait(), 1)
+            assert queue.inflight == 1 and queue.parked == 19
+            release.set()
+            await queue.join()
+            assert (queue.inflight, queue.parked) == (0, 0)
+            assert queue._slots._value == 8 - 1   # حلقة الجلب تنتظر التالي بخانة
+
+        await run_fetcher(app, check)
+
+    asyncio.run(main())
+
+
+def test_inflight_limit_keeps_backlog_in_queue():
+    release = None
+
+    async def main():
+        nonlocal release
+        release = asyncio.Event()
+
+        async def handler(update, context):
+            await release.wait()
+
+        app   = make_app(handler, queue_max=100, inflight=20)
+        queue = app.update_queue
+        rejected = 0
+
+        async def flood():
+            nonlocal rejected
+            for n in range(500):
+                try:
+                    queue.put_nowait(make_update(n, 1000 + n))
+                except asyncio.QueueFull:
+                    rejected += 1
+                await asyncio.sleep(0)            # يترك حلقة الجلب تعمل
+
+        async def check():
+            await flood()
+            assert queue.inflight == 20
+            assert queue.full()
+            assert rejected == 500 - 100 - 20
+            tasks = [t for t in asyncio.all_tasks() if "process_concurrent_update" in t.get_name()]
+            assert len(tasks) == 20
+            release.set()
+            await queue.join()
+            assert queue.inflight == 0
+
+        await run_fetcher(app, check)
+
+    asyncio.run(main())
@@ -0,0 +1,45 @@
+"""عدّ المستخدمين الجدد: العائد بعد التنظيف ليس جديداً"""
+
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(bot, "_STATS", None)
+    monkeypatch.setattr(bot, "_LAST_SEEN", None)
+    yield
+    bot.store_drain()
+
+
+def interact(uid):
+    chat   = SimpleNamespace(id=uid, type="private")
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=uid), effective_chat=chat,
+                             callback_query=None, inline_query=None, message=None)
+    asyncio.run(bot.track_activity(update, None))
+
+
+def test_pruned_user_returning_is_not_counted_as_new():
+    interact(5)
+    assert bot.get_stats().new_users(1) == 1
+    bot.get_last_seen().touch(5, time.time() - (bot.PRUNE_DAYS + 1) * bot.DAY_SECS)
+    assert bot.prune_inactive() == 1 and 5 not in bot.load_users()
+
+    interact(5)
+    assert 5 in bot.load_users()                  # عاد لقائمة الإرسال
+    assert bot.get_stats().new_users(1) == 1
+
+
+def test_retired_state_survives_restart(monkeypatch):
+    interact(6)
+    bot.get_last_seen().touch(6, time.time() - (bot.PRUNE_DAYS + 1) * bot.DAY_SECS)
+    bot.prune_inactive()
+    bot.get_last_seen().flush()
+    monkeypatch.setattr(bot, "_LAST_SEEN", None)
+    interact(6)
+    assert bot.get_stats().new_users(1) == 1